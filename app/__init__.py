@@ -3,3 +3,9 @@ Medical Bill Extraction System - Main Application
 """
 __version__ = "1.0.0"
 __author__ = "BFHL Challenge Team"
+
+from dotenv import load_dotenv
+
+# The app modules read their settings with os.getenv when they are imported, so .env is
+# loaded here, before any of them (main.py, submit_bill.py and replay.py all import app first)
+load_dotenv()
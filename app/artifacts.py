@@ -0,0 +1,124 @@
+"""
+Short-lived per-job artifacts, so retries resume from the stage that failed
+
+A job's artifact holds what its finished stages produced:
+
+- "content": the extracted content (encoded pages, PDF text, OCR text,
+  forensics reports), so a retry skips rasterization and OCR
+- "response": the provider's answer once it parsed as JSON, so a failure
+  after the provider call (validation, sink) does not pay for the AI again
+
+Artifacts live in memory (bounded, least recently used dropped first) and,
+when the store has a directory, as JSON files there too, which lets a
+rerun of the command line pick up where a failed run stopped (page
+images, which are bytes in memory, are written as {"__bytes__": base64}). Every
+artifact expires ARTIFACT_TTL_SECONDS after it was last written.
+"""
+import os
+import json
+import base64
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+ARTIFACT_TTL_SECONDS = float(os.getenv("ARTIFACT_TTL_SECONDS", "900"))
+ARTIFACT_MAX_ITEMS = int(os.getenv("ARTIFACT_MAX_ITEMS", "256"))
+PURGE_INTERVAL_SECONDS = 60
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj):
+    return base64.b64decode(obj["__bytes__"]) if set(obj) == {"__bytes__"} else obj
+
+
+class ArtifactStore:
+    """Key -> {stage: value} with a TTL, in memory and optionally on disk"""
+
+    def __init__(self, directory=None, ttl=ARTIFACT_TTL_SECONDS, max_items=ARTIFACT_MAX_ITEMS):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()  # key -> (written_at, artifact)
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[:32] + ".json")
+
+    def get(self, key):
+        """The artifact for key ({} if there is none or it expired)"""
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item and now - item[0] <= self.ttl:
+                self._items.move_to_end(key)
+                return dict(item[1])
+            self._items.pop(key, None)
+        if not self.directory:
+            return {}
+        path = self._path(key)
+        try:
+            if now - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return {}
+            with open(path) as f:
+                artifact = json.load(f, object_hook=_decode)
+        except (OSError, ValueError):
+            return {}
+        self._remember(key, artifact, os.path.getmtime(path))
+        return dict(artifact)
+
+    def put(self, key, **stages):
+        """Add / replace stages of key's artifact and restart its TTL"""
+        artifact = {**self.get(key), **stages}
+        now = time.time()
+        self._remember(key, artifact, now)
+        if self.directory:
+            path = self._path(key)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(artifact, f, default=_encode)
+            os.replace(tmp, path)
+        if now - self._last_purge > PURGE_INTERVAL_SECONDS:
+            self.purge()
+        return artifact
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _remember(self, key, artifact, written_at):
+        with self._lock:
+            self._items[key] = (written_at, artifact)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def purge(self):
+        """Drop expired artifacts (memory and disk)"""
+        now = time.time()
+        self._last_purge = now
+        with self._lock:
+            for key in [k for k, (written_at, _) in self._items.items() if now - written_at > self.ttl]:
+                del self._items[key]
+        if not self.directory:
+            return
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.endswith(".json") and now - entry.stat().st_mtime > self.ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,187 @@
+"""
+Benford's-law digit analysis for line-item amounts
+
+Scores the leading-digit distribution of each document's line-item
+amounts against Benford's law (chi-square, 8 degrees of freedom), and
+keeps running per-vendor and per-hospital digit counts in SQLite so every
+new bill can also be compared against its own vendor's history. A
+baseline is just nine counters, so the comparison and the update are
+O(1) regardless of how many bills have been seen.
+
+Each distinct amount counts once per document: a daily room rent repeated
+over a ten-day stay is one charge, not ten identical leading digits, and
+counting it ten times pushes ordinary bills over the threshold. A single
+bill is weak evidence, so a document's own score only adds a flag; the
+risk level is raised when it also deviates from its vendor's or
+hospital's history.
+"""
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+
+BENFORD_PROBS = np.log10(1.0 + 1.0 / np.arange(1, 10))
+DIGIT_COLUMNS = [f"d{d}" for d in range(1, 10)]
+
+CHI_SQUARE_THRESHOLD = float(os.getenv("BENFORD_CHI_SQUARE_THRESHOLD", "15.507"))  # p = 0.05, 8 dof
+MIN_SAMPLE = int(os.getenv("BENFORD_MIN_SAMPLE", "30"))  # distinct amounts per document
+MIN_BASELINE = int(os.getenv("BENFORD_MIN_BASELINE", "100"))
+
+
+def leading_digits(amounts):
+    """Vectorized first significant digit (1-9) of every positive, finite amount"""
+    values = np.abs(np.asarray(amounts, dtype=np.float64))
+    values = values[np.isfinite(values) & (values > 0)]
+    if values.size == 0:
+        return np.empty(0, dtype=np.int64)
+    scaled = values / np.power(10.0, np.floor(np.log10(values)))
+    # Guard against 9.999... / 0.999... rounding at power-of-ten boundaries
+    return np.clip(np.floor(scaled + 1e-9).astype(np.int64), 1, 9)
+
+
+def digit_counts(amounts):
+    """Counts of leading digits 1..9 as an int64 vector of length 9"""
+    return np.bincount(leading_digits(amounts), minlength=10)[1:].astype(np.int64)
+
+
+def chi_square(counts, probs):
+    counts = np.asarray(counts, dtype=np.float64)
+    expected = counts.sum() * probs
+    return float(np.sum((counts - expected) ** 2 / expected))
+
+
+def mean_absolute_deviation(counts, probs):
+    """Nigrini's MAD between observed and expected digit proportions"""
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    return float(np.mean(np.abs(counts / total - probs))) if total else 0.0
+
+
+def _normalize_key(value):
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(value).lower()).split()) if value else ""
+
+
+def _amounts(result):
+    """The document's distinct line-item amounts (to the cent)"""
+    amounts = set()
+    for page in result.get("pages") or []:
+        for item in page.get("line_items") or []:
+            try:
+                amounts.add(round(float(item.get("amount")), 2))
+            except (TypeError, ValueError):
+                pass
+    return sorted(amounts)
+
+
+class BenfordEngine:
+    """Per-document Benford scoring plus incremental per-vendor / per-hospital baselines"""
+
+    def __init__(self, db_path=":memory:", threshold=CHI_SQUARE_THRESHOLD,
+                 min_sample=MIN_SAMPLE, min_baseline=MIN_BASELINE):
+        self.threshold = threshold
+        self.min_sample = min_sample
+        self.min_baseline = min_baseline
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS baselines (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                {", ".join(f"{c} INTEGER NOT NULL DEFAULT 0" for c in DIGIT_COLUMNS)},
+                documents INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, key)
+            )
+        """)
+        self._conn.commit()
+
+    def baseline(self, scope, key):
+        """Digit counts seen so far for a vendor/hospital (zeros if unknown)"""
+        row = self._conn.execute(
+            f"SELECT {', '.join(DIGIT_COLUMNS)} FROM baselines WHERE scope = ? AND key = ?", (scope, key)
+        ).fetchone()
+        return np.array(row if row else [0] * 9, dtype=np.int64)
+
+    def _update(self, scope, key, counts):
+        self._conn.execute(f"""
+            INSERT INTO baselines (scope, key, {", ".join(DIGIT_COLUMNS)}, documents)
+            VALUES (?, ?, {", ".join("?" * 9)}, 1)
+            ON CONFLICT (scope, key) DO UPDATE SET
+                {", ".join(f"{c} = {c} + excluded.{c}" for c in DIGIT_COLUMNS)},
+                documents = documents + 1
+        """, (scope, key, *[int(c) for c in counts]))
+
+    def _compare_to_baseline(self, counts, history):
+        """Chi-square of this document against a vendor's own (Laplace-smoothed) distribution"""
+        probs = (history + 1.0) / (history.sum() + 9.0)
+        score = chi_square(counts, probs)
+        return {
+            "history_amounts": int(history.sum()),
+            "chi_square": round(score, 3),
+            "suspicious": bool(score > self.threshold),
+        }
+
+    def score(self, result, update=True):
+        """Score a result's line-item amounts; optionally fold them into the baselines"""
+        counts = digit_counts(_amounts(result))
+        n = int(counts.sum())
+        analysis = {
+            "amounts_analyzed": n,
+            "digit_distribution": [round(float(c) / n, 4) if n else 0.0 for c in counts],
+            "chi_square": None,
+            "mad": None,
+            "threshold": self.threshold,
+            "suspicious": False,
+            "status": "insufficient_data" if n < self.min_sample else "scored",
+            "baselines": {},
+        }
+        if n >= self.min_sample:
+            score = chi_square(counts, BENFORD_PROBS)
+            analysis["chi_square"] = round(score, 3)
+            analysis["mad"] = round(mean_absolute_deviation(counts, BENFORD_PROBS), 4)
+            analysis["suspicious"] = bool(score > self.threshold)
+
+        header = result.get("header") or {}
+        scopes = {
+            "vendor": _normalize_key(header.get("vendor_name")),
+            "hospital": _normalize_key(header.get("hospital_name")),
+        }
+        with self._lock:
+            for scope, key in scopes.items():
+                if not key or n == 0:
+                    continue
+                history = self.baseline(scope, key)
+                if n >= self.min_sample and history.sum() >= self.min_baseline:
+                    analysis["baselines"][scope] = {"key": key, **self._compare_to_baseline(counts, history)}
+                if update:
+                    self._update(scope, key, counts)
+            if update:
+                self._conn.commit()
+        return analysis
+
+    def annotate(self, result, update=True):
+        """Attach benford_analysis to fraud_analysis and raise flags for suspicious distributions"""
+        analysis = self.score(result, update=update)
+        fraud = result.get("fraud_analysis", {})
+        fraud["benford_analysis"] = analysis
+        flags = fraud.setdefault("flags", [])
+        if analysis["suspicious"]:
+            flags.append(f"Benford's law: leading-digit chi-square {analysis['chi_square']} "
+                         f"exceeds {self.threshold} over {analysis['amounts_analyzed']} distinct amounts")
+        deviates = False
+        for scope, info in analysis["baselines"].items():
+            if info["suspicious"]:
+                flags.append(f"Amount digits deviate from {scope} baseline '{info['key']}' "
+                             f"(chi-square {info['chi_square']} over {info['history_amounts']} past amounts)")
+                deviates = True
+        # One document's chi-square alone is not enough to raise the risk
+        if analysis["suspicious"] and deviates and fraud.get("risk_level") in (None, "LOW"):
+            fraud["risk_level"] = "MEDIUM"
+        result["fraud_analysis"] = fraud
+        return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
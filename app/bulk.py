@@ -0,0 +1,358 @@
+"""
+Offline bulk mode using the providers' asynchronous batch APIs
+
+Packages already-extracted documents into each provider's batch job
+format, submits them, polls for completion and returns the raw model
+text per document so callers can run the usual clean_json_string /
+validate_math path:
+
+- OpenAI:    JSONL file upload + /v1/batches (endpoint /v1/chat/completions)
+- Anthropic: /v1/messages/batches with one params object per document
+- Gemini:    models/<model>:batchGenerateContent with inlined requests
+
+Batch jobs are cheaper than the synchronous endpoints and do not consume
+the interactive rate limits, at the cost of latency (minutes to hours).
+Submitted batches are tracked in a JSON state file so a poller can be
+restarted without resubmitting. Base URLs come from GEMINI_BASE_URL /
+OPENAI_BASE_URL / ANTHROPIC_BASE_URL so everything can run against the
+local stand-in server in mock_provider.py.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import requests
+
+from app.extraction import page_labels, MAX_IMAGES_PER_CALL
+from app.transport import as_base64
+from app.generation import get_profile, gemini_generation_config, openai_params, anthropic_params
+
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+
+GEMINI_MODEL = "gemini-2.5-flash"
+OPENAI_MODEL = "gpt-4o"
+ANTHROPIC_MODEL = "claude-3-5-sonnet-20240620"
+
+BULK_MAX_DOCS_PER_BATCH = int(os.getenv("BULK_MAX_DOCS_PER_BATCH", "100"))
+BULK_POLL_SECONDS = float(os.getenv("BULK_POLL_SECONDS", "60"))
+
+
+def key_fingerprint(api_key):
+    """Stable identifier for a key that is safe to write to disk"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+# --- Per-provider request bodies (same content as the synchronous calls) ---
+
+def gemini_request(prompt, content, profile):
+    parts = [{"text": prompt}]
+    for page, image in zip(page_labels(content), content["images"][:MAX_IMAGES_PER_CALL]):
+        parts.append({"text": f"--- VISUAL DATA FOR PAGE {page} ---"})
+        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": as_base64(image)}})
+    if content["text"]:
+        parts.append({"text": f"EXTRACTED TEXT CONTEXT:\n{content['text']}"})
+    return {"contents": [{"role": "user", "parts": parts}],
+            "generationConfig": gemini_generation_config(profile, GEMINI_MODEL)}
+
+
+def openai_request(prompt, content, profile):
+    user_content = [{"type": "text", "text": prompt}]
+    for page, image in zip(page_labels(content), content["images"][:MAX_IMAGES_PER_CALL]):
+        user_content.append({"type": "text", "text": f"--- PAGE {page} ---"})
+        user_content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{as_base64(image)}"}})
+    if content["text"]:
+        user_content.append({"type": "text", "text": f"TEXT CONTEXT:\n{content['text']}"})
+    return {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {"role": "system", "content": "You are a JSON-only extraction API."},
+            {"role": "user", "content": user_content},
+        ],
+        "response_format": {"type": "json_object"},
+        **openai_params(profile, OPENAI_MODEL),
+    }
+
+
+def anthropic_request(prompt, content, profile):
+    message_content = [
+        {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": as_base64(image)}}
+        for image in content["images"][:MAX_IMAGES_PER_CALL]
+    ]
+    if content["text"]:
+        prompt += f"\n\nTEXT CONTEXT:\n{content['text']}"
+    message_content.append({"type": "text", "text": prompt})
+    return {"model": ANTHROPIC_MODEL, "messages": [{"role": "user", "content": message_content}],
+            **anthropic_params(profile, ANTHROPIC_MODEL)}
+
+
+# --- Provider batch clients ---
+
+class GeminiBatch:
+    name = "gemini"
+
+    def __init__(self, api_key):
+        self.api_key = api_key
+
+    def submit(self, requests_by_id, display_name):
+        body = {"batch": {"display_name": display_name, "input_config": {"requests": {"requests": [
+            {"request": req, "metadata": {"key": custom_id}} for custom_id, req in requests_by_id.items()
+        ]}}}}
+        r = requests.post(f"{GEMINI_BASE_URL}/v1beta/models/{GEMINI_MODEL}:batchGenerateContent",
+                          params={"key": self.api_key}, json=body, timeout=300)
+        r.raise_for_status()
+        return r.json()["name"]
+
+    def poll(self, remote_id):
+        r = requests.get(f"{GEMINI_BASE_URL}/v1beta/{remote_id}", params={"key": self.api_key}, timeout=60)
+        r.raise_for_status()
+        op = r.json()
+        state = (op.get("metadata") or {}).get("state", "")
+        if op.get("done") or state in ("BATCH_STATE_SUCCEEDED", "JOB_STATE_SUCCEEDED"):
+            if op.get("error") or state.endswith("FAILED"):
+                return "failed", op
+            return "completed", op
+        if state.endswith(("FAILED", "CANCELLED", "EXPIRED")):
+            return "failed", op
+        return "running", op
+
+    def results(self, remote_id, op):
+        output = op.get("response") or (op.get("metadata") or {}).get("output") or {}
+        inlined = (output.get("inlinedResponses") or {}).get("inlinedResponses", [])
+        results = {}
+        for entry in inlined:
+            custom_id = (entry.get("metadata") or {}).get("key")
+            response = entry.get("response")
+            if not response:
+                results[custom_id] = (None, None, str(entry.get("error")))
+                continue
+            usage = response.get("usageMetadata", {})
+            results[custom_id] = (response["candidates"][0]["content"]["parts"][0]["text"], {
+                "prompt_tokens": usage.get("promptTokenCount", 0),
+                "output_tokens": usage.get("candidatesTokenCount", 0),
+                "reasoning_tokens": usage.get("thoughtsTokenCount", 0),
+                "total_tokens": usage.get("totalTokenCount", 0),
+                "model": GEMINI_MODEL,
+            }, None)
+        return results
+
+
+class OpenAIBatch:
+    name = "openai"
+
+    def __init__(self, api_key):
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+
+    def submit(self, requests_by_id, display_name):
+        jsonl = "\n".join(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions",
+                                      "body": req}) for custom_id, req in requests_by_id.items())
+        r = requests.post(f"{OPENAI_BASE_URL}/files", headers=self.headers, data={"purpose": "batch"},
+                          files={"file": (f"{display_name}.jsonl", jsonl.encode("utf-8"))}, timeout=300)
+        r.raise_for_status()
+        r = requests.post(f"{OPENAI_BASE_URL}/batches", headers=self.headers, timeout=60, json={
+            "input_file_id": r.json()["id"],
+            "endpoint": "/v1/chat/completions",
+            "completion_window": "24h",
+            "metadata": {"bulk_id": display_name},
+        })
+        r.raise_for_status()
+        return r.json()["id"]
+
+    def poll(self, remote_id):
+        r = requests.get(f"{OPENAI_BASE_URL}/batches/{remote_id}", headers=self.headers, timeout=60)
+        r.raise_for_status()
+        batch = r.json()
+        if batch["status"] == "completed":
+            return "completed", batch
+        if batch["status"] in ("failed", "expired", "cancelled"):
+            return "failed", batch
+        return "running", batch
+
+    def results(self, remote_id, batch):
+        results = {}
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if not file_id:
+                continue
+            r = requests.get(f"{OPENAI_BASE_URL}/files/{file_id}/content", headers=self.headers, timeout=300)
+            r.raise_for_status()
+            for line in r.text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                body = response.get("body") or {}
+                if response.get("status_code") != 200 or not body.get("choices"):
+                    results[entry["custom_id"]] = (None, None, str(entry.get("error") or body.get("error")))
+                    continue
+                usage = body.get("usage", {})
+                details = usage.get("completion_tokens_details") or {}
+                results[entry["custom_id"]] = (body["choices"][0]["message"]["content"], {
+                    "prompt_tokens": usage.get("prompt_tokens", 0),
+                    "output_tokens": usage.get("completion_tokens", 0),
+                    "reasoning_tokens": details.get("reasoning_tokens", 0),
+                    "total_tokens": usage.get("total_tokens", 0),
+                    "model": OPENAI_MODEL,
+                }, None)
+        return results
+
+
+class AnthropicBatch:
+    name = "anthropic"
+
+    def __init__(self, api_key):
+        self.headers = {"x-api-key": api_key, "anthropic-version": "2023-06-01"}
+
+    def submit(self, requests_by_id, display_name):
+        r = requests.post(f"{ANTHROPIC_BASE_URL}/v1/messages/batches", headers=self.headers, timeout=300, json={
+            "requests": [{"custom_id": custom_id, "params": req} for custom_id, req in requests_by_id.items()]
+        })
+        r.raise_for_status()
+        return r.json()["id"]
+
+    def poll(self, remote_id):
+        r = requests.get(f"{ANTHROPIC_BASE_URL}/v1/messages/batches/{remote_id}", headers=self.headers, timeout=60)
+        r.raise_for_status()
+        batch = r.json()
+        if batch.get("processing_status") == "ended":
+            return "completed", batch
+        return "running", batch
+
+    def results(self, remote_id, batch):
+        r = requests.get(batch["results_url"], headers=self.headers, timeout=300)
+        r.raise_for_status()
+        results = {}
+        for line in r.text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            result = entry.get("result") or {}
+            if result.get("type") != "succeeded":
+                results[entry["custom_id"]] = (None, None, result.get("type", "errored"))
+                continue
+            message = result["message"]
+            usage = message.get("usage", {})
+            text = next(block["text"] for block in message["content"] if block.get("type") == "text")
+            results[entry["custom_id"]] = (text, {
+                "prompt_tokens": usage.get("input_tokens", 0),
+                "output_tokens": usage.get("output_tokens", 0),
+                "reasoning_tokens": 0,
+                "total_tokens": usage.get("input_tokens", 0) + usage.get("output_tokens", 0),
+                "model": "claude-3-5-sonnet",
+            }, None)
+        return results
+
+
+BATCH_CLIENTS = {"gemini": GeminiBatch, "openai": OpenAIBatch, "anthropic": AnthropicBatch}
+REQUEST_BUILDERS = {"gemini": gemini_request, "openai": openai_request, "anthropic": anthropic_request}
+
+
+class BulkState:
+    """JSON file listing submitted batches and which document each custom_id belongs to"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.batches = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.batches = json.load(f)
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.batches, f, indent=2)
+            os.replace(tmp, self.path)
+
+    def pending(self):
+        return {bid: b for bid, b in self.batches.items() if b["status"] == "submitted"}
+
+
+def submit_documents(documents, pool, prompt_fn, state, profile=None):
+    """
+    Submit documents as provider batch jobs.
+    documents: list of dicts with "ref" (file path or job id), "filename", "content"
+               and optionally "extra" (JSON-serializable data kept for fan-out).
+    pool: API key pool entries ({"provider", "key"}); chunks are spread round-robin.
+    Returns the list of new bulk ids.
+    """
+    if not pool:
+        raise RuntimeError("No API keys configured for bulk submission")
+    profile = get_profile(profile)
+    chunks = [documents[i:i + BULK_MAX_DOCS_PER_BATCH] for i in range(0, len(documents), BULK_MAX_DOCS_PER_BATCH)]
+    bulk_ids = []
+    for n, chunk in enumerate(chunks):
+        entry = pool[n % len(pool)]
+        provider, api_key = entry["provider"], entry["key"]
+        bulk_id = f"bulk-{uuid.uuid4().hex[:12]}"
+        items, requests_by_id = {}, {}
+        for i, doc in enumerate(chunk):
+            custom_id = f"doc-{i}"
+            prompt = prompt_fn(doc["filename"], doc["content"]["page_count"], doc["content"].get("page_numbers"))
+            requests_by_id[custom_id] = REQUEST_BUILDERS[provider](prompt, doc["content"], profile)
+            items[custom_id] = {"ref": doc["ref"], "filename": doc["filename"], "extra": doc.get("extra")}
+
+        remote_id = BATCH_CLIENTS[provider](api_key).submit(requests_by_id, bulk_id)
+        state.batches[bulk_id] = {
+            "provider": provider,
+            "key_fingerprint": key_fingerprint(api_key),
+            "remote_id": remote_id,
+            "profile": profile["name"],
+            "status": "submitted",
+            "submitted_at": time.time(),
+            "items": items,
+        }
+        state.save()
+        print(f"Submitted {len(items)} document(s) to {provider} batch {remote_id} ({bulk_id})")
+        bulk_ids.append(bulk_id)
+    return bulk_ids
+
+
+def poll_once(bulk_id, batch, pool):
+    """
+    Check one submitted batch. Returns None while it is still running,
+    otherwise {custom_id: (text, token_info, error)} for every item.
+    """
+    key = next((e["key"] for e in pool if e["provider"] == batch["provider"]
+                and key_fingerprint(e["key"]) == batch["key_fingerprint"]), None)
+    if not key:
+        raise RuntimeError(f"API key for {bulk_id} ({batch['provider']}) is no longer configured")
+    client = BATCH_CLIENTS[batch["provider"]](key)
+    status, payload = client.poll(batch["remote_id"])
+    if status == "running":
+        return None
+    results = client.results(batch["remote_id"], payload) if status == "completed" else {}
+    for custom_id in batch["items"]:
+        text, token_info, error = results.get(custom_id, (None, None, f"batch {status}"))
+        if token_info:
+            token_info.update({"profile": batch.get("profile"), "mode": "bulk"})
+        results[custom_id] = (text, token_info, error)
+    return results
+
+
+def wait_for_batches(state, pool, on_result, poll_seconds=BULK_POLL_SECONDS):
+    """
+    Poll every pending batch in state until all have finished, calling
+    on_result(item, text, token_info, error) for each document as its batch completes.
+    """
+    while state.pending():
+        for bulk_id, batch in state.pending().items():
+            try:
+                results = poll_once(bulk_id, batch, pool)
+            except Exception as e:
+                print(f"Polling {bulk_id} failed: {e}")
+                continue
+            if results is None:
+                continue
+            for custom_id, (text, token_info, error) in results.items():
+                on_result(batch["items"][custom_id], text, token_info, error)
+            batch["status"] = "completed"
+            batch["completed_at"] = time.time()
+            state.save()
+            print(f"Batch {bulk_id} finished ({len(results)} document(s))")
+        if state.pending():
+            time.sleep(poll_seconds)
@@ -0,0 +1,227 @@
+"""
+Client for a running API server (python submit_bill.py --server URL)
+
+Instead of extracting and calling the AI itself, the command line can hand
+its files to the web service, so key rotation, rate limits, scheduling,
+artifacts and indexes all live in one place however many people run it:
+
+- files are uploaded to /api/v1/batch-extract in groups of
+  FILES_PER_UPLOAD, several requests at once, all into one batch_id chosen
+  by the client; request bodies are streamed from disk
+- results come from /api/v1/batch/{batch_id}/results: long-polled,
+  compressed NDJSON of every job finished since the last cursor, so a
+  batch of any size costs one request per POLL_WAIT_SECONDS at most
+  (plus one per 1,000 results)
+
+Which file went to which job is saved in a small JSON state file after
+every upload and download. Dropped connections are retried with backoff;
+a run that was stopped continues where it was when started again, and if
+the server no longer knows the batch (it was restarted), the files
+without a result are uploaded again.
+"""
+import os
+import json
+import time
+import uuid
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+FILES_PER_UPLOAD = 4
+POLL_WAIT_SECONDS = 20
+RECONNECT_DELAYS = (1, 2, 5, 10, 30)
+UPLOAD_CHUNK_BYTES = 256 * 1024
+
+
+class BatchNotFound(Exception):
+    pass
+
+
+class MultipartBody:
+    """multipart/form-data body of files, read from disk in chunks while it is sent"""
+
+    def __init__(self, field, paths):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        for path in paths:
+            name = os.path.basename(path).replace('"', "")
+            mime = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            self.parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{field}"; '
+                              f'filename="{name}"\r\nContent-Type: {mime}\r\n\r\n'.encode())
+            self.parts.append(path)
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode())
+        self.length = sum(len(p) if isinstance(p, bytes) else os.path.getsize(p) for p in self.parts)
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, "rb") as f:
+                while True:
+                    chunk = f.read(UPLOAD_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    yield chunk
+
+
+class ApiClient:
+    """The API calls a batch needs, retried with backoff when the connection drops"""
+
+    def __init__(self, server, tenant=None, timeout=120):
+        import requests
+        self.base = server.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        if tenant:
+            self.session.headers["X-Tenant-ID"] = tenant
+
+    def _request(self, method, path, **kwargs):
+        import requests
+        kwargs.setdefault("timeout", self.timeout)
+        for delay in RECONNECT_DELAYS + (None,):
+            try:
+                response = self.session.request(method, f"{self.base}{path}", **kwargs)
+                if response.status_code < 500 or delay is None:
+                    return response
+                reason = f"HTTP {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if delay is None:
+                    raise
+                reason = type(e).__name__
+            print(f"   🔌 {reason} from {self.base}; retrying in {delay}s")
+            time.sleep(delay)
+
+    def upload(self, paths, batch_id, params=None):
+        body = MultipartBody("files", paths)
+        response = self._request("POST", "/api/v1/batch-extract", data=body,
+                                 params={**(params or {}), "batch_id": batch_id},
+                                 headers={"Content-Type": body.content_type})
+        response.raise_for_status()
+        return response.json()
+
+    def batch_results(self, batch_id, since=0, wait=0):
+        """(cursor, done, records): the jobs finished after since, read line by line from the
+        (gzip/zstd) NDJSON stream while iterating records"""
+        response = self._request("GET", f"/api/v1/batch/{batch_id}/results", params={"since": since, "wait": wait},
+                                 timeout=self.timeout + wait, stream=True)
+        if response.status_code == 404:
+            raise BatchNotFound(batch_id)
+        response.raise_for_status()
+        records = (json.loads(line) for line in response.iter_lines() if line)
+        return int(response.headers["X-Batch-Cursor"]), response.headers.get("X-Batch-Done") == "true", records
+
+
+class BatchState:
+    """batch_id and path -> {"job_id", "done"}, saved to a JSON file after every change"""
+
+    def __init__(self, path, server):
+        self.path = path
+        data = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+        if data.get("server") != server:
+            data = {}
+        self.server = server
+        self.batch_id = data.get("batch_id") or uuid.uuid4().hex
+        self.files = data.get("files", {})
+        self._lock = threading.Lock()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"server": self.server, "batch_id": self.batch_id, "files": self.files}, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def job_id(self, path):
+        entry = self.files.get(path) or {}
+        return None if entry.get("done") else entry.get("job_id")
+
+    def assign(self, path, job_id):
+        with self._lock:
+            self.files[path] = {"job_id": job_id, "done": False}
+            self.save()
+
+    def finish(self, path):
+        with self._lock:
+            self.files[path]["done"] = True
+            self.save()
+
+    def new_batch(self):
+        """Start over in a new batch for the files that have no result yet"""
+        with self._lock:
+            self.batch_id = uuid.uuid4().hex
+            self.files = {p: e for p, e in self.files.items() if e.get("done")}
+            self.save()
+
+    def pending(self, paths):
+        """{job_id: path} of the given files that were uploaded but have no result yet"""
+        return {self.job_id(p): p for p in paths if self.job_id(p)}
+
+    def discard(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def upload_files(client, state, paths, params=None, concurrency=4):
+    """Upload the files that are not in the batch yet, FILES_PER_UPLOAD per request, concurrently"""
+    todo = [p for p in paths if not state.job_id(p)]
+    groups = [todo[i:i + FILES_PER_UPLOAD] for i in range(0, len(todo), FILES_PER_UPLOAD)]
+
+    def send(group):
+        answer = client.upload(group, state.batch_id, params)
+        for path, job in zip(group, answer["batch_results"]):
+            state.assign(path, job["job_id"])
+        return len(group)
+
+    if groups:
+        print(f"📤 Uploading {len(todo)} file(s) to batch {state.batch_id} ({len(groups)} request(s))...")
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            sent = 0
+            for count in pool.map(send, groups):
+                sent += count
+                print(f"   📤 {sent}/{len(todo)} uploaded", end="\r", flush=True)
+        print()
+    return len(todo)
+
+
+def follow_batch(client, state, paths, on_result, params=None, concurrency=4):
+    """Wait for the batch's jobs and call on_result(path, record) for each file as its job finishes
+    (record: {"job_id", "status", "result"} or {..., "error"})"""
+    cursor = 0
+    while True:
+        pending = state.pending(paths)
+        if not pending:
+            return
+        try:
+            next_cursor, _, records = client.batch_results(state.batch_id, cursor, POLL_WAIT_SECONDS)
+            for record in records:
+                path = pending.pop(record["job_id"], None)
+                if path:
+                    on_result(path, record)
+                    state.finish(path)
+            # Only once the whole answer is read; a broken stream is asked for again
+            cursor = next_cursor
+        except BatchNotFound:
+            print(f"\n   ⚠️ The server no longer knows batch {state.batch_id}; uploading unfinished files again")
+            state.new_batch()
+            upload_files(client, state, paths, params, concurrency)
+            cursor = 0
+        except Exception as e:
+            # Results already saved are marked in the state; the rest are picked up on the next round
+            print(f"\n   🔌 Lost the server ({e}); still waiting...")
+            time.sleep(RECONNECT_DELAYS[-1])
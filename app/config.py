@@ -3,7 +3,6 @@ Configuration management for Medical Bill Extraction System
 """
 from pydantic_settings import BaseSettings
 from typing import Optional
-import os
 
 
 class Settings(BaseSettings):
@@ -32,16 +31,12 @@ class Settings(BaseSettings):
     # LLM Settings
     use_gpt4_vision: bool = True
     use_claude: bool = True
-    llm_max_tokens: int = 2000
-    llm_temperature: float = 0.1
     
     # Fraud Detection Settings
-    benford_chi_square_threshold: float = 15.507
     font_outlier_threshold: float = 0.15
     tampering_sensitivity: float = 0.7
     
     # Validation Settings
-    total_match_tolerance: float = 0.01  # 1% tolerance
     min_confidence_score: float = 0.7
     
     # API Settings
@@ -59,7 +54,3 @@ class Settings(BaseSettings):
 
 # Global settings instance
 settings = Settings()
-
-# Create necessary directories
-os.makedirs(settings.temp_dir, exist_ok=True)
-os.makedirs(settings.output_dir, exist_ok=True)
@@ -0,0 +1,255 @@
+"""
+Cross-document duplicate-billing index
+
+Persists every extracted line item (after validate_math) in SQLite with
+normalized description / vendor / date / amount signatures and MinHash
+LSH band keys over the description. New results are checked against the
+whole history with indexed lookups only:
+
+- exact duplicate: same vendor, date, amount and normalized description
+  already billed in a different document
+- near duplicate: same vendor, date and amount with a description whose
+  estimated Jaccard similarity (character 3-grams) is above a threshold
+- re-submitted bill: most of a document's items match one earlier document
+  with the same invoice id or recipient; patients billed the same standard
+  charges (different recipients, different or missing invoice ids) only
+  get a MEDIUM overlap finding
+
+Matches are appended to fraud_analysis.flags.
+"""
+import os
+import re
+import time
+import zlib
+import random
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+NUM_PERM = 32
+BANDS = 8
+ROWS_PER_BAND = NUM_PERM // BANDS
+NEAR_DUPLICATE_THRESHOLD = 0.8
+RESUBMISSION_RATIO = 0.5
+MAX_CANDIDATES = 50
+MAX_ITEM_FLAGS = 10
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1729)  # fixed seed: signatures must be stable across runs
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(NUM_PERM)]
+
+
+def normalize_text(value):
+    """Lowercase, keep letters/digits, collapse whitespace"""
+    if value is None:
+        return ""
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", str(value).lower()).split())
+
+
+def amount_to_cents(value):
+    try:
+        return int(round(float(value) * 100))
+    except (TypeError, ValueError):
+        return None
+
+
+def minhash(text):
+    """MinHash signature over character 3-gram shingles"""
+    padded = f" {text} "
+    shingles = {zlib.crc32(padded[i:i + 3].encode()) for i in range(max(len(padded) - 2, 1))}
+    return [min((a * s + b) % _MERSENNE_PRIME for s in shingles) for a, b in _PERMUTATIONS]
+
+
+def band_keys(signature):
+    """One signed 63-bit key per LSH band"""
+    keys = []
+    for band in range(BANDS):
+        chunk = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(repr((band, chunk)).encode(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, "big", signed=True))
+    return keys
+
+
+def estimated_jaccard(sig_a, sig_b):
+    return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / NUM_PERM
+
+
+class DuplicateIndex:
+    """Persistent line-item index shared by every processed document"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY,
+                doc_id TEXT NOT NULL,
+                source TEXT,
+                vendor TEXT NOT NULL,
+                item_date TEXT NOT NULL,
+                amount_cents INTEGER NOT NULL,
+                description TEXT,
+                exact_sig TEXT NOT NULL,
+                minhash BLOB NOT NULL,
+                added_at REAL NOT NULL,
+                recipient TEXT NOT NULL DEFAULT '',
+                invoice_id TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS idx_items_exact ON items (exact_sig);
+            CREATE INDEX IF NOT EXISTS idx_items_doc ON items (doc_id);
+            CREATE TABLE IF NOT EXISTS lsh (
+                band_key INTEGER NOT NULL,
+                item_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_lsh_band ON lsh (band_key);
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(items)")}
+        for column in ("recipient", "invoice_id"):
+            if column not in columns:   # index files written before these were kept
+                self._conn.execute(f"ALTER TABLE items ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        self._conn.commit()
+
+    @staticmethod
+    def _party(result):
+        """(recipient, invoice id) of a result, normalized ("" when unknown)"""
+        header = result.get("header") or {}
+        return normalize_text(header.get("recipient_name")), normalize_text(header.get("id"))
+
+    @staticmethod
+    def _signatures(result):
+        """Yield (description, vendor, date, amount_cents, desc_norm, exact_sig) for every line item"""
+        header = result.get("header") or {}
+        vendor = normalize_text(header.get("vendor_name"))
+        item_date = str(header.get("date") or "")
+        for page in result.get("pages") or []:
+            for item in page.get("line_items") or []:
+                cents = amount_to_cents(item.get("amount"))
+                desc_norm = normalize_text(item.get("description"))
+                if cents is None or not desc_norm:
+                    continue
+                exact_sig = hashlib.sha1(f"{vendor}|{item_date}|{cents}|{desc_norm}".encode()).hexdigest()
+                yield item.get("description"), vendor, item_date, cents, desc_norm, exact_sig
+
+    def check(self, result, doc_id):
+        """Find earlier items from other documents that duplicate this result's items"""
+        matches = []
+        items = list(self._signatures(result))
+        with self._lock:
+            for description, vendor, item_date, cents, desc_norm, exact_sig in items:
+                row = self._conn.execute(
+                    "SELECT doc_id, source, description, recipient, invoice_id FROM items "
+                    "WHERE exact_sig = ? AND doc_id != ? LIMIT 1",
+                    (exact_sig, doc_id)
+                ).fetchone()
+                if row:
+                    matches.append({"description": description, "amount": cents / 100, "kind": "exact",
+                                    "similarity": 1.0, "doc_id": row[0], "source": row[1],
+                                    "recipient": row[3], "invoice_id": row[4]})
+                    continue
+
+                signature = minhash(desc_norm)
+                keys = band_keys(signature)
+                rows = self._conn.execute(
+                    f"SELECT DISTINCT i.doc_id, i.source, i.description, i.minhash, i.recipient, i.invoice_id "
+                    f"FROM lsh l "
+                    f"JOIN items i ON i.id = l.item_id "
+                    f"WHERE l.band_key IN ({','.join('?' * len(keys))}) "
+                    f"AND i.amount_cents = ? AND i.vendor = ? AND i.item_date = ? AND i.doc_id != ? "
+                    f"LIMIT {MAX_CANDIDATES}",
+                    (*keys, cents, vendor, item_date, doc_id)
+                ).fetchall()
+                best = None
+                for other_doc, other_source, other_desc, blob, recipient, invoice_id in rows:
+                    similarity = estimated_jaccard(signature, array("q", blob))
+                    if similarity >= NEAR_DUPLICATE_THRESHOLD and (not best or similarity > best["similarity"]):
+                        best = {"description": description, "amount": cents / 100, "kind": "near",
+                                "similarity": round(similarity, 2), "doc_id": other_doc,
+                                "source": other_source, "matched_description": other_desc,
+                                "recipient": recipient, "invoice_id": invoice_id}
+                if best:
+                    matches.append(best)
+        return matches, len(items)
+
+    def add(self, result, doc_id, source=None):
+        """(Re)index a document's line items; reprocessing the same doc_id replaces its rows"""
+        now = time.time()
+        recipient, invoice_id = self._party(result)
+        with self._lock:
+            old_ids = [r[0] for r in self._conn.execute("SELECT id FROM items WHERE doc_id = ?", (doc_id,))]
+            if old_ids:
+                marks = ",".join("?" * len(old_ids))
+                self._conn.execute(f"DELETE FROM lsh WHERE item_id IN ({marks})", old_ids)
+                self._conn.execute(f"DELETE FROM items WHERE id IN ({marks})", old_ids)
+            for description, vendor, item_date, cents, desc_norm, exact_sig in self._signatures(result):
+                signature = minhash(desc_norm)
+                cur = self._conn.execute(
+                    "INSERT INTO items (doc_id, source, vendor, item_date, amount_cents, description, "
+                    "exact_sig, minhash, added_at, recipient, invoice_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (doc_id, source, vendor, item_date, cents, description, exact_sig,
+                     array("q", signature).tobytes(), now, recipient, invoice_id)
+                )
+                self._conn.executemany("INSERT INTO lsh (band_key, item_id) VALUES (?, ?)",
+                                       [(key, cur.lastrowid) for key in band_keys(signature)])
+            self._conn.commit()
+
+    def annotate(self, result, doc_id, source=None):
+        """Check a validated result against the index, flag matches, then add it to the index"""
+        matches, item_count = self.check(result, doc_id)
+        self.add(result, doc_id, source)
+        if not matches:
+            return result
+
+        fraud = result.get("fraud_analysis", {})
+        flags = fraud.setdefault("flags", [])
+        for m in matches[:MAX_ITEM_FLAGS]:
+            where = m["source"] or m["doc_id"]
+            if m["kind"] == "exact":
+                msg = f"Cross-document duplicate: '{m['description']}' ({m['amount']}) already billed in {where}"
+            else:
+                msg = (f"Cross-document near-duplicate: '{m['description']}' ({m['amount']}) resembles "
+                       f"'{m['matched_description']}' in {where} (similarity {m['similarity']})")
+            if msg not in flags:
+                flags.append(msg)
+        if len(matches) > MAX_ITEM_FLAGS:
+            flags.append(f"... and {len(matches) - MAX_ITEM_FLAGS} more cross-document duplicate line items")
+
+        # Most of the bill matches a single earlier document -> likely re-submitted
+        per_doc = {}
+        for m in matches:
+            per_doc[m["doc_id"]] = per_doc.get(m["doc_id"], 0) + 1
+        top_doc, top_count = max(per_doc.items(), key=lambda kv: kv[1])
+        overlap = item_count > 0 and top_count / item_count >= RESUBMISSION_RATIO
+        resubmitted = False
+        if overlap:
+            top = next(m for m in matches if m["doc_id"] == top_doc)
+            where = top["source"] or top["doc_id"]
+            recipient, invoice_id = self._party(result)
+            # Two patients with the same standard charges are not a re-submission; the same invoice id is,
+            # whatever name the AI read
+            same_invoice = bool(invoice_id) and invoice_id == top["invoice_id"]
+            other_recipient = bool(recipient and top["recipient"]) and recipient != top["recipient"]
+            resubmitted = same_invoice or not other_recipient
+            if resubmitted:
+                flags.append(f"Possible re-submitted bill: {top_count}/{item_count} line items match {where}")
+            else:
+                flags.append(f"Cross-document overlap: {top_count}/{item_count} line items match {where}, "
+                             f"billed to a different recipient")
+
+        fraud["duplicates_detected"] = True
+        fraud["cross_document_duplicates"] = len(matches)
+        if resubmitted:
+            fraud["risk_level"] = "HIGH"
+        elif fraud.get("risk_level") in (None, "LOW"):
+            fraud["risk_level"] = "MEDIUM"
+        result["fraud_analysis"] = fraud
+        return result
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
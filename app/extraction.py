@@ -0,0 +1,418 @@
+"""
+Content extraction backends (PDF / image -> text + page images for the AI)
+
+Backends register themselves per file extension with @backend. The heavy
+libraries (pdf2image, pypdf, Pillow, pytesseract, the NumPy forensics
+module) are imported the first time a document of that type is
+extracted, and the Tesseract / Poppler install locations are probed on
+first use rather than at import. warm_up() does all of that ahead of
+time.
+
+A document can be given as a path (command line) or as raw bytes
+(uploads); both go through the same backend.
+
+Callers can ask for a subset of pages, by number ("1-3,7,10-") and/or by
+role ("summary", "line_items"). The selection is made before anything is
+rasterized or OCR'd, so cost follows the pages requested rather than the
+length of the document; roles are decided from the PDF text layer, which
+is much cheaper to read than rendering a page.
+
+With a page index (app/page_index.py) PDF pages already known to be
+boilerplate are dropped as well: by text hash before rasterizing, by
+image hash before encoding. The pages that stay and whose image is sent
+to the AI (the first MAX_IMAGES_PER_CALL) are fingerprinted in
+content["page_hashes"] so the index can learn from the result; a page the
+AI never saw says nothing about whether it has line items.
+
+Pages are kept as JPEG bytes; providers base64-encode them only while
+sending (app/transport.py). PDFs are rendered to a temporary directory
+and taken PAGE_WINDOW pages at a time through fingerprinting, forensics
+and JPEG encoding, so a long document never has all its decoded pages in
+memory at once.
+"""
+import io
+import os
+import re
+import sys
+import tempfile
+import threading
+
+from app.metrics import StageTimer
+from app import page_index
+
+# Local pixel forensics (ELA, noise, compression, font metrics) on rendered pages
+PIXEL_FORENSICS = os.getenv("PIXEL_FORENSICS", "true").lower() == "true"
+# Page images sent to the AI per document (packed and re-read calls set content["max_images"])
+MAX_IMAGES_PER_CALL = 5
+# Rendered PDF pages decoded in memory at a time (fingerprint, forensics, JPEG encoding)
+PAGE_WINDOW = int(os.getenv("PAGE_WINDOW", str(min(4, os.cpu_count() or 1))))
+# Deskew / crop / binarize photos before OCR and the vision call (app/preprocess.py)
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "true").lower() == "true"
+
+# Windows install locations; on Linux / Docker the binaries are on PATH
+TESSERACT_CMD = os.getenv("TESSERACT_CMD", r"C:\Program Files\Tesseract-OCR\tesseract.exe")
+POPPLER_PATHS = [r"C:\Program Files\poppler-25.11.0\Library\bin", r"C:\Program Files\poppler-25.11.0\bin"]
+
+# extension -> backend(source, content, timer, selection); "" is the fallback
+BACKENDS = {}
+
+PAGE_ROLES = ("all", "summary", "line_items")
+# Wording that marks a page carrying the bill's totals
+SUMMARY_PATTERN = re.compile(
+    r"grand\s*total|net\s*(amount|payable)|amount\s*(due|payable)|total\s*(amount|payable|bill)|"
+    r"bill\s*summary|balance\s*due|final\s*bill", re.IGNORECASE)
+# Amount-like numbers (1,234.50 / 450.00); a page with several is a line-item page
+AMOUNT_PATTERN = re.compile(r"\d[\d,]*\.\d{2}\b")
+MIN_AMOUNT_LINES = 3
+
+_BINARIES_LOCK = threading.Lock()
+_BINARIES_READY = False
+
+
+def backend(*extensions):
+    """Register an extraction backend for the given file extensions"""
+    def decorator(fn):
+        for ext in extensions:
+            BACKENDS[ext] = fn
+        return fn
+    return decorator
+
+
+def configure_binaries():
+    """Point pytesseract / pdf2image at the Tesseract and Poppler installs (once)"""
+    global _BINARIES_READY
+    with _BINARIES_LOCK:
+        if _BINARIES_READY:
+            return
+        if os.path.exists(TESSERACT_CMD):
+            import pytesseract
+            pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+        for path in POPPLER_PATHS:
+            if os.path.exists(path):
+                os.environ["PATH"] += os.pathsep + path
+                break
+        _BINARIES_READY = True
+
+
+class PageSelectionError(ValueError):
+    """The requested pages / role do not select anything in this document"""
+
+
+def parse_page_ranges(spec, page_count=None):
+    """'1-3,7,10-' -> [1, 2, 3, 7, 10, 11, ...] (1-based, sorted).
+    Without page_count only the syntax is checked and open ranges stay unexpanded."""
+    pages = set()
+    for part in str(spec).replace(" ", "").split(","):
+        if not part:
+            continue
+        match = re.fullmatch(r"(\d+)(?:-(\d*))?", part)
+        if not match or int(match.group(1)) < 1:
+            raise PageSelectionError(f"Invalid page range '{part}' (use e.g. 1-3,7,10-)")
+        start = int(match.group(1))
+        if match.group(2) is None:
+            end = start
+        elif match.group(2) == "":
+            end = page_count if page_count is not None else start
+        else:
+            end = int(match.group(2))
+        if end < start:
+            raise PageSelectionError(f"Invalid page range '{part}' (end before start)")
+        if page_count is not None:
+            end = min(end, page_count)
+        pages.update(range(start, end + 1))
+    if not pages:
+        raise PageSelectionError("Empty page range")
+    return sorted(pages)
+
+
+def check_page_request(pages=None, page_role=None):
+    """Validate client input up front; raises PageSelectionError"""
+    if pages:
+        parse_page_ranges(pages)
+    if page_role and page_role not in PAGE_ROLES:
+        raise PageSelectionError(f"Unknown page role '{page_role}' (use {', '.join(PAGE_ROLES)})")
+
+
+def select_pages(page_count, page_text, pages=None, page_role=None):
+    """Pick the pages to process. page_text(n) returns the text layer of page n.
+    Returns (page numbers, {page number: text} read along the way)."""
+    selected = parse_page_ranges(pages, page_count) if pages else list(range(1, page_count + 1))
+    selected = [p for p in selected if p <= page_count]
+    if not selected:
+        raise PageSelectionError(f"Pages '{pages}' are outside this {page_count}-page document")
+    if not page_role or page_role == "all":
+        return selected, {}
+
+    texts = {p: page_text(p) or "" for p in selected}
+    if page_role == "summary":
+        chosen = [p for p in selected if SUMMARY_PATTERN.search(texts[p])]
+        # No text layer / no totals wording: totals are almost always on the first or last page
+        chosen = chosen or sorted({selected[0], selected[-1]})
+    else:
+        chosen = [p for p in selected
+                  if sum(1 for line in texts[p].splitlines() if AMOUNT_PATTERN.search(line)) >= MIN_AMOUNT_LINES]
+        chosen = chosen or selected
+    return chosen, {p: texts[p] for p in chosen}
+
+
+def page_runs(page_numbers):
+    """[1, 2, 3, 7, 9, 10] -> [(1, 3), (7, 7), (9, 10)]"""
+    runs = []
+    for p in page_numbers:
+        if runs and p == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], p)
+        else:
+            runs.append((p, p))
+    return runs
+
+
+def sent_pages(content):
+    """Page numbers the AI gets to see: those with an image within the per-call limit, or every
+    page when only text is sent"""
+    pages = content.get("page_numbers") or []
+    if content.get("images"):
+        return pages[:content.get("max_images", MAX_IMAGES_PER_CALL)]
+    return pages
+
+
+def page_labels(content):
+    """Document page number (or packed-call label) of each image in content["images"]"""
+    return content.get("image_labels") or content.get("page_numbers") or list(range(1, len(content["images"]) + 1))
+
+
+def encode_pil_image(image):
+    """Convert PIL Image to JPEG bytes"""
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def _open(source):
+    """A path stays a path; bytes become a file-like object"""
+    return io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+
+
+def _pdf_reader(source):
+    import pypdf
+    return pypdf.PdfReader(_open(source))
+
+
+def _read_pdf_text(reader, page_numbers, content, known=None):
+    known = known or {}
+    for p in page_numbers:
+        text = known[p] if p in known else reader.pages[p - 1].extract_text()
+        content["text"] += f"\n--- PAGE {p} ---\n{text}"
+
+
+def _rasterize(source, page_numbers, page_count, folder):
+    """Render only the requested pages into folder (one pdf2image call per contiguous run); returns the paths"""
+    from pdf2image import convert_from_bytes, convert_from_path
+    convert = convert_from_bytes if isinstance(source, (bytes, bytearray)) else convert_from_path
+    if len(page_numbers) == page_count:
+        return convert(source, output_folder=folder, paths_only=True)
+    paths = []
+    for first, last in page_runs(page_numbers):
+        paths.extend(convert(source, first_page=first, last_page=last, output_folder=folder, paths_only=True))
+    return paths
+
+
+def _drop_pages(page_numbers, skipped):
+    """Page numbers left after skipping known pages (never none: the first page stays)"""
+    gone = {s["page_number"] for s in skipped}
+    kept = [p for p in page_numbers if p not in gone]
+    if kept:
+        return kept
+    skipped.remove(next(s for s in skipped if s["page_number"] == page_numbers[0]))
+    return page_numbers[:1]
+
+
+def _skip_known_text(index, reader, page_numbers, known_text, hashes, skipped):
+    """Fingerprint each page's text layer; drop pages whose text is known boilerplate.
+    Pages that read like line items are never fingerprinted (hashes[p] is None)."""
+    for p in page_numbers:
+        if p not in known_text:
+            known_text[p] = reader.pages[p - 1].extract_text() or ""
+        if sum(1 for line in known_text[p].splitlines() if AMOUNT_PATTERN.search(line)) >= MIN_AMOUNT_LINES:
+            hashes[p] = None
+            continue
+        key = page_index.text_hash(known_text[p])
+        hashes[p] = {"text_hash": key, "text": known_text[p][:page_index.TEXT_EXCERPT_CHARS]}
+        match = index.lookup(text_key=key) if key else None
+        if match:
+            skipped.append({"page_number": p, **match})
+    return _drop_pages(page_numbers, skipped)
+
+
+def _known_image(index, image, p, hashes):
+    """Fingerprint a rendered page; the boilerplate match for a scan (no text fingerprint) or None"""
+    if hashes[p] is None:
+        return None
+    value = page_index.dhash(image)
+    hashes[p]["dhash"] = f"{value:064x}"
+    return None if hashes[p]["text_hash"] else index.lookup(image_hash=value)
+
+
+def _encode_pages(paths, page_numbers, timer, index, hashes, skipped):
+    """Open the rendered pages PAGE_WINDOW at a time: drop known scans, run forensics, encode to JPEG.
+    Returns (JPEG bytes, forensics reports, page numbers kept)."""
+    from PIL import Image
+    images, reports, kept = [], [], []
+    pages = list(zip(page_numbers, paths))
+    for start in range(0, len(pages), PAGE_WINDOW):
+        window = []
+        for p, path in pages[start:start + PAGE_WINDOW]:
+            image = Image.open(path)
+            if index:
+                with timer.stage("page_index"):
+                    match = _known_image(index, image, p, hashes)
+                # Never all of them: the last page stays when everything before it was skipped
+                if match and (kept or window or p != pages[-1][0]):
+                    skipped.append({"page_number": p, **match})
+                    image.close()
+                    continue
+            window.append((p, image))
+        if PIXEL_FORENSICS and window:
+            from app.forensics import analyze_pages, FORENSICS_MAX_PAGES
+            budget = FORENSICS_MAX_PAGES - len(reports)
+            if budget > 0:
+                with timer.stage("forensics"):
+                    reports.extend(analyze_pages([img for _, img in window[:budget]],
+                                                 [p for p, _ in window[:budget]]))
+        with timer.stage("encode"):
+            for p, image in window:
+                images.append(encode_pil_image(image))
+                kept.append(p)
+                image.close()
+    return images, reports, kept
+
+
+@backend(".pdf")
+def extract_pdf(source, content, timer, selection):
+    with timer.stage("pdf_text"):
+        reader = _pdf_reader(source)
+        page_count = len(reader.pages)
+        page_numbers, known_text = select_pages(page_count, lambda p: reader.pages[p - 1].extract_text(),
+                                                **selection)
+    content["page_count"] = page_count
+
+    index = page_index.default_index()
+    hashes, skipped = {}, []
+    if index:
+        with timer.stage("page_index"):
+            page_numbers = _skip_known_text(index, reader, page_numbers, known_text, hashes, skipped)
+
+    # Try converting PDF to Images (Best for Vision)
+    try:
+        print(f"   📸 Converting {len(page_numbers)} of {page_count} PDF page(s) to images...")
+        with tempfile.TemporaryDirectory(prefix="bill-pages-") as folder:
+            with timer.stage("rasterize"):
+                paths = _rasterize(source, page_numbers, page_count, folder)
+            images, reports, page_numbers = _encode_pages(paths, page_numbers, timer, index, hashes, skipped)
+        content["images"] = images
+        content["extraction_method"] = "pdf_vision"
+        if PIXEL_FORENSICS:
+            content["forensics"] = reports
+
+    except Exception as e:
+        print(f"   ⚠️ PDF Vision failed: {e}")
+        # Fallback: Text Only
+        content["extraction_method"] = "pdf_text_only"
+
+    content["page_numbers"] = page_numbers
+    if index:
+        content["page_hashes"] = {p: hashes[p] for p in sent_pages(content) if hashes[p]}
+        content["skipped_pages"] = sorted(skipped, key=lambda s: s["page_number"])
+        if skipped:
+            print(f"   ♻️ Skipped {len(skipped)} known boilerplate page(s): "
+                  f"{', '.join(str(s['page_number']) for s in content['skipped_pages'])}")
+
+    # Text of the selected pages (as backup for vision, or on its own)
+    with timer.stage("pdf_text"):
+        _read_pdf_text(reader, page_numbers, content, known_text)
+
+
+@backend("")
+def extract_image(source, content, timer, selection):
+    print("   📸 Processing Image...")
+    with timer.stage("encode"):
+        if isinstance(source, (bytes, bytearray)):
+            img_bytes = source
+        else:
+            with open(source, "rb") as f:
+                img_bytes = f.read()
+        content["images"] = [img_bytes]
+
+    try:
+        from PIL import Image
+        import pytesseract
+        image = Image.open(io.BytesIO(img_bytes))
+        if PIXEL_FORENSICS:
+            # On the upload itself: preprocessing rewrites every pixel
+            from app.forensics import analyze_pages
+            with timer.stage("forensics"):
+                content["forensics"] = analyze_pages([image])
+        if IMAGE_PREPROCESS:
+            from app.preprocess import preprocess
+            try:
+                with timer.stage("preprocess"):
+                    cleaned = preprocess(img_bytes)
+                content["images"] = [cleaned["image"]]
+                content["preprocessing"] = cleaned["steps"]
+                image = Image.open(io.BytesIO(cleaned["ocr_image"]))
+            except Exception as e:
+                print(f"   ⚠️ Preprocessing failed, using the original image: {e}")
+        with timer.stage("ocr"):
+            content["text"] = pytesseract.image_to_string(image)
+    except Exception:
+        pass
+    content["extraction_method"] = "image_vision"
+
+
+def extract_content(source, filename=None, pages=None, page_role=None):
+    """Extract content for AI (Vision prioritized).
+    source is a file path or the file's bytes (then filename picks the backend).
+    pages / page_role restrict which pages are processed (PDFs only).
+    Raises PageSelectionError when the selection matches no page."""
+    filename = filename or str(source)
+    content = {
+        "text": "",
+        "page_count": 1,
+        "images": [], # JPEG bytes of each page
+        "extraction_method": "unknown"
+    }
+    timer = StageTimer()
+    configure_binaries()
+
+    try:
+        ext = os.path.splitext(filename)[1].lower()
+        BACKENDS.get(ext, BACKENDS[""])(source, content, timer, {"pages": pages, "page_role": page_role})
+    except PageSelectionError:
+        raise
+    except Exception as e:
+        print(f"❌ Extraction Error: {e}")
+
+    if pages or (page_role and page_role != "all"):
+        content["page_selection"] = {"pages": pages, "page_role": page_role or "all",
+                                     "selected": page_labels(content), "total_pages": content["page_count"]}
+    content["stage_timings"] = timer.stages
+    return content
+
+
+def warm_up():
+    """Import every extraction library and probe the binaries now instead of on the first document"""
+    configure_binaries()
+    loaded = []
+    for module in ("pypdf", "pdf2image", "PIL.Image", "pytesseract", "app.forensics", "app.preprocess"):
+        try:
+            __import__(module)
+            loaded.append(module)
+        except ImportError as e:
+            print(f"⚠️ {module} not available: {e}")
+    return loaded
+
+
+def shutdown():
+    """Stop the image preprocessing workers, if any were started"""
+    preprocess = sys.modules.get("app.preprocess")
+    if preprocess:
+        preprocess.shutdown()
@@ -0,0 +1,237 @@
+"""
+Local pixel-level tamper detection for rendered pages
+
+Runs on the PIL page images produced during extraction (no LLM call):
+
+- error-level analysis (ELA): re-save as JPEG and look for text blocks
+  whose error level is far above the rest of the page
+- noise consistency: high-pass residual per background block; pasted or
+  whited-out patches are much noisier / cleaner than the page's paper
+- compression consistency: 8x8 JPEG grid strength per region; regions
+  with a different compression history stand out
+- font metrics: glyph height and stroke width of numeric words from
+  tesseract word boxes, compared across the page and within each line
+
+Every check is vectorized with NumPy and pages are analyzed in parallel
+threads. Each component yields a score in [0, 1]; a page is flagged when
+its highest component score reaches TAMPERING_SENSITIVITY.
+"""
+import io
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+TAMPERING_SENSITIVITY = float(os.getenv("TAMPERING_SENSITIVITY", "0.7"))
+FONT_OUTLIER_THRESHOLD = float(os.getenv("FONT_OUTLIER_THRESHOLD", "0.15"))
+FORENSICS_MAX_PAGES = int(os.getenv("FORENSICS_MAX_PAGES", "20"))
+FORENSICS_FONT_CHECK = os.getenv("FORENSICS_FONT_CHECK", "true").lower() == "true"
+
+ANALYSIS_MAX_SIDE = 1600      # ELA / noise / font checks run on a downscaled page
+BLOCK = 16                    # block size for ELA and noise statistics
+REGION = 64                   # region size for JPEG grid statistics (multiple of 8)
+ELA_QUALITY = 90
+ROBUST_Z = 4.0
+BLOCK_OUTLIER_FRACTION = 0.05  # this share of outlier blocks gives a component score of 1.0
+NUMERIC_WORD = re.compile(r"^[\d.,/-]*\d[\d.,/-]*$")
+
+
+def _blocks(arr, size):
+    """View a 2-D array as (rows, cols, size, size) tiles, dropping the ragged edge"""
+    h, w = arr.shape[0] - arr.shape[0] % size, arr.shape[1] - arr.shape[1] % size
+    return arr[:h, :w].reshape(h // size, size, w // size, size).swapaxes(1, 2)
+
+
+def _robust_z(values, mask):
+    """Median/MAD z-scores of values, using only the entries selected by mask as reference"""
+    ref = values[mask]
+    if ref.size < 8:
+        return np.zeros_like(values, dtype=np.float32)
+    median = np.median(ref)
+    mad = np.median(np.abs(ref - median)) * 1.4826 + 1e-6
+    return (values - median) / mad
+
+
+def _component(outliers, considered, **details):
+    count = int(considered.sum()) if hasattr(considered, "sum") else int(considered)
+    fraction = float(outliers.sum()) / count if count else 0.0
+    return {
+        "score": round(min(1.0, fraction / BLOCK_OUTLIER_FRACTION), 3),
+        "outlier_fraction": round(fraction, 4),
+        **details,
+    }
+
+
+def error_level_analysis(rgb, ink):
+    """Blocks with ink whose JPEG re-save error is far above the page's other ink blocks"""
+    buf = io.BytesIO()
+    Image.fromarray(rgb).save(buf, format="JPEG", quality=ELA_QUALITY)
+    buf.seek(0)
+    resaved = np.asarray(Image.open(buf).convert("RGB"), dtype=np.int16)
+    ela = np.abs(rgb.astype(np.int16) - resaved).max(axis=2).astype(np.float32)
+    level = _blocks(ela, BLOCK).mean(axis=(2, 3))
+    outliers = ink & (_robust_z(level, ink) > ROBUST_Z)
+    return _component(outliers, ink, blocks=int(ink.sum()))
+
+
+def noise_consistency(gray, ink):
+    """Background blocks whose high-pass noise is far from the page's paper noise"""
+    padded = np.pad(gray, 1, mode="edge")
+    h, w = gray.shape
+    blur = sum(padded[dy:dy + h, dx:dx + w] for dy in range(3) for dx in range(3)) / 9.0
+    noise = _blocks(gray - blur, BLOCK).std(axis=(2, 3))
+    background = ~ink & (_blocks(gray, BLOCK).mean(axis=(2, 3)) > 128)
+    paper = float(np.median(noise[background])) if background.any() else 0.0
+    if paper < 0.5:
+        # Born-digital render: no sensor noise to compare against
+        return {"score": 0.0, "outlier_fraction": 0.0, "status": "not_applicable"}
+    ratio = np.log((noise + 1e-3) / paper)
+    outliers = background & (np.abs(ratio) > np.log(3.0))
+    return _component(outliers, background, paper_noise=round(paper, 3),
+                      too_clean_blocks=int((background & (ratio < -np.log(3.0))).sum()))
+
+
+def compression_consistency(gray):
+    """Regions whose 8x8 JPEG grid strength disagrees with the rest of the page"""
+    # Clip strong edges (text strokes) so only artifact-scale steps are compared
+    diffs = np.minimum(np.abs(np.diff(gray, axis=1)), 4.0)
+    h = diffs.shape[0] - diffs.shape[0] % REGION
+    w = diffs.shape[1] - diffs.shape[1] % REGION
+    if h == 0 or w == 0:
+        return {"score": 0.0, "outlier_fraction": 0.0, "status": "too_small"}
+    diffs = diffs[:h, :w]
+    boundary = ((np.arange(w) + 1) % 8 == 0).astype(np.float32)
+    on_grid = _blocks(diffs * boundary, REGION).sum(axis=(2, 3)) / (REGION * REGION / 8)
+    off_grid = _blocks(diffs * (1 - boundary), REGION).sum(axis=(2, 3)) / (REGION * REGION * 7 / 8)
+    textured = off_grid > 0.2
+    if not textured.any():
+        return {"score": 0.0, "outlier_fraction": 0.0, "status": "no_texture"}
+    grid = on_grid / (off_grid + 1e-3)
+    page_grid = float(np.median(grid[textured]))
+    if page_grid > 1.3:
+        outliers = textured & (grid < 1.0)    # grid missing inside a JPEG page
+    else:
+        outliers = textured & (grid > 2.0)    # JPEG patch inside a clean page
+    return _component(outliers, textured, page_grid_strength=round(page_grid, 3))
+
+
+def font_metrics(image, gray):
+    """Numeric words whose glyph height or stroke width is out of line with their neighbours"""
+    try:
+        import pytesseract
+        data = pytesseract.image_to_data(image, output_type=pytesseract.Output.DICT)
+    except Exception as e:
+        return {"score": 0.0, "outlier_ratio": 0.0, "status": f"unavailable: {e.__class__.__name__}"}
+
+    words = []
+    for i, text in enumerate(data["text"]):
+        text = (text or "").strip()
+        try:
+            conf = float(data["conf"][i])
+        except (TypeError, ValueError):
+            conf = -1
+        if conf < 60 or len(text) < 2 or not NUMERIC_WORD.match(text):
+            continue
+        x, y, bw, bh = data["left"][i], data["top"][i], data["width"][i], data["height"][i]
+        crop = gray[y:y + bh, x:x + bw] < 128
+        if bh <= 0 or bw <= 0 or not crop.any():
+            continue
+        runs = np.count_nonzero(crop[:, 1:] & ~crop[:, :-1]) + np.count_nonzero(crop[:, 0])
+        words.append((text, (data["block_num"][i], data["par_num"][i], data["line_num"][i]),
+                      float(bh), float(crop.sum()) / max(runs, 1)))
+
+    if len(words) < 8:
+        return {"score": 0.0, "outlier_ratio": 0.0, "numeric_words": len(words), "status": "too_few_words"}
+
+    heights = np.array([w[2] for w in words], dtype=np.float32)
+    strokes = np.array([w[3] for w in words], dtype=np.float32)
+    everything = np.ones(len(words), dtype=bool)
+    outliers = (np.abs(_robust_z(heights, everything)) > ROBUST_Z) | \
+               (np.abs(_robust_z(strokes, everything)) > ROBUST_Z)
+
+    # Within a line every amount should share one glyph height
+    lines = {}
+    for idx, word in enumerate(words):
+        lines.setdefault(word[1], []).append(idx)
+    for members in lines.values():
+        if len(members) >= 3:
+            line_heights = heights[members]
+            deviation = np.abs(line_heights - np.median(line_heights)) / np.median(line_heights)
+            outliers[np.array(members)[deviation > 0.2]] = True
+
+    ratio = float(outliers.mean())
+    return {
+        "score": round(min(1.0, ratio / FONT_OUTLIER_THRESHOLD), 3),
+        "outlier_ratio": round(ratio, 4),
+        "numeric_words": len(words),
+        "outlier_words": [words[i][0] for i in np.flatnonzero(outliers)[:5]],
+    }
+
+
+def analyze_page(image, page_number):
+    """Run every check on one page image and combine them into a page score"""
+    started = time.perf_counter()
+    full_gray = np.asarray(image.convert("L"), dtype=np.float32)
+    compression = compression_consistency(full_gray)
+
+    scaled = image.convert("RGB")
+    scale = ANALYSIS_MAX_SIDE / max(scaled.size)
+    if scale < 1:
+        scaled = scaled.resize((int(scaled.width * scale), int(scaled.height * scale)), Image.BILINEAR)
+    rgb = np.asarray(scaled, dtype=np.uint8)
+    gray = rgb.mean(axis=2, dtype=np.float32)
+    ink = _blocks(gray, BLOCK).std(axis=(2, 3)) > 12
+
+    checks = {
+        "error_level": error_level_analysis(rgb, ink),
+        "noise": noise_consistency(gray, ink),
+        "compression": compression,
+    }
+    if FORENSICS_FONT_CHECK:
+        checks["font"] = font_metrics(scaled, gray)
+
+    score = max(c["score"] for c in checks.values())
+    return {
+        "page_number": page_number,
+        "score": round(score, 3),
+        "suspicious": bool(score >= TAMPERING_SENSITIVITY),
+        "checks": checks,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def analyze_pages(images, page_numbers=None):
+    """Analyze up to FORENSICS_MAX_PAGES pages in parallel; returns one report per page"""
+    images = images[:FORENSICS_MAX_PAGES]
+    page_numbers = page_numbers or list(range(1, len(images) + 1))
+    if not images:
+        return []
+    workers = min(len(images), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(analyze_page, images, page_numbers))
+
+
+def merge_forensics(result, reports):
+    """Fold per-page forensic reports into result['fraud_analysis']"""
+    if not reports:
+        return result
+    fraud = result.get("fraud_analysis", {})
+    suspicious = [r for r in reports if r["suspicious"]]
+    fraud["pixel_forensics"] = {
+        "max_score": max(r["score"] for r in reports),
+        "sensitivity": TAMPERING_SENSITIVITY,
+        "suspicious_pages": [r["page_number"] for r in suspicious],
+        "pages": reports,
+    }
+    if suspicious:
+        fraud["pixel_anomalies_detected"] = True
+        flags = fraud.setdefault("flags", [])
+        for r in suspicious:
+            worst = max(r["checks"], key=lambda name: r["checks"][name]["score"])
+            flags.append(f"Pixel forensics: page {r['page_number']} scored {r['score']} ({worst} check)")
+        if fraud.get("risk_level") in (None, "LOW"):
+            fraud["risk_level"] = "MEDIUM"
+    result["fraud_analysis"] = fraud
+    return result
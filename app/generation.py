@@ -0,0 +1,110 @@
+"""
+Generation profiles for the LLM providers
+
+A profile bundles the knobs that trade speed/cost against thoroughness:
+thinking (reasoning) budget, temperature, max output tokens and stop
+sequences. Each call_* function turns the selected profile into its
+provider's request parameters, so the same job-level choice ("fast",
+"balanced", "thorough") applies whichever key the round-robin picks.
+"""
+import os
+
+PROFILES = {
+    # No hidden reasoning: cheapest and lowest latency
+    "fast": {
+        "thinking_budget": 0,
+        "temperature": 0.0,
+        "max_output_tokens": 8192,
+        "stop_sequences": [],
+    },
+    # Small reasoning budget; temperature / max tokens follow LLM_TEMPERATURE / LLM_MAX_TOKENS
+    "balanced": {
+        "thinking_budget": 2048,
+        "temperature": float(os.getenv("LLM_TEMPERATURE", "0.1")),
+        "max_output_tokens": int(os.getenv("LLM_MAX_TOKENS", "8192")),
+        "stop_sequences": [],
+    },
+    # Let the model decide how much to think (-1 = dynamic budget on Gemini)
+    "thorough": {
+        "thinking_budget": -1,
+        "temperature": 0.1,
+        "max_output_tokens": 16384,
+        "stop_sequences": [],
+    },
+}
+
+DEFAULT_PROFILE = os.getenv("GENERATION_PROFILE", "balanced")
+
+# Hard output caps per model (requests above these are rejected by the provider)
+MODEL_MAX_OUTPUT_TOKENS = {
+    "gemini-2.5-flash": 65536,
+    "gpt-4o": 16384,
+    # 8192 only with the max-tokens-3-5-sonnet-2024-07-15 beta header, which batch requests cannot send
+    "claude-3-5-sonnet-20240620": 4096,
+}
+
+# Anthropic models that accept extended thinking
+ANTHROPIC_THINKING_MODELS = ("claude-3-7", "claude-sonnet-4", "claude-opus-4")
+
+# Fixed budget used where a provider has no "dynamic" setting
+DYNAMIC_THINKING_FALLBACK = 8192
+
+
+def get_profile(name=None):
+    """Resolve a profile by name (None -> GENERATION_PROFILE); raises ValueError if unknown"""
+    name = name or DEFAULT_PROFILE
+    if name not in PROFILES:
+        raise ValueError(f"Unknown generation profile '{name}' (choose from {', '.join(PROFILES)})")
+    return {"name": name, **PROFILES[name]}
+
+
+def _max_tokens(profile, model):
+    return min(profile["max_output_tokens"], MODEL_MAX_OUTPUT_TOKENS.get(model, profile["max_output_tokens"]))
+
+
+def gemini_generation_config(profile, model="gemini-2.5-flash"):
+    """generationConfig block for generateContent"""
+    config = {
+        "temperature": profile["temperature"],
+        "maxOutputTokens": _max_tokens(profile, model),
+        "thinkingConfig": {"thinkingBudget": profile["thinking_budget"]},
+    }
+    if profile["stop_sequences"]:
+        config["stopSequences"] = profile["stop_sequences"]
+    return config
+
+
+def openai_params(profile, model="gpt-4o"):
+    """Extra keyword arguments for chat.completions.create"""
+    params = {
+        "temperature": profile["temperature"],
+        "max_tokens": _max_tokens(profile, model),
+    }
+    if profile["stop_sequences"]:
+        params["stop"] = profile["stop_sequences"][:4]
+    if model.startswith("o"):
+        # Reasoning models take an effort level instead of a temperature
+        params.pop("temperature")
+        params["max_completion_tokens"] = params.pop("max_tokens")
+        budget = profile["thinking_budget"]
+        params["reasoning_effort"] = "low" if budget == 0 else "high" if budget < 0 else "medium"
+    return params
+
+
+def anthropic_params(profile, model="claude-3-5-sonnet-20240620"):
+    """Extra keyword arguments for messages.create"""
+    max_tokens = _max_tokens(profile, model)
+    params = {"max_tokens": max_tokens, "temperature": profile["temperature"]}
+    if profile["stop_sequences"]:
+        params["stop_sequences"] = profile["stop_sequences"]
+    budget = profile["thinking_budget"]
+    if budget and model.startswith(ANTHROPIC_THINKING_MODELS):
+        budget = DYNAMIC_THINKING_FALLBACK if budget < 0 else max(budget, 1024)
+        params["thinking"] = {"type": "enabled", "budget_tokens": min(budget, max_tokens - 1)}
+        params["temperature"] = 1.0  # required by the API when thinking is enabled
+    return params
+
+
+def openai_reasoning_tokens(usage):
+    details = getattr(usage, "completion_tokens_details", None)
+    return getattr(details, "reasoning_tokens", 0) or 0
@@ -6,41 +6,37 @@ This API takes a file (PDF or Image) and returns the extracted data in JSON form
 It also checks for basic fraud indicators.
 """
 import os
+import re
 import uuid
 import json
-import base64
-import requests
 import time
+import zlib
 import asyncio
-from typing import Dict
-from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException
+import importlib.util
+import threading
+from typing import Dict, Optional
+from collections import Counter
+from functools import partial
+from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException, Response, Header
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-import pytesseract
-from PIL import Image
-import io
-import pypdf
-from dotenv import load_dotenv
-
-# Load env vars
-load_dotenv()
-
-# Configuration
-TESSERACT_CMD = os.getenv("TESSERACT_CMD", r"C:\Program Files\Tesseract-OCR\tesseract.exe")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-
-if os.path.exists(TESSERACT_CMD):
-    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
-
-# Set Poppler Path
-POPPLER_PATH = r"C:\Program Files\poppler-25.11.0\Library\bin"
-if os.path.exists(POPPLER_PATH):
-    os.environ["PATH"] += os.pathsep + POPPLER_PATH
-else:
-    POPPLER_PATH_ALT = r"C:\Program Files\poppler-25.11.0\bin"
-    if os.path.exists(POPPLER_PATH_ALT):
-        os.environ["PATH"] += os.pathsep + POPPLER_PATH_ALT
+from app.sinks import ResultSink
+from app.duplicates import DuplicateIndex
+from app.metrics import StageTimer, record_job, JOBS_IN_FLIGHT, JOBS_QUEUED
+from app.generation import DEFAULT_PROFILE, PROFILES
+from app import providers, extraction, page_index, tariff
+from app.providers import analyze_document, api_pool, clean_json_string, get_common_prompt
+from app.extraction import extract_content, check_page_request, PageSelectionError
+from app.validation import validate_math
+from app.reconcile import reconcile
+from app.replay import attach_raw_response
+
+# Create provider clients, import the extraction libraries etc. at startup
+# (before /ready passes) instead of on the first request
+WARM_UP = os.getenv("WARM_UP", "true").lower() == "true"
+
+# Generation profile used when a job does not ask for one (fast / balanced / thorough)
+GENERATION_PROFILE = DEFAULT_PROFILE
 
 app = FastAPI(
     title="BAJAJ HEALTH DATATHON API",
@@ -57,452 +53,459 @@ app.add_middleware(
 )
 
 job_status: Dict[str, dict] = {}
+JOBS_QUEUED.set_function(lambda: sum(1 for j in list(job_status.values()) if j.get("status") == "queued"))
+
+# batch_id -> {"created_at", "jobs": {job_id: filename}, "seq", "finished": {job_id: seq}};
+# several batch-extract requests can add to one batch
+batches: Dict[str, dict] = {}
+job_batches: Dict[str, str] = {}
+BATCH_LOCK = threading.Lock()
+BATCH_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+FINISHED_STATUSES = ("completed", "failed")
+# Longest a batch status request waits for news (?wait=)
+BATCH_MAX_WAIT_SECONDS = 30
+# Results per /api/v1/batch/{batch_id}/results request (?limit=), and bytes compressed at a time
+RESULTS_PAGE_SIZE = 1000
+RESULTS_MAX_PAGE_SIZE = 10000
+RESULTS_CHUNK_BYTES = 64 * 1024
+
+# Optional consolidated JSONL/Parquet output for all completed jobs
+RESULT_SINK_DIR = os.getenv("RESULT_SINK_DIR")
+RESULT_SINK = ResultSink(RESULT_SINK_DIR) if RESULT_SINK_DIR else None
+
+# Optional persistent index for cross-document duplicate billing
+DUPLICATE_INDEX_PATH = os.getenv("DUPLICATE_INDEX_PATH")
+DUPLICATE_INDEX = DuplicateIndex(DUPLICATE_INDEX_PATH) if DUPLICATE_INDEX_PATH else None
+
+# Provider batch jobs submitted by mode=bulk requests (created on first use)
+BULK_STATE = None
+
+# Benford digit analysis; baselines are in-memory unless BENFORD_BASELINE_PATH is set (created on first use)
+BENFORD_ENGINE = None
+
+# Extracted content / provider answers kept per job so retries resume from the failed stage
+# (in memory; also on disk when ARTIFACT_DIR is set, created on first use)
+ARTIFACTS = None
+
+# Priority / fair-share scheduler for extract and batch-extract jobs (started on first use)
+SCHEDULER = None
+# Slots default to one per API key (at least 2, so one can stay reserved for single uploads)
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "0"))
+# A failed batch job is queued once more after this many seconds
+BATCH_RETRY_DELAY = float(os.getenv("BATCH_RETRY_DELAY", "5"))
+
+READINESS = {"ready": not WARM_UP, "warm_up": None}
+
+def scheduler():
+    global SCHEDULER
+    if SCHEDULER is None:
+        from app.scheduler import Scheduler
+        SCHEDULER = Scheduler(SCHEDULER_WORKERS or max(2, len(api_pool()))).start()
+    return SCHEDULER
+
+def artifacts():
+    global ARTIFACTS
+    if ARTIFACTS is None:
+        from app.artifacts import ArtifactStore
+        ARTIFACTS = ArtifactStore(os.getenv("ARTIFACT_DIR"))
+    return ARTIFACTS
+
+def set_job_status(job_id, status):
+    """Replace a job's status, keeping its scheduling info"""
+    scheduling = job_status.get(job_id, {}).get("scheduling")
+    job_status[job_id] = {**status, "scheduling": scheduling} if scheduling else status
+    if status.get("status") in FINISHED_STATUSES:
+        record_finish(job_id)
+
+def record_finish(job_id):
+    """Give a batch job that finished (or whose result changed) the next number in its batch,
+    so /api/v1/batch/{batch_id}/results?since= can return only what is new"""
+    batch = batches.get(job_batches.get(job_id))
+    if batch is None:
+        return
+    with BATCH_LOCK:
+        batch["seq"] += 1
+        batch["finished"][job_id] = batch["seq"]
+
+def bulk_state():
+    global BULK_STATE
+    if BULK_STATE is None:
+        from app.bulk import BulkState
+        BULK_STATE = BulkState(os.getenv("BULK_STATE_PATH", os.path.join("outputs", "bulk_state.json")))
+    return BULK_STATE
+
+def benford_engine():
+    global BENFORD_ENGINE
+    if BENFORD_ENGINE is None:
+        from app.benford import BenfordEngine
+        BENFORD_ENGINE = BenfordEngine(os.getenv("BENFORD_BASELINE_PATH", ":memory:"))
+    return BENFORD_ENGINE
+
+def warm_up():
+    """Everything the first request would otherwise pay for"""
+    started = time.perf_counter()
+    report = {
+        "providers": providers.warm_up(),
+        "extraction": extraction.warm_up(),
+    }
+    benford_engine()
+    tariff.default_index()
+    bulk_state()
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+async def run_warm_up():
+    try:
+        READINESS["warm_up"] = await asyncio.to_thread(warm_up)
+    except Exception as e:
+        print(f"Warm-up failed, continuing lazily: {e}")
+        READINESS["warm_up"] = {"error": str(e)}
+    READINESS["ready"] = True
+
+@app.on_event("startup")
+async def start_warm_up():
+    # In the background so liveness (/) answers while /ready still says 503
+    if WARM_UP:
+        asyncio.create_task(run_warm_up())
+
+@app.on_event("shutdown")
+async def close_result_sink():
+    if SCHEDULER:
+        await SCHEDULER.stop()
+    if RESULT_SINK:
+        RESULT_SINK.close()
+    if DUPLICATE_INDEX:
+        DUPLICATE_INDEX.close()
+    if BENFORD_ENGINE:
+        BENFORD_ENGINE.close()
+    extraction.shutdown()
 
 @app.get("/")
 async def root():
     return {"message": "Invoice Extractor API Running", "docs": "/docs"}
 
-def clean_json_string(json_str):
-    """Clean AI output to get valid JSON"""
-    json_str = json_str.replace("```json", "").replace("```", "")
-    start = json_str.find("{")
-    end = json_str.rfind("}")
-    if start != -1 and end != -1:
-        json_str = json_str[start:end+1]
-    return json_str
-
-def encode_pil_image(image):
-    """Convert PIL Image to base64 string"""
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-def extract_content_from_bytes(file_bytes, filename):
-    """Extract content for AI (Vision prioritized)"""
-    content = {
-        "text": "",
-        "page_count": 1,
-        "images": [], # List of base64 images
-        "extraction_method": "unknown"
-    }
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 503 until the startup warm-up has finished"""
+    if not READINESS["ready"]:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready", "warm_up": READINESS["warm_up"]}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus scrape endpoint"""
+    from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def complete_job(job_id, filename, json_str, token_info, content, timer=None, resumed_from=None, profile=None):
+    """Parse, validate and store an AI response as the job's result.
+    Pages that do not add up are re-extracted (app/reconcile.py), so run it off the event loop."""
+    timer = timer or StageTimer(content.get("stage_timings"))
+    with timer.stage("json_parse"):
+        result = json.loads(clean_json_string(json_str))
+    # Boilerplate pages left out of the call: learn from this answer, put their known content back
+    with timer.stage("page_index"):
+        result = page_index.apply(result, content.get("page_hashes"), content.get("skipped_pages"), filename)
     
-    try:
-        if filename.lower().endswith('.pdf'):
-            # Try converting PDF to Images (Best for Vision)
-            try:
-                from pdf2image import convert_from_bytes
-                pil_images = convert_from_bytes(file_bytes)
-                content["page_count"] = len(pil_images)
-                content["images"] = [encode_pil_image(img) for img in pil_images]
-                content["extraction_method"] = "pdf_vision"
-                
-                # Also extract text as backup
-                pdf_file = io.BytesIO(file_bytes)
-                reader = pypdf.PdfReader(pdf_file)
-                for i, page in enumerate(reader.pages):
-                    content["text"] += f"\n--- PAGE {i+1} ---\n{page.extract_text()}"
-                    
-            except Exception as e:
-                print(f"PDF Vision failed: {e}")
-                # Fallback: Text Only
-                pdf_file = io.BytesIO(file_bytes)
-                reader = pypdf.PdfReader(pdf_file)
-                content["page_count"] = len(reader.pages)
-                for i, page in enumerate(reader.pages):
-                    content["text"] += f"\n--- PAGE {i+1} ---\n{page.extract_text()}"
-                content["extraction_method"] = "pdf_text_only"
-        else:
-            # Image Processing
-            content["images"] = [base64.b64encode(file_bytes).decode('utf-8')]
-            try:
-                image = Image.open(io.BytesIO(file_bytes))
-                content["text"] = pytesseract.image_to_string(image)
-            except: pass
-            content["extraction_method"] = "image_vision"
-            
-    except Exception as e:
-        print(f"Extraction Error: {e}")
-        
-    return content
-
-# --- AI PROVIDERS & LOAD BALANCING ---
-API_POOL = []
-CURRENT_KEY_INDEX = 0
-
-def load_api_keys():
-    """Load all available API keys into a pool"""
-    global API_POOL
-    API_POOL = []
+    # Inject Token Info
+    if token_info:
+        result = {"token_usage": token_info, **result}
+    # Raw answer, so new validation / fraud rules can be replayed without the AI
+    result = attach_raw_response(result, json_str)
     
-    # Helper to add keys
-    def add_keys(prefix, provider_name):
-        # Check base key
-        key = os.getenv(f"{prefix}_API_KEY")
-        if key: API_POOL.append({"provider": provider_name, "key": key})
-        
-        # Check numbered keys (1-10)
-        for i in range(1, 11):
-            key = os.getenv(f"{prefix}_API_KEY_{i}")
-            if key: API_POOL.append({"provider": provider_name, "key": key})
-
-    add_keys("GEMINI", "gemini")
-    add_keys("OPENAI", "openai")
-    add_keys("ANTHROPIC", "anthropic")
+    # --- Perform System Validation ---
+    with timer.active(), timer.stage("reconcile"):
+        result = reconcile(result, content, filename, profile or GENERATION_PROFILE)
+    with timer.stage("validate"):
+        result, _ = validate_math(result)
+    with timer.stage("fraud_rules"):
+        from app.forensics import merge_forensics
+        result = merge_forensics(result, content.get("forensics"))
+        result = benford_engine().annotate(result)
+        result = tariff.default_index().annotate(result)
+        if DUPLICATE_INDEX:
+            result = DUPLICATE_INDEX.annotate(result, doc_id=job_id, source=filename)
+    # ---------------------------------
     
-    print(f"Loaded {len(API_POOL)} API Key(s) for Load Balancing")
-
-# Initialize Pool
-load_api_keys()
-
-def get_next_provider():
-    """Round-robin selection of API provider"""
-    global CURRENT_KEY_INDEX
-    if not API_POOL: return None
+    if RESULT_SINK:
+        with timer.stage("sink"):
+            RESULT_SINK.write(result, source_file=filename, doc_id=job_id)
     
-    provider = API_POOL[CURRENT_KEY_INDEX]
-    CURRENT_KEY_INDEX = (CURRENT_KEY_INDEX + 1) % len(API_POOL)
-    return provider
-
-def get_common_prompt(filename, page_count):
-    return f"""
-    You are an expert Forensic Auditor. Analyze this document (Filename: {filename}, Pages: {page_count}).
-
-    INSTRUCTIONS:
-    1. **EXTRACTION**: Extract all visible data. If a Total is clearly the final amount to be paid, extract it.
-    2. **PAGE MAPPING**: Assign items to their correct pages based on visual markers.
-    3. **ANALYSIS**: Flag visual anomalies (edits, fonts) and duplicate items.
-
-    TASK:
-    1. Extract Header Info.
-    2. Extract Line Items (Description, Qty, Unit Price, Amount).
-    3. Extract Financial Totals (Subtotal, Tax, Total).
-
-    OUTPUT JSON STRUCTURE:
-    {{
-        "file_info": {{
-            "file_name": "{filename}",
-            "page_count": {page_count},
-            "document_type": "Invoice/Receipt/Bill/Statement",
-            "document_title": "string",
-            "printed_on": "string or null"
-        }},
-        "header": {{
-            "id": "string",
-            "date": "YYYY-MM-DD",
-            "vendor_name": "string",
-            "recipient_name": "string"
-        }},
-        "pages": [
-            {{
-                "page_number": 1,
-                "line_items": [
-                    {{"description": "string", "quantity": number, "unit_price": number, "amount": number}}
-                ],
-                "page_anomalies": ["list", "of", "visual", "issues"]
-            }}
-        ],
-        "financials": {{
-            "subtotal": number,
-            "tax": number,
-            "extracted_total": number
-        }},
-        "fraud_analysis": {{
-            "risk_level": "LOW/MEDIUM/HIGH",
-            "pixel_anomalies_detected": boolean,
-            "duplicates_detected": boolean,
-            "flags": ["list", "of", "issues"],
-            "reasoning": "detailed explanation"
-        }}
-    }}
-    """
-
-def call_gemini(content, filename, api_key):
-    print(f"🤖 Analyzing {filename} with Gemini 2.5 Flash (Key: ...{api_key[-4:]})...")
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}"
-    parts = [{"text": get_common_prompt(filename, content['page_count'])}]
+    extraction_method = content.get("extraction_method")
+    result["processing_metadata"] = {"extraction_method": extraction_method, **timer.metadata()}
+    if content.get("page_selection"):
+        result["processing_metadata"]["page_selection"] = content["page_selection"]
+    if content.get("skipped_pages"):
+        result["processing_metadata"]["skipped_pages"] = [s["page_number"] for s in content["skipped_pages"]]
+    if resumed_from:
+        result["processing_metadata"]["resumed_from"] = resumed_from
+    timer.export((token_info or {}).get("model"), extraction_method)
+    record_job("completed", token_info, extraction_method)
     
-    for i, img_b64 in enumerate(content["images"][:5]):
-        parts.append({"text": f"--- VISUAL DATA FOR PAGE {i+1} ---"})
-        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": img_b64}})
-
-    if content["text"]:
-        parts.append({"text": f"EXTRACTED TEXT CONTEXT:\n{content['text']}"})
-
-    # Retry Logic
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(
-                url, headers={'Content-Type': 'application/json'},
-                json={"contents": [{"parts": parts}]}, timeout=120
-            )
-            if response.status_code == 200:
-                res_json = response.json()
-                text = res_json['candidates'][0]['content']['parts'][0]['text']
-                usage = res_json.get('usageMetadata', {})
-                token_info = {
-                    "prompt_tokens": usage.get('promptTokenCount', 0),
-                    "output_tokens": usage.get('candidatesTokenCount', 0),
-                    "total_tokens": usage.get('totalTokenCount', 0),
-                    "model": "gemini-2.5-flash"
-                }
-                return text, token_info
-            elif response.status_code == 429:
-                print(f"Rate limit hit. Waiting 5s... (Attempt {attempt+1}/{max_retries})")
-                time.sleep(5)
-            else:
-                print(f"Gemini Error: {response.text}")
-                return None, None
-        except Exception as e:
-            print(f"Request Failed: {e}. Retrying...")
-            time.sleep(2)
-            
-    return None, None
-
-def call_openai(content, filename, api_key):
-    print(f"🤖 Analyzing {filename} with GPT-4o (Key: ...{api_key[-4:]})...")
+    set_job_status(job_id, {
+        "status": "completed",
+        "progress": 100,
+        "message": "Success",
+        "result": result
+    })
+
+async def process_job(job_id: str, file_content: bytes, filename: str, profile: str = None,
+                      selection: dict = None):
+    JOBS_IN_FLIGHT.inc()
+    timer = StageTimer()
+    content = {}
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
+        # A retry picks up whatever an earlier attempt already finished
+        artifact = artifacts().get(job_id)
+        content, response = artifact.get("content"), artifact.get("response")
+        resumed_from = None
         
-        messages = [
-            {"role": "system", "content": "You are a JSON-only extraction API."},
-            {"role": "user", "content": []}
-        ]
-        
-        user_content = messages[1]["content"]
-        user_content.append({"type": "text", "text": get_common_prompt(filename, content['page_count'])})
-        
-        for i, img_b64 in enumerate(content["images"][:5]):
-            user_content.append({"type": "text", "text": f"--- PAGE {i+1} ---"})
-            user_content.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
-            })
+        if content is None:
+            job_status[job_id]["progress"] = 20
+            job_status[job_id]["message"] = "Extracting content"
             
-        if content["text"]:
-            user_content.append({"type": "text", "text": f"TEXT CONTEXT:\n{content['text']}"})
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            response_format={"type": "json_object"},
-            max_tokens=4000
-        )
-        
-        text = response.choices[0].message.content
-        usage = response.usage
-        token_info = {
-            "prompt_tokens": usage.prompt_tokens,
-            "output_tokens": usage.completion_tokens,
-            "total_tokens": usage.total_tokens,
-            "model": "gpt-4o"
-        }
-        return text, token_info
-    except Exception as e:
-        print(f"OpenAI Error: {e}")
-        return None, None
-
-def call_anthropic(content, filename, api_key):
-    print(f"🤖 Analyzing {filename} with Claude 3.5 Sonnet (Key: ...{api_key[-4:]})...")
-    try:
-        import anthropic
-        client = anthropic.Anthropic(api_key=api_key)
+            # Blocking work runs in threads so the event loop keeps serving uploads and status checks
+            content = await asyncio.to_thread(extract_content, file_content, filename, **(selection or {}))
+            timer = StageTimer(content.get("stage_timings"))
+            artifacts().put(job_id, content=content)
+        else:
+            resumed_from = "json_parse" if response else "provider_call"
         
-        message_content = []
-        for i, img_b64 in enumerate(content["images"][:5]):
-            message_content.append({
-                "type": "image",
-                "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64}
-            })
+        if response:
+            json_str, token_info = response["json_str"], response["token_info"]
+        else:
+            job_status[job_id]["progress"] = 50
+            job_status[job_id]["message"] = "AI Analysis (Vision + Fraud)"
             
-        prompt = get_common_prompt(filename, content['page_count'])
-        if content["text"]:
-            prompt += f"\n\nTEXT CONTEXT:\n{content['text']}"
+            with timer.active(), timer.stage("provider_call"):
+                json_str, token_info = await asyncio.to_thread(analyze_document, content, filename,
+                                                               profile or GENERATION_PROFILE)
             
-        message_content.append({"type": "text", "text": prompt})
-
-        response = client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=4000,
-            messages=[{"role": "user", "content": message_content}]
-        )
-        
-        text = response.content[0].text
-        usage = response.usage
-        token_info = {
-            "prompt_tokens": usage.input_tokens,
-            "output_tokens": usage.output_tokens,
-            "total_tokens": usage.input_tokens + usage.output_tokens,
-            "model": "claude-3-5-sonnet"
-        }
-        return text, token_info
-    except Exception as e:
-        print(f"Anthropic Error: {e}")
-        return None, None
-
-def analyze_document(content, filename):
-    """Route to available AI provider using Round-Robin"""
-    provider_info = get_next_provider()
-    
-    if not provider_info:
-        return None, None
-        
-    provider = provider_info["provider"]
-    key = provider_info["key"]
-    
-    if provider == "gemini":
-        return call_gemini(content, filename, key)
-    elif provider == "openai":
-        return call_openai(content, filename, key)
-    elif provider == "anthropic":
-        return call_anthropic(content, filename, key)
-    
-    return None, None
-
-def validate_math(data):
-    """Perform Python-side math validation"""
-    try:
-        calculated_total = 0.0
-        line_items = []
-        
-        if "pages" in data:
-            for page in data["pages"]:
-                if "line_items" in page:
-                    line_items.extend(page["line_items"])
-        elif "line_items" in data:
-            line_items = data["line_items"]
-            
-        for item in line_items:
-            amount = item.get("amount")
-            if amount is not None:
-                try: calculated_total += float(amount)
-                except: pass
-                
-        financials = data.get("financials", {})
-        extracted_total = financials.get("extracted_total")
-        
-        is_match = None
-        
-        if extracted_total is not None:
+            if not json_str:
+                raise Exception("AI analysis failed (Check API Keys)")
+            # Only answers that parse are worth resuming from
             try:
-                extracted_total = float(extracted_total)
-                if abs(extracted_total - calculated_total) < 0.10:
-                    is_match = True
-                else:
-                    is_match = False
-            except: pass
-
-        financials["calculated_total"] = round(calculated_total, 2)
-        financials["is_match"] = is_match
-        data["financials"] = financials
-        
-        fraud = data.get("fraud_analysis", {})
-        if is_match is False and extracted_total is not None:
-            fraud["math_mismatch_detected"] = True
-            msg = f"Math mismatch: Extracted {extracted_total} vs Calculated {round(calculated_total, 2)}"
-            if msg not in fraud.get("flags", []):
-                fraud.setdefault("flags", []).append(msg)
-            if abs(extracted_total - calculated_total) > 1.0:
-                 if fraud.get("risk_level") == "LOW":
-                     fraud["risk_level"] = "MEDIUM"
-        else:
-            fraud["math_mismatch_detected"] = False
+                json.loads(clean_json_string(json_str))
+                artifacts().put(job_id, response={"json_str": json_str, "token_info": token_info})
+            except ValueError:
+                pass
             
-        data["fraud_analysis"] = fraud
-        return data
-        
-    except Exception as e:
-        print(f"   ⚠️ Validation Error: {e}")
-        return data
-
-async def process_job(job_id: str, file_content: bytes, filename: str):
-    try:
-        job_status[job_id]["progress"] = 20
-        job_status[job_id]["message"] = "Extracting content"
-        
-        content = extract_content_from_bytes(file_content, filename)
-        
-        job_status[job_id]["progress"] = 50
-        job_status[job_id]["message"] = "AI Analysis (Vision + Fraud)"
-        
-        json_str, token_info = analyze_document(content, filename)
-        
-        if not json_str:
-            raise Exception("AI analysis failed (Check API Keys)")
-            
-        json_str = clean_json_string(json_str)
-        result = json.loads(json_str)
-        
-        # Inject Token Info
-        if token_info:
-            result = {"token_usage": token_info, **result}
-        
-        # --- Perform System Validation ---
-        result = validate_math(result)
-        # ---------------------------------
-        
-        job_status[job_id] = {
-            "status": "completed",
-            "progress": 100,
-            "message": "Success",
-            "result": result
-        }
+        await asyncio.to_thread(complete_job, job_id, filename, json_str, token_info, content, timer,
+                                resumed_from, profile)
         
     except Exception as e:
         print(f"Job failed: {e}")
-        job_status[job_id] = {
+        timer.export(None, content.get("extraction_method"))
+        record_job("failed", None, content.get("extraction_method"))
+        set_job_status(job_id, {
             "status": "failed",
             "progress": 0,
-            "error": str(e)
-        }
-
-async def orchestrate_batch_processing(jobs_data: list):
+            "error": str(e),
+            "processing_metadata": timer.metadata()
+        })
+    finally:
+        JOBS_IN_FLIGHT.dec()
+
+async def run_scheduled_job(job_id: str, file_content: bytes, filename: str, profile: str = None,
+                            selection: dict = None, retries: int = 0, queue_wait: float = 0.0):
+    """Scheduler entry point: record the queue wait, process, requeue a failed job if it has retries left"""
+    scheduling = job_status[job_id]["scheduling"]
+    scheduling["queue_wait_ms"] = round(queue_wait * 1000, 1)
+    scheduling["attempts"] = scheduling.get("attempts", 0) + 1
+    job_status[job_id]["status"] = "processing"
+    
+    await process_job(job_id, file_content, filename, profile, selection)
+    
+    if job_status[job_id].get("status") == "failed" and retries > 0:
+        job_status[job_id].update({"status": "retrying", "message": "Retrying failed job...", "progress": 0})
+        run = partial(run_scheduled_job, job_id, file_content, filename, profile, selection, retries - 1)
+        asyncio.get_running_loop().call_later(
+            BATCH_RETRY_DELAY, scheduler().submit, job_id, run, scheduling["priority_class"], scheduling["tenant"])
+
+def schedule_job(job_id, file_content, filename, priority_class, tenant, profile=None, selection=None, retries=0):
+    """Queue a job with the scheduler; its class and tenant are shown in the job status"""
+    job_status[job_id]["scheduling"] = {"priority_class": priority_class, "tenant": tenant or "default",
+                                        "queued_at": time.time()}
+    run = partial(run_scheduled_job, job_id, file_content, filename, profile, selection, retries)
+    scheduler().submit(job_id, run, priority_class, tenant)
+
+def check_priority(priority):
+    """Reject unknown priority classes before queueing any work"""
+    from app.scheduler import PRIORITY_CLASSES
+    if priority and priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority '{priority}'. Use one of: {', '.join(PRIORITY_CLASSES)}")
+
+def check_profile(profile):
+    """Reject unknown generation profiles before queueing any work"""
+    if profile and profile not in PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown profile '{profile}'. Use one of: {', '.join(PROFILES)}")
+
+def check_pages(pages, page_role):
+    """Reject malformed page ranges / roles up front; returns the selection to pass to extraction"""
+    try:
+        check_page_request(pages, page_role)
+    except PageSelectionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"pages": pages, "page_role": page_role}
+
+async def run_pack(pack, files, profile, selection, priority_class, tenant, queue_wait=0.0):
+    """Scheduler entry point for a pack: one provider call, then each document is completed
+    on its own; documents the answer does not cover are scheduled as regular jobs"""
+    from app.packing import analyze_pack
+    for doc in pack:
+        job_status[doc["ref"]]["scheduling"]["queue_wait_ms"] = round(queue_wait * 1000, 1)
+        job_status[doc["ref"]].update({"status": "processing", "progress": 50,
+                                       "message": f"AI Analysis (packed with {len(pack) - 1} other documents)"})
+    JOBS_IN_FLIGHT.inc()
+    try:
+        results, pack_timer = await asyncio.to_thread(analyze_pack, pack, profile or GENERATION_PROFILE)
+    except Exception as e:
+        print(f"Packed call failed: {e}")
+        results, pack_timer = {}, StageTimer()
+    finally:
+        JOBS_IN_FLIGHT.dec()
+    
+    for doc in pack:
+        job_id, content = doc["ref"], doc["content"]
+        if job_id in results:
+            json_str, token_info = results[job_id]
+            timer = StageTimer({**content.get("stage_timings", {}), **pack_timer.stages})
+            try:
+                await asyncio.to_thread(complete_job, job_id, doc["filename"], json_str, token_info, content,
+                                        timer, None, profile)
+                continue
+            except Exception as e:
+                print(f"Packed result for {doc['filename']} unusable: {e}")
+        # Not covered by the packed answer: run it alone (its extracted content is in the artifact store)
+        file_content, filename = files[job_id]
+        job_status[job_id].update({"status": "queued", "message": "Packed call missed it, queued on its own"})
+        schedule_job(job_id, file_content, filename, priority_class, tenant, profile, selection, retries=1)
+
+async def orchestrate_packed_processing(jobs_data: list, profile: str = None, selection: dict = None,
+                                        priority_class: str = "batch", tenant: str = None):
     """
-    Orchestrates batch processing with rate limiting and retries.
+    Packing mode: extract every file, send small documents (single-page receipts,
+    photos) several to a provider call, and everything else as regular jobs.
     jobs_data: list of (job_id, content, filename)
     """
-    failed_jobs = []
+    from app.packing import plan_packs
+    files = {job_id: (file_content, filename) for job_id, file_content, filename in jobs_data}
+    for job_id, _, _ in jobs_data:
+        job_status[job_id].update({"status": "processing", "progress": 20, "message": "Extracting content"})
     
-    # 1. First Pass
-    for i, (job_id, content, filename) in enumerate(jobs_data):
-        # Update status to processing (if not already)
-        job_status[job_id]["status"] = "processing"
-        
-        # Process the job
-        await process_job(job_id, content, filename)
-        
-        # Check failure
-        if job_status[job_id].get("status") == "failed":
-            failed_jobs.append((job_id, content, filename))
-            
-        # Rate Limit Delay (2s)
-        if i < len(jobs_data) - 1:
-            await asyncio.sleep(2)
-            
-    # 2. Retry Failed Jobs
-    if failed_jobs:
-        # Cool down
-        await asyncio.sleep(5)
-        
-        for i, (job_id, content, filename) in enumerate(failed_jobs):
-            # Reset status
-            job_status[job_id]["status"] = "retrying"
-            job_status[job_id]["message"] = "Retrying failed job..."
-            job_status[job_id]["progress"] = 0
+    async def extract(job_id, file_content, filename):
+        try:
+            content = await asyncio.to_thread(extract_content, file_content, filename, **(selection or {}))
+        except Exception as e:
+            set_job_status(job_id, {"status": "failed", "progress": 0, "error": str(e)})
+            return None
+        artifacts().put(job_id, content=content)
+        return {"ref": job_id, "filename": filename, "content": content}
+    
+    documents = [doc for doc in await asyncio.gather(*(extract(*job) for job in jobs_data)) if doc]
+    packs, singles = plan_packs(documents, profile or GENERATION_PROFILE)
+    
+    for doc in singles:
+        file_content, filename = files[doc["ref"]]
+        job_status[doc["ref"]].update({"status": "queued", "message": "Job queued for batch processing"})
+        schedule_job(doc["ref"], file_content, filename, priority_class, tenant, profile, selection, retries=1)
+    for pack in packs:
+        pack_id = f"pack-{uuid.uuid4()}"
+        for doc in pack:
+            job_status[doc["ref"]].update({"status": "queued", "message": "Queued in a packed call"})
+            job_status[doc["ref"]]["scheduling"] = {"priority_class": priority_class, "tenant": tenant or "default",
+                                                    "queued_at": time.time(), "pack_id": pack_id,
+                                                    "packed_documents": len(pack)}
+        run = partial(run_pack, pack, files, profile, selection, priority_class, tenant)
+        scheduler().submit(pack_id, run, priority_class, tenant)
+
+async def orchestrate_bulk_processing(jobs_data: list, profile: str = None, selection: dict = None):
+    """
+    Offline bulk mode: extract every file, submit them as provider batch jobs
+    (cheaper, outside the interactive rate limits) and finish each job when
+    its batch completes.
+    jobs_data: list of (job_id, content, filename)
+    """
+    from app.bulk import submit_documents, poll_once, BULK_POLL_SECONDS
+    state = bulk_state()
+    contents = {}
+    documents = []
+    for job_id, file_content, filename in jobs_data:
+        job_status[job_id].update({"status": "processing", "progress": 20, "message": "Extracting content"})
+        try:
+            content = await asyncio.to_thread(extract_content, file_content, filename, **(selection or {}))
+        except PageSelectionError as e:
+            set_job_status(job_id, {"status": "failed", "progress": 0, "error": str(e)})
+            continue
+        contents[job_id] = content
+        documents.append({"ref": job_id, "filename": filename, "content": content})
+    
+    try:
+        bulk_ids = await asyncio.to_thread(submit_documents, documents, api_pool(), get_common_prompt,
+                                           state, profile)
+    except Exception as e:
+        print(f"Bulk submission failed: {e}")
+        for job_id in contents:
+            set_job_status(job_id, {"status": "failed", "progress": 0, "error": f"Bulk submission failed: {e}"})
+        return
+    
+    for bulk_id in bulk_ids:
+        batch = state.batches[bulk_id]
+        for item in batch["items"].values():
+            job_status[item["ref"]].update({
+                "status": "submitted", "progress": 50, "bulk_id": bulk_id,
+                "message": f"Waiting for {batch['provider']} batch {batch['remote_id']}"
+            })
+    
+    pending = set(bulk_ids)
+    while pending:
+        await asyncio.sleep(BULK_POLL_SECONDS)
+        for bulk_id in list(pending):
+            batch = state.batches[bulk_id]
+            try:
+                results = await asyncio.to_thread(poll_once, bulk_id, batch, api_pool())
+            except Exception as e:
+                print(f"Polling {bulk_id} failed: {e}")
+                continue
+            if results is None:
+                continue
             
-            await process_job(job_id, content, filename)
+            for custom_id, (json_str, token_info, error) in results.items():
+                item = batch["items"][custom_id]
+                try:
+                    if not json_str:
+                        raise Exception(f"Provider batch returned no result ({error})")
+                    await asyncio.to_thread(complete_job, item["ref"], item["filename"], json_str, token_info,
+                                            contents[item["ref"]], None, None, profile)
+                except Exception as e:
+                    record_job("failed", token_info, contents[item["ref"]].get("extraction_method"))
+                    set_job_status(item["ref"], {"status": "failed", "progress": 0, "error": str(e)})
             
-            if i < len(failed_jobs) - 1:
-                await asyncio.sleep(3)
+            batch["status"] = "completed"
+            batch["completed_at"] = time.time()
+            state.save()
+            pending.discard(bulk_id)
 
 @app.post("/api/v1/extract")
 async def extract_invoice(
     file: UploadFile = File(...),
-    background_tasks: BackgroundTasks = None
+    profile: Optional[str] = None,
+    pages: Optional[str] = None,
+    page_role: Optional[str] = None,
+    priority: Optional[str] = None,
+    tenant: Optional[str] = Header(None, alias="X-Tenant-ID")
 ):
+    """
+    Upload one file. pages ("1-3,7,10-") and page_role (summary / line_items)
+    limit which pages are rendered and sent to the AI.
+    Runs as an interactive job (ahead of batch work) unless priority=batch;
+    X-Tenant-ID decides whose share of the capacity it uses.
+    """
     if not file.filename:
         raise HTTPException(status_code=400, detail="No filename")
+    check_profile(profile)
+    check_priority(priority)
+    selection = check_pages(pages, page_role)
         
     job_id = str(uuid.uuid4())
     content = await file.read()
@@ -513,7 +516,7 @@ async def extract_invoice(
         "message": "Job queued"
     }
     
-    background_tasks.add_task(process_job, job_id, content, file.filename)
+    schedule_job(job_id, content, file.filename, priority or "interactive", tenant, profile, selection)
     
     return {
         "job_id": job_id,
@@ -523,12 +526,37 @@ async def extract_invoice(
 @app.post("/api/v1/batch-extract")
 async def batch_extract_invoices(
     files: list[UploadFile] = File(...),
-    background_tasks: BackgroundTasks = None
+    background_tasks: BackgroundTasks = None,
+    profile: Optional[str] = None,
+    mode: Optional[str] = None,
+    pages: Optional[str] = None,
+    page_role: Optional[str] = None,
+    priority: Optional[str] = None,
+    batch_id: Optional[str] = None,
+    tenant: Optional[str] = Header(None, alias="X-Tenant-ID")
 ):
     """
     Upload multiple files (PDFs/Images) for batch processing.
-    Returns a list of Job IDs.
+    Returns a list of Job IDs and the batch they belong to: a new batch, or
+    batch_id when given, so a client can upload a large batch in several
+    (concurrent) requests and follow it at /api/v1/batch/{batch_id}.
+    mode=bulk sends the files through the providers' batch APIs instead
+    (cheaper, results arrive in minutes to hours).
+    mode=pack sends small documents (single-page receipts, photos) several
+    to one provider call and splits the answer back per file.
+    pages / page_role apply to every file in the batch.
+    Files run as batch jobs (after interactive uploads, fair-shared between
+    X-Tenant-ID tenants) unless priority=interactive.
     """
+    check_profile(profile)
+    check_priority(priority)
+    selection = check_pages(pages, page_role)
+    if mode not in (None, "sync", "bulk", "pack"):
+        raise HTTPException(status_code=400, detail="mode must be 'sync', 'bulk' or 'pack'")
+    if batch_id is not None and not BATCH_ID_PATTERN.match(batch_id):
+        raise HTTPException(status_code=400, detail="batch_id must be 1-64 letters, digits, '-' or '_'")
+    batch_id = batch_id or str(uuid.uuid4())
+    batch = batches.setdefault(batch_id, {"created_at": time.time(), "jobs": {}, "seq": 0, "finished": {}})
     jobs_response = []
     jobs_data = []
     
@@ -546,6 +574,8 @@ async def batch_extract_invoices(
         }
         
         jobs_data.append((job_id, content, file.filename))
+        batch["jobs"][job_id] = file.filename
+        job_batches[job_id] = batch_id
         
         jobs_response.append({
             "filename": file.filename,
@@ -553,10 +583,177 @@ async def batch_extract_invoices(
             "status_url": f"/api/v1/status/{job_id}"
         })
     
-    # Launch the orchestrator as a single background task
-    background_tasks.add_task(orchestrate_batch_processing, jobs_data)
+    if mode == "bulk":
+        # Launch the orchestrator as a single background task
+        background_tasks.add_task(orchestrate_bulk_processing, jobs_data, profile, selection)
+    elif mode == "pack":
+        background_tasks.add_task(orchestrate_packed_processing, jobs_data, profile, selection,
+                                  priority or "batch", tenant)
+    else:
+        for job_id, content, filename in jobs_data:
+            schedule_job(job_id, content, filename, priority or "batch", tenant, profile, selection, retries=1)
+    
+    return {"batch_id": batch_id, "batch_status_url": f"/api/v1/batch/{batch_id}", "batch_results": jobs_response}
+
+@app.post("/api/v1/replay")
+async def replay_jobs(
+    tolerance: Optional[float] = None,
+    risk_threshold: Optional[float] = None,
+    apply: bool = False
+):
+    """
+    Re-run validation and the local fraud rules over every completed job
+    held by this service, without calling the AI. Returns a diff report of
+    changed risk levels / math checks; apply=true also updates the stored results.
+    tolerance / risk_threshold override MATH_MATCH_TOLERANCE / MATH_RISK_THRESHOLD.
+    """
+    from app.replay import replay_results
+    results = {job_id: job["result"] for job_id, job in list(job_status.items())
+               if job.get("status") == "completed" and job.get("result")}
+    report, updated = await asyncio.to_thread(replay_results, results, 1, tolerance, risk_threshold,
+                                              engine=benford_engine())
+    if apply:
+        for job_id, result in updated.items():
+            job_status[job_id]["result"] = result
+            record_finish(job_id)
+    report["applied"] = apply
+    return report
+
+@app.get("/api/v1/scheduler")
+async def scheduler_status():
+    """Queued and running jobs per priority class"""
+    return {"workers": scheduler().workers, "batch_slots": scheduler().batch_slots, "classes": scheduler().stats()}
+
+def batch_summary(batch_id):
+    """Status counts and per-job status (without results) of a batch"""
+    batch = batches[batch_id]
+    jobs = []
+    for job_id, filename in list(batch["jobs"].items()):
+        job = job_status.get(job_id, {})
+        entry = {"job_id": job_id, "filename": filename, "status": job.get("status", "unknown"),
+                 "progress": job.get("progress", 0)}
+        if job.get("error"):
+            entry["error"] = job["error"]
+        jobs.append(entry)
+    counts = Counter(job["status"] for job in jobs)
+    finished = sum(counts[status] for status in FINISHED_STATUSES)
+    return {"batch_id": batch_id, "created_at": batch["created_at"], "total": len(jobs), "finished": finished,
+            "done": finished == len(jobs), "counts": dict(counts), "jobs": jobs}
+
+@app.get("/api/v1/batch/{batch_id}")
+async def get_batch_status(batch_id: str, wait: float = 0, finished: int = -1):
+    """
+    Status of every job in a batch, in one request. With wait=N the answer is
+    held back (up to N seconds, at most 30) until more than `finished` jobs
+    have finished, so a client can long-poll instead of checking every job.
+    """
+    if batch_id not in batches:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    deadline = time.monotonic() + min(max(wait, 0), BATCH_MAX_WAIT_SECONDS)
+    while True:
+        summary = batch_summary(batch_id)
+        if summary["finished"] > finished or summary["done"] or time.monotonic() >= deadline:
+            return summary
+        await asyncio.sleep(0.25)
+
+def result_encoding(accept_encoding):
+    """zstd (when the zstandard package is installed) or gzip if the client accepts it, else None"""
+    accepted = set()
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip())
+    if "zstd" in accepted and importlib.util.find_spec("zstandard"):
+        return "zstd"
+    return "gzip" if "gzip" in accepted or "*" in accepted else None
+
+def compressed_stream(lines, encoding=None):
+    """Join lines into chunks of about RESULTS_CHUNK_BYTES and compress them as they are sent"""
+    if encoding == "zstd":
+        import zstandard
+        compressor = zstandard.ZstdCompressor().compressobj()
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = None
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= RESULTS_CHUNK_BYTES:
+            data = b"".join(buffer)
+            buffer, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = b"".join(buffer)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+def batch_result_lines(batch, entries):
+    """One compact JSON line per finished job: seq, job_id, filename, status and result or error"""
+    for seq, job_id in entries:
+        job = job_status.get(job_id, {})
+        record = {"seq": seq, "job_id": job_id, "filename": batch["jobs"].get(job_id), "status": job.get("status")}
+        if job.get("status") == "completed":
+            record["result"] = job.get("result")
+        else:
+            record["error"] = job.get("error")
+        yield (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+@app.get("/api/v1/batch/{batch_id}/results")
+async def get_batch_results(
+    batch_id: str,
+    since: int = 0,
+    limit: int = RESULTS_PAGE_SIZE,
+    wait: float = 0,
+    accept_encoding: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Results of a batch's finished jobs as NDJSON (one job per line, in the
+    order they finished), gzip- or zstd-compressed as Accept-Encoding allows.
+    X-Batch-Cursor is the since= for the next request, which then returns
+    only jobs finished after this one; X-Batch-Done says every job is in.
+    With wait=N the answer waits (up to 30 seconds) for a job to finish.
+    Answers carry an ETag; If-None-Match with it gives 304 Not Modified.
+    """
+    if batch_id not in batches:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    batch = batches[batch_id]
+    limit = min(max(limit, 1), RESULTS_MAX_PAGE_SIZE)
+    deadline = time.monotonic() + min(max(wait, 0), BATCH_MAX_WAIT_SECONDS)
+    while True:
+        with BATCH_LOCK:
+            current = batch["seq"]
+            newer = sorted((seq, job_id) for job_id, seq in batch["finished"].items() if seq > since)
+        # A job that failed and is being retried is left out until it finishes again (with a new number)
+        entries = [(seq, job_id) for seq, job_id in newer
+                   if job_status.get(job_id, {}).get("status") in FINISHED_STATUSES]
+        total = len(batch["jobs"])
+        finished = sum(1 for job_id in list(batch["jobs"])
+                       if job_status.get(job_id, {}).get("status") in FINISHED_STATUSES)
+        if entries or finished == total or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.25)
     
-    return {"batch_results": jobs_response}
+    page = entries[:limit]
+    more = len(entries) > limit
+    cursor = page[-1][0] if more else max(current, since)
+    encoding = result_encoding(accept_encoding)
+    etag = f'"{batch_id}-{since}-{cursor}-{total}-{len(page)}-{encoding or "identity"}"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "X-Batch-Cursor": str(cursor),
+               "X-Batch-Done": "true" if finished == total and not more else "false",
+               "X-Result-Count": str(len(page))}
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    # A plain iterator: Starlette runs it in a thread, so serializing 10,000 results does not block the loop
+    return StreamingResponse(compressed_stream(batch_result_lines(batch, page), encoding),
+                             media_type="application/x-ndjson", headers=headers)
 
 @app.get("/api/v1/status/{job_id}")
 async def get_status(job_id: str):
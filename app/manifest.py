@@ -0,0 +1,128 @@
+"""
+Run manifest for the CLI (submit_bill.py)
+
+Keeps one SQLite row per (file path, content hash) with the status,
+attempt count, timing and token usage of the last run, so that a rerun
+can skip files that already succeeded and have not changed.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """Hash file content in chunks (large scans never sit fully in memory)"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """SQLite-backed record of what each CLI run has processed"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._started = {}
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                started_at REAL,
+                finished_at REAL,
+                duration_s REAL,
+                prompt_tokens INTEGER,
+                output_tokens INTEGER,
+                total_tokens INTEGER,
+                model TEXT,
+                output_file TEXT,
+                error TEXT,
+                PRIMARY KEY (path, content_hash)
+            )
+        """)
+        self._conn.commit()
+
+    def content_hash(self, path):
+        key = os.path.abspath(path)
+        if key not in self._hashes:
+            self._hashes[key] = file_sha256(path)
+        return self._hashes[key]
+
+    def _row(self, path):
+        cur = self._conn.execute(
+            "SELECT status, output_file FROM files WHERE path = ? AND content_hash = ?",
+            (os.path.abspath(path), self.content_hash(path))
+        )
+        return cur.fetchone()
+
+    def is_done(self, path):
+        """True if this exact file content already succeeded and its output still exists"""
+        with self._lock:
+            row = self._row(path)
+        if not row:
+            return False
+        status, output_file = row
+        return status == "success" and bool(output_file) and os.path.exists(output_file)
+
+    def start(self, path):
+        """Mark a file as running and bump its attempt counter"""
+        now = time.time()
+        with self._lock:
+            self._started[os.path.abspath(path)] = now
+            self._conn.execute("""
+                INSERT INTO files (path, content_hash, status, attempts, started_at)
+                VALUES (?, ?, 'running', 1, ?)
+                ON CONFLICT (path, content_hash) DO UPDATE SET
+                    status = 'running', attempts = attempts + 1,
+                    started_at = excluded.started_at, error = NULL
+            """, (os.path.abspath(path), self.content_hash(path), now))
+            self._conn.commit()
+
+    def finish(self, path, success, token_info=None, output_file=None, error=None):
+        """Record the outcome of the latest attempt"""
+        now = time.time()
+        token_info = token_info or {}
+        with self._lock:
+            started = self._started.pop(os.path.abspath(path), None)
+            if started is None:
+                # Started by an earlier process (e.g. a resumed bulk run)
+                row = self._conn.execute(
+                    "SELECT started_at FROM files WHERE path = ? AND content_hash = ?",
+                    (os.path.abspath(path), self.content_hash(path))
+                ).fetchone()
+                started = row[0] if row and row[0] else now
+            self._conn.execute("""
+                UPDATE files SET
+                    status = ?, finished_at = ?, duration_s = ?,
+                    prompt_tokens = ?, output_tokens = ?, total_tokens = ?, model = ?,
+                    output_file = ?, error = ?
+                WHERE path = ? AND content_hash = ?
+            """, (
+                "success" if success else "failed", now, round(now - started, 3),
+                token_info.get("prompt_tokens"), token_info.get("output_tokens"),
+                token_info.get("total_tokens"), token_info.get("model"),
+                os.path.abspath(output_file) if output_file else None, error,
+                os.path.abspath(path), self.content_hash(path)
+            ))
+            self._conn.commit()
+
+    def summary(self):
+        """Counts per status plus total tokens across the manifest"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*), COALESCE(SUM(total_tokens), 0) FROM files GROUP BY status"
+            ).fetchall()
+        return {status: {"files": count, "total_tokens": tokens} for status, count, tokens in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,203 @@
+"""
+Upload-once media references for provider calls
+
+With MEDIA_UPLOADS=true, page images are uploaded once through the
+provider's file API and later calls (retries, re-runs, other profiles)
+send only the returned reference instead of the base64 page:
+
+- gemini: Files API (resumable upload), referenced as file_data; files
+  expire after 48 hours and the returned expirationTime is kept
+- anthropic: Files API (beta), referenced as an image source of type
+  "file"; files do not expire, MEDIA_TTL_SECONDS bounds how long a
+  reference is trusted
+- openai: chat completions only take inline or URL images, so pages are
+  always sent inline
+
+References are cached per provider, API key (files belong to the key's
+project / workspace) and page hash (sha256 of the page's JPEG bytes), together
+with their expiry. The cache lives in memory and, when MEDIA_CACHE_PATH is
+set, in a JSON file so re-runs of the command line reuse it. A reference
+is dropped a few minutes before it expires, and whenever a call using it
+is rejected; any upload failure falls back to the inline page.
+
+mock_provider.py implements both upload APIs for local runs.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+
+from app.transport import as_bytes
+
+MEDIA_UPLOADS = os.getenv("MEDIA_UPLOADS", "false").lower() == "true"
+MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", "")
+MEDIA_TTL_SECONDS = float(os.getenv("MEDIA_TTL_SECONDS", str(24 * 3600)))
+EXPIRY_MARGIN_SECONDS = 600
+
+GEMINI_FILE_TTL_SECONDS = 48 * 3600
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+ANTHROPIC_FILES_BETA = "files-api-2025-04-14"
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def page_hash(image):
+    return hashlib.sha256(as_bytes(image)).hexdigest()
+
+
+def _key_id(api_key):
+    # Never store the key itself
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+def _parse_expiry(value, default_ttl):
+    """RFC 3339 expirationTime -> epoch seconds (now + default_ttl if missing)"""
+    if value:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            pass
+    return time.time() + default_ttl
+
+
+class MediaCache:
+    """(provider, key, page hash) -> {"ref": ..., "expires_at": epoch}, optionally saved to a JSON file"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._items = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._items = json.load(f)
+            except (OSError, ValueError):
+                self._items = {}
+        self.purge()
+
+    @staticmethod
+    def _key(provider, api_key, digest):
+        return f"{provider}|{_key_id(api_key)}|{digest}"
+
+    def get(self, provider, api_key, digest):
+        entry = self._items.get(self._key(provider, api_key, digest))
+        if entry and entry["expires_at"] - EXPIRY_MARGIN_SECONDS > time.time():
+            return entry["ref"]
+        return None
+
+    def put(self, provider, api_key, digest, ref, expires_at):
+        with self._lock:
+            self._items[self._key(provider, api_key, digest)] = {"ref": ref, "expires_at": expires_at}
+            self._save()
+
+    def forget(self, provider, api_key, digests):
+        with self._lock:
+            for digest in digests:
+                self._items.pop(self._key(provider, api_key, digest), None)
+            self._save()
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            self._items = {k: v for k, v in self._items.items() if v["expires_at"] - EXPIRY_MARGIN_SECONDS > now}
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._items, f)
+        os.replace(tmp, self.path)
+
+
+def cache():
+    global _CACHE
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = MediaCache(MEDIA_CACHE_PATH or None)
+    return _CACHE
+
+
+def use_cache_file(path):
+    """Keep references in path (the command line points this into its output directory)"""
+    global _CACHE
+    with _CACHE_LOCK:
+        _CACHE = MediaCache(path)
+    return _CACHE
+
+
+# --- Uploads ---
+
+def _upload_gemini(session, api_key, data, base_url):
+    start = session.post(
+        f"{base_url}/upload/v1beta/files?key={api_key}",
+        headers={
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(data)),
+            "X-Goog-Upload-Header-Content-Type": "image/jpeg",
+            "Content-Type": "application/json",
+        },
+        json={"file": {"display_name": "bill-page"}},
+        timeout=60,
+    )
+    start.raise_for_status()
+    upload_url = start.headers["X-Goog-Upload-URL"]
+    r = session.post(upload_url, data=data, timeout=120, headers={
+        "X-Goog-Upload-Offset": "0",
+        "X-Goog-Upload-Command": "upload, finalize",
+    })
+    r.raise_for_status()
+    info = r.json()["file"]
+    return info["uri"], _parse_expiry(info.get("expirationTime"), GEMINI_FILE_TTL_SECONDS)
+
+
+def _upload_anthropic(session, api_key, data):
+    r = session.post(
+        f"{ANTHROPIC_BASE_URL}/v1/files",
+        headers={"x-api-key": api_key, "anthropic-version": "2023-06-01", "anthropic-beta": ANTHROPIC_FILES_BETA},
+        files={"file": ("page.jpg", data, "image/jpeg")},
+        timeout=120,
+    )
+    r.raise_for_status()
+    return r.json()["id"], time.time() + MEDIA_TTL_SECONDS
+
+
+def references(provider, api_key, images, session=None, base_url=None):
+    """Reference for each page (None where the page has to go inline).
+    Uploads pages that are not cached yet; returns (refs, page hashes)."""
+    digests = [page_hash(img) for img in images]
+    if not MEDIA_UPLOADS or provider not in ("gemini", "anthropic"):
+        return [None] * len(images), digests
+
+    from app.metrics import stage
+    store = cache()
+    refs = []
+    for img, digest in zip(images, digests):
+        ref = store.get(provider, api_key, digest)
+        if ref is None:
+            try:
+                import requests
+                session = session or requests.Session()
+                with stage("media_upload"):
+                    data = as_bytes(img)
+                    if provider == "gemini":
+                        ref, expires_at = _upload_gemini(session, api_key, data, base_url)
+                    else:
+                        ref, expires_at = _upload_anthropic(session, api_key, data)
+                store.put(provider, api_key, digest, ref, expires_at)
+            except Exception as e:
+                print(f"   ⚠️ Media upload failed ({e}); sending the page inline")
+                ref = None
+        refs.append(ref)
+    return refs, digests
+
+
+def forget(provider, api_key, digests):
+    """Drop references a provider rejected (expired or deleted files)"""
+    cache().forget(provider, api_key, digests)
@@ -0,0 +1,144 @@
+"""
+Stage-level instrumentation and Prometheus metrics
+
+StageTimer records wall-clock and CPU time per pipeline stage
+(rasterize, pdf_text, ocr, encode, forensics, provider_call,
+json_parse, validate, ...). The timings travel with the content/result
+dicts so they end up in each result's processing_metadata, and are
+exported as Prometheus histograms labelled by provider, model and
+extraction method.
+"""
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+LABELS = ["stage", "provider", "model", "extraction_method"]
+
+STAGE_SECONDS = Histogram("bill_stage_duration_seconds", "Wall-clock time per pipeline stage",
+                          LABELS, buckets=STAGE_BUCKETS)
+STAGE_CPU_SECONDS = Histogram("bill_stage_cpu_seconds", "CPU time (calling thread) per pipeline stage",
+                              LABELS, buckets=STAGE_BUCKETS)
+JOBS_TOTAL = Counter("bill_jobs_total", "Finished jobs",
+                     ["status", "provider", "model", "extraction_method"])
+TOKENS_TOTAL = Counter("bill_tokens_total", "Tokens used", ["kind", "provider", "model"])
+JOBS_QUEUED = Gauge("bill_jobs_queued", "Jobs accepted but not started yet")
+JOBS_IN_FLIGHT = Gauge("bill_jobs_in_flight", "Jobs currently being processed")
+TOKEN_THROUGHPUT = Gauge("bill_tokens_per_second", "Total tokens per second over the last minute")
+QUEUE_WAIT = Histogram("bill_queue_wait_seconds", "Time from submission to start, per priority class",
+                       ["priority_class"], buckets=STAGE_BUCKETS)
+QUEUE_SLO_MISSES = Counter("bill_queue_slo_misses_total", "Jobs that waited longer than their class's queue SLO",
+                           ["priority_class"])
+SCHEDULER_QUEUED = Gauge("bill_scheduler_queued", "Jobs waiting for a scheduler slot", ["priority_class"])
+SCHEDULER_RUNNING = Gauge("bill_scheduler_running", "Scheduler slots in use", ["priority_class"])
+
+_ACTIVE = contextvars.ContextVar("active_stage_timer", default=None)
+
+
+def provider_for_model(model):
+    model = model or ""
+    if model.startswith("gemini"):
+        return "gemini"
+    if model.startswith("gpt") or model.startswith("o"):
+        return "openai"
+    if model.startswith("claude"):
+        return "anthropic"
+    return "unknown"
+
+
+class StageTimer:
+    """Accumulates wall / CPU milliseconds per named stage"""
+
+    def __init__(self, stages=None):
+        self.stages = {name: dict(values) for name, values in (stages or {}).items()}
+        self._depth = 0
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        nested = self._depth > 0
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            entry = self.stages.setdefault(name, {"wall_ms": 0.0, "cpu_ms": 0.0, "calls": 0})
+            entry["wall_ms"] = round(entry["wall_ms"] + (time.perf_counter() - wall) * 1000, 2)
+            entry["cpu_ms"] = round(entry["cpu_ms"] + (time.thread_time() - cpu) * 1000, 2)
+            entry["calls"] += 1
+            if nested:
+                # Already counted in the enclosing stage (provider_backoff inside provider_call)
+                entry["nested"] = True
+
+    @contextmanager
+    def active(self):
+        """Make this the timer that module-level stage() calls record into"""
+        token = _ACTIVE.set(self)
+        try:
+            yield self
+        finally:
+            _ACTIVE.reset(token)
+
+    def metadata(self):
+        return {
+            "stage_timings": self.stages,
+            "total_wall_ms": round(sum(s["wall_ms"] for s in self.stages.values() if not s.get("nested")), 2),
+        }
+
+    def export(self, model=None, extraction_method=None):
+        provider = provider_for_model(model)
+        for name, entry in self.stages.items():
+            labels = (name, provider, model or "unknown", extraction_method or "unknown")
+            STAGE_SECONDS.labels(*labels).observe(entry["wall_ms"] / 1000)
+            STAGE_CPU_SECONDS.labels(*labels).observe(entry["cpu_ms"] / 1000)
+
+
+@contextmanager
+def stage(name):
+    """Time a stage on the active StageTimer (no-op when none is active)"""
+    timer = _ACTIVE.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+class _TokenRate:
+    """Sliding one-minute window of token counts"""
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self.events = deque()
+        self.lock = threading.Lock()
+
+    def add(self, tokens):
+        with self.lock:
+            self.events.append((time.time(), tokens))
+
+    def per_second(self):
+        cutoff = time.time() - self.window
+        with self.lock:
+            while self.events and self.events[0][0] < cutoff:
+                self.events.popleft()
+            return sum(t for _, t in self.events) / self.window
+
+
+_TOKEN_RATE = _TokenRate()
+TOKEN_THROUGHPUT.set_function(_TOKEN_RATE.per_second)
+
+
+def record_job(status, token_info=None, extraction_method=None):
+    """Count a finished job and its token usage"""
+    token_info = token_info or {}
+    model = token_info.get("model") or "unknown"
+    provider = provider_for_model(model)
+    JOBS_TOTAL.labels(status, provider, model, extraction_method or "unknown").inc()
+    for kind in ("prompt_tokens", "output_tokens", "reasoning_tokens", "total_tokens"):
+        if token_info.get(kind):
+            TOKENS_TOTAL.labels(kind.replace("_tokens", ""), provider, model).inc(token_info[kind])
+    if token_info.get("total_tokens"):
+        _TOKEN_RATE.add(token_info["total_tokens"])
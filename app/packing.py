@@ -0,0 +1,136 @@
+"""
+Packing small documents into one provider call
+
+Single-page receipts and photos are most of the volume by count, and each
+one pays the full prompt, a round-trip and a rate-limit slot. In packing
+mode small documents (at most PACK_MAX_PAGES page images) are grouped
+under an estimated input budget of PACK_TOKEN_BUDGET tokens, and each group
+goes out as one request: the instructions and output structure once, every
+document's pages labelled "PAGE n OF DOCUMENT i", its text under
+"=== DOCUMENT i ===", and an answer of the form {"documents": [...]}.
+
+The answer is split back into one JSON string per document, which then
+goes through the usual parsing and validation as if it had been a call of
+its own. Token usage is shared out evenly. Documents the answer does not
+cover (or a whole pack, when the call fails or the answer does not parse)
+come back without a result so the caller can run them on their own.
+
+A pack is also capped by the profile's output tokens (PACK_OUTPUT_TOKENS
+per document) so the combined answer is not cut off.
+"""
+import os
+import json
+import uuid
+
+PACK_TOKEN_BUDGET = int(os.getenv("PACK_TOKEN_BUDGET", "12000"))
+PACK_MAX_DOCUMENTS = int(os.getenv("PACK_MAX_DOCUMENTS", "8"))
+PACK_MAX_PAGES = int(os.getenv("PACK_MAX_PAGES", "1"))
+PACK_IMAGE_TOKENS = 1100   # rough input cost of one page image (the largest of the providers)
+PACK_OUTPUT_TOKENS = 1200  # rough answer size for one small document
+
+
+def estimate_tokens(content):
+    return len(content["images"]) * PACK_IMAGE_TOKENS + len(content["text"]) // 4
+
+
+def is_small(content):
+    return (len(content["images"]) <= PACK_MAX_PAGES
+            and estimate_tokens(content) <= PACK_TOKEN_BUDGET // 2)
+
+
+def max_documents(profile):
+    return max(1, min(PACK_MAX_DOCUMENTS, profile["max_output_tokens"] // PACK_OUTPUT_TOKENS))
+
+
+def plan_packs(documents, profile=None):
+    """Group documents ([{"ref", "filename", "content"}]) into packs.
+    Returns (packs, singles): lists of documents to send together, and documents to send alone."""
+    from app.generation import get_profile
+    limit = max_documents(get_profile(profile))
+    packs, singles, current, used = [], [], [], 0
+    for doc in documents:
+        if not is_small(doc["content"]):
+            singles.append(doc)
+            continue
+        cost = estimate_tokens(doc["content"])
+        if current and (len(current) >= limit or used + cost > PACK_TOKEN_BUDGET):
+            packs.append(current)
+            current, used = [], 0
+        current.append(doc)
+        used += cost
+    if current:
+        packs.append(current)
+    # A pack of one is just a regular call
+    singles.extend(pack[0] for pack in packs if len(pack) == 1)
+    return [pack for pack in packs if len(pack) > 1], singles
+
+
+def packed_content(documents):
+    """One content dict (as extract_content returns) for the whole pack"""
+    from app.providers import get_packed_prompt
+    from app.extraction import page_labels
+    images, labels, texts = [], [], []
+    for i, doc in enumerate(documents, 1):
+        content = doc["content"]
+        for page, image in zip(page_labels(content), content["images"]):
+            images.append(image)
+            labels.append(f"{page} OF DOCUMENT {i}")
+        if content["text"].strip():
+            texts.append(f"=== DOCUMENT {i} ===\n{content['text']}")
+    return {
+        "images": images,
+        "image_labels": labels,
+        "max_images": len(images),
+        "text": "\n\n".join(texts),
+        "page_count": len(images),
+        "prompt": get_packed_prompt([(doc["filename"], doc["content"]["page_count"]) for doc in documents]),
+    }
+
+
+def split_response(json_str, documents, token_info=None, pack_id=None):
+    """Split a packed answer into {ref: (json_str, token_info)}; documents it does not cover are left out"""
+    from app.providers import clean_json_string
+    try:
+        data = json.loads(clean_json_string(json_str))
+    except (TypeError, ValueError):
+        return {}
+    entries = data.get("documents") if isinstance(data, dict) else None
+    if not isinstance(entries, list):
+        return {}
+    entries = [e for e in entries if isinstance(e, dict)]
+
+    by_index = {}
+    for entry in entries:
+        index = entry.get("document_index")
+        if isinstance(index, int) and 1 <= index <= len(documents) and index not in by_index:
+            by_index[index] = entry
+    if not by_index and len(entries) == len(documents):
+        # No usable indexes; the order is all there is
+        by_index = dict(enumerate(entries, 1))
+
+    share = None
+    if token_info:
+        n = len(documents)
+        share = {**token_info, "packed_documents": n, "pack_id": pack_id}
+        for key in ("prompt_tokens", "output_tokens", "reasoning_tokens", "total_tokens"):
+            share[key] = round((token_info.get(key) or 0) / n)
+
+    results = {}
+    for index, entry in by_index.items():
+        entry = {k: v for k, v in entry.items() if k != "document_index"}
+        results[documents[index - 1]["ref"]] = (json.dumps(entry), share)
+    return results
+
+
+def analyze_pack(documents, profile=None):
+    """One provider call for a pack. Returns ({ref: (json_str, token_info)}, StageTimer of the call)."""
+    from app.providers import analyze_document
+    from app.metrics import StageTimer
+    pack_id = uuid.uuid4().hex[:12]
+    timer = StageTimer()
+    label = f"pack-{pack_id} ({len(documents)} documents)"
+    with timer.active(), timer.stage("provider_call"):
+        json_str, token_info = analyze_document(packed_content(documents), label, profile)
+    if not json_str:
+        return {}, timer
+    return split_response(json_str, documents, token_info, pack_id), timer
@@ -0,0 +1,226 @@
+"""
+Page index: skip boilerplate pages (terms and conditions, cover and
+letterhead pages) that are already known to carry no line items
+
+Every PDF page the AI sees is recorded in SQLite with two fingerprints:
+
+- text hash: SHA-1 of the page's text layer (pypdf), lowercased, digits
+  replaced and whitespace collapsed so page numbers and dates do not
+  matter; pages with less than PAGE_INDEX_MIN_TEXT characters get none
+- image hash: 256-bit difference hash (dHash) of the rendered page,
+  indexed with LSH (16 bands of 16 bits) and matched by Hamming distance
+  up to PAGE_HASH_DISTANCE; only used for pages without a text layer
+  (scans), where there is nothing better to go on
+
+Pages whose text reads like line items (several amount-like lines) are
+never fingerprinted, so a bill page cannot be mistaken for boilerplate,
+and only pages the AI was shown are learned from.
+
+Each fingerprint is stored together with how often the page was seen and
+how often the AI found line items on it. A page seen PAGE_INDEX_MIN_SEEN times (in one document or
+across documents) and never with line items is boilerplate: later copies
+are left out of the rasterization (text hash) or the provider payload
+(image hash), and the known content (page anomalies and the start of its
+text) is put back into the result as that page's entry. At least one page
+of every document is always sent.
+
+The index is shared by all jobs (PAGE_INDEX_PATH, or --page-index on the
+command line); without one nothing is skipped.
+"""
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+PAGE_INDEX_PATH = os.getenv("PAGE_INDEX_PATH")
+PAGE_INDEX_MIN_SEEN = int(os.getenv("PAGE_INDEX_MIN_SEEN", "2"))
+PAGE_INDEX_MIN_TEXT = int(os.getenv("PAGE_INDEX_MIN_TEXT", "200"))
+PAGE_HASH_DISTANCE = int(os.getenv("PAGE_HASH_DISTANCE", "6"))
+HASH_SIZE = 16           # dHash grid: 16 x 16 = 256 bits
+BANDS = 16
+BITS_PER_BAND = HASH_SIZE * HASH_SIZE // BANDS
+MAX_CANDIDATES = 50
+TEXT_EXCERPT_CHARS = 500
+
+_INDEX = None
+_INDEX_PID = None
+_INDEX_LOCK = threading.Lock()
+
+
+def text_hash(text):
+    """Fingerprint of a page's text layer (None when there is too little text)"""
+    normalized = " ".join(re.sub(r"\d", "#", (text or "").lower()).split())
+    if len(normalized) < PAGE_INDEX_MIN_TEXT:
+        return None
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def dhash(image):
+    """256-bit difference hash of a PIL image, as an int"""
+    from PIL import Image
+    small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def band_keys(value):
+    mask = (1 << BITS_PER_BAND) - 1
+    return [(band << BITS_PER_BAND) | ((value >> (band * BITS_PER_BAND)) & mask) for band in range(BANDS)]
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class PageIndex:
+    """Persistent page fingerprints shared by every processed document"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                text_hash TEXT,
+                dhash TEXT,
+                seen INTEGER NOT NULL,
+                with_items INTEGER NOT NULL,
+                content TEXT,
+                source TEXT,
+                first_seen REAL NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_pages_text ON pages (text_hash);
+            CREATE TABLE IF NOT EXISTS lsh (
+                band_key INTEGER NOT NULL,
+                page_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_lsh_band ON lsh (band_key);
+        """)
+        self._conn.commit()
+
+    def _find(self, text_key=None, image_hash=None):
+        """The indexed page with this text hash, or else the closest image hash: (row, distance)"""
+        if text_key:
+            row = self._conn.execute(
+                "SELECT id, seen, with_items, content FROM pages WHERE text_hash = ?", (text_key,)).fetchone()
+            return (row, 0) if row else (None, None)
+        if image_hash is None:
+            return None, None
+        keys = band_keys(image_hash)
+        rows = self._conn.execute(
+            f"SELECT DISTINCT p.id, p.seen, p.with_items, p.content, p.dhash FROM lsh l "
+            f"JOIN pages p ON p.id = l.page_id WHERE l.band_key IN ({','.join('?' * len(keys))}) "
+            f"AND p.text_hash IS NULL LIMIT {MAX_CANDIDATES}", keys).fetchall()
+        best, best_distance = None, None
+        for row in rows:
+            distance = hamming(image_hash, int(row[4], 16))
+            if distance <= PAGE_HASH_DISTANCE and (best is None or distance < best_distance):
+                best, best_distance = row[:4], distance
+        return best, best_distance
+
+    def lookup(self, text_key=None, image_hash=None):
+        """Known-boilerplate match for a page ({"page_id", "matched_by", "times_seen", "content"}) or None"""
+        with self._lock:
+            row, distance = self._find(text_key, image_hash)
+        if not row:
+            return None
+        page_id, seen, with_items, content = row
+        if with_items or seen < PAGE_INDEX_MIN_SEEN:
+            return None
+        match = {"page_id": page_id, "matched_by": "text" if text_key else "image",
+                 "times_seen": seen, "content": json.loads(content or "{}")}
+        if not text_key:
+            match["distance"] = distance
+        return match
+
+    def learn(self, page_hashes, result, source=None):
+        """Record the pages the AI saw ({page number: {"text_hash", "dhash", "text"}}) with whether
+        the result found line items on them"""
+        if not page_hashes or not isinstance(result.get("pages"), list):
+            return
+        entries = {}
+        for entry in result["pages"]:
+            if isinstance(entry, dict):
+                entries.setdefault(str(entry.get("page_number")), entry)
+        now = time.time()
+        with self._lock:
+            for page, hashes in page_hashes.items():
+                if not hashes.get("text_hash") and not hashes.get("dhash"):
+                    continue
+                entry = entries.get(str(page)) or {}
+                has_items = 1 if entry.get("line_items") else 0
+                image_hash = int(hashes["dhash"], 16) if hashes.get("dhash") else None
+                row, _ = self._find(hashes.get("text_hash"), image_hash)
+                content = json.dumps({"page_anomalies": entry.get("page_anomalies") or [],
+                                      "text": (hashes.get("text") or "")[:TEXT_EXCERPT_CHARS]})
+                if row:
+                    self._conn.execute(
+                        "UPDATE pages SET seen = seen + 1, with_items = with_items + ?, last_seen = ?, "
+                        "content = CASE WHEN ? THEN content ELSE ? END WHERE id = ?",
+                        (has_items, now, has_items, content, row[0]))
+                    continue
+                cur = self._conn.execute(
+                    "INSERT INTO pages (text_hash, dhash, seen, with_items, content, source, first_seen, last_seen) "
+                    "VALUES (?, ?, 1, ?, ?, ?, ?, ?)",
+                    (hashes.get("text_hash"), hashes.get("dhash"), has_items, content, source, now, now))
+                if image_hash is not None and not hashes.get("text_hash"):
+                    self._conn.executemany("INSERT INTO lsh (band_key, page_id) VALUES (?, ?)",
+                                           [(key, cur.lastrowid) for key in band_keys(image_hash)])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def default_index():
+    """The shared index at PAGE_INDEX_PATH (None when not configured)"""
+    global _INDEX, _INDEX_PID
+    if not PAGE_INDEX_PATH:
+        return None
+    # A forked extraction worker must not share its parent's SQLite connection
+    if _INDEX is None or _INDEX_PID != os.getpid():
+        with _INDEX_LOCK:
+            if _INDEX is None or _INDEX_PID != os.getpid():
+                _INDEX, _INDEX_PID = PageIndex(PAGE_INDEX_PATH), os.getpid()
+    return _INDEX
+
+
+def reattach(result, skipped_pages):
+    """Put the known content of skipped boilerplate pages back into the result's pages"""
+    if not skipped_pages:
+        return result
+    pages = result.get("pages") if isinstance(result.get("pages"), list) else []
+    for skipped in skipped_pages:
+        content = skipped.get("content") or {}
+        pages.append({
+            "page_number": skipped["page_number"],
+            "line_items": [],
+            "page_anomalies": content.get("page_anomalies", []),
+            "known_page": {"matched_by": skipped["matched_by"], "times_seen": skipped["times_seen"],
+                           "text": content.get("text", "")},
+        })
+    pages.sort(key=lambda p: p.get("page_number") if isinstance(p.get("page_number"), int) else 0)
+    result["pages"] = pages
+    return result
+
+
+def apply(result, page_hashes=None, skipped_pages=None, source=None):
+    """After a document is analyzed: learn from the pages the AI saw, then reattach the skipped ones"""
+    index = default_index()
+    if index and page_hashes:
+        index.learn(page_hashes, result, source)
+    return reattach(result, skipped_pages)
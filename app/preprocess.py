@@ -0,0 +1,208 @@
+"""
+Clean-up of photographed bills before OCR and the vision call
+
+Phone photos (test_bill.jpg style) come in rotated, skewed, shadowed and
+with the table around the paper in frame. Each step is vectorized with
+NumPy / done by Pillow:
+
+- EXIF rotation: apply the camera's orientation tag
+- perspective correction: find the paper's corners (Otsu threshold, then
+  the extreme points of the bright region) and warp them to a rectangle;
+  this also crops away the background
+- deskew: projection-profile search for the text angle on a downscaled
+  binary page
+- denoise + adaptive threshold: light Gaussian blur (a median filter
+  eats decimal points), then a local-mean (integral image) threshold that
+  flattens shadows and uneven light
+- border crop: trim the empty margins around the ink
+
+The vision model gets the corrected grayscale page as a JPEG (smaller than
+the upload and without the background); tesseract gets the binarized page.
+Pixel forensics still run on the original upload, since every step here
+rewrites pixels.
+
+Images are processed in a process pool so the CPU work stays off the
+caller's threads; callers that already run in a worker process set
+USE_POOL = False.
+"""
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+PREPROCESS_MAX_SIDE = int(os.getenv("PREPROCESS_MAX_SIDE", "2000"))
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(min(4, os.cpu_count() or 1))))
+USE_POOL = PREPROCESS_WORKERS > 0
+
+MAX_SKEW_DEGREES = 10.0
+SKEW_ANALYSIS_SIDE = 800       # deskew search runs on a page this size
+PAPER_MIN_AREA = 0.25          # paper must cover this share of the photo to be warped
+PAPER_MAX_AREA = 0.97          # above this the photo is already just the paper
+THRESHOLD_SENSITIVITY = 0.15   # ink = darker than the local mean by this fraction
+CROP_MARGIN = 0.02
+JPEG_QUALITY = 85
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def otsu_threshold(gray):
+    """Global Otsu threshold of a uint8 array"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weights = np.cumsum(hist)
+    means = np.cumsum(hist * np.arange(256))
+    total_w, total_m = weights[-1], means[-1]
+    w_bg, w_fg = weights[:-1], total_w - weights[:-1]
+    valid = (w_bg > 0) & (w_fg > 0)
+    between = np.zeros(255)
+    m_bg = means[:-1][valid] / w_bg[valid]
+    m_fg = (total_m - means[:-1][valid]) / w_fg[valid]
+    between[valid] = w_bg[valid] * w_fg[valid] * (m_bg - m_fg) ** 2
+    return int(np.argmax(between))
+
+
+def find_paper(gray):
+    """Corners (tl, tr, br, bl) of the bright paper in a photo, or None if it fills the frame"""
+    step = max(1, max(gray.shape) // 400)
+    small = gray[::step, ::step]
+    mask = small > otsu_threshold(small)
+    coverage = mask.mean()
+    if not PAPER_MIN_AREA <= coverage <= PAPER_MAX_AREA:
+        return None
+    ys, xs = np.nonzero(mask)
+    s, d = xs + ys, xs - ys
+    corners = np.array([
+        (xs[np.argmin(s)], ys[np.argmin(s)]),   # top-left
+        (xs[np.argmax(d)], ys[np.argmax(d)]),   # top-right
+        (xs[np.argmax(s)], ys[np.argmax(s)]),   # bottom-right
+        (xs[np.argmin(d)], ys[np.argmin(d)]),   # bottom-left
+    ], dtype=np.float64) * step
+    # Pull the corners in a little so no sliver of background survives the warp
+    center = corners.mean(axis=0)
+    corners += 2 * step * (center - corners) / np.linalg.norm(center - corners, axis=1, keepdims=True)
+    x, y = corners[:, 0], corners[:, 1]
+    area = 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+    if area < PAPER_MIN_AREA * gray.size:
+        return None
+    return corners
+
+
+def warp_paper(image, corners):
+    """Map the paper quadrilateral onto an upright rectangle"""
+    tl, tr, br, bl = corners
+    width = int(max(np.linalg.norm(tr - tl), np.linalg.norm(br - bl)))
+    height = int(max(np.linalg.norm(bl - tl), np.linalg.norm(br - tr)))
+    # Image.QUAD takes the source corners as upper-left, lower-left, lower-right, upper-right
+    quad = (*tl, *bl, *br, *tr)
+    return image.transform((width, height), Image.QUAD, quad, resample=Image.BICUBIC)
+
+
+def estimate_skew(gray):
+    """Text angle in degrees, counter-clockwise like Image.rotate (rotate by minus this to
+    straighten), from row projection profiles"""
+    scale = SKEW_ANALYSIS_SIDE / max(gray.shape)
+    if scale < 1:
+        gray = np.asarray(Image.fromarray(gray).resize(
+            (max(1, int(gray.shape[1] * scale)), max(1, int(gray.shape[0] * scale)))))
+    ys, xs = np.nonzero(gray < otsu_threshold(gray))
+    if ys.size < 100:
+        return 0.0
+    xs = xs - gray.shape[1] / 2.0
+    ys = ys - gray.shape[0] / 2.0
+    offset = np.hypot(*gray.shape)
+
+    def score(angles):
+        rad = np.deg2rad(angles)[:, None]
+        rows = np.round(ys * np.cos(rad) + xs * np.sin(rad) + offset).astype(np.int64)
+        return [np.square(np.bincount(r)).sum() for r in rows]
+
+    coarse = np.arange(-MAX_SKEW_DEGREES, MAX_SKEW_DEGREES + 0.5, 1.0)
+    best = coarse[int(np.argmax(score(coarse)))]
+    fine = np.arange(best - 1.0, best + 1.05, 0.1)
+    return float(fine[int(np.argmax(score(fine)))])
+
+
+def adaptive_threshold(gray):
+    """Binarize against the local mean (Bradley-Roth); True = ink"""
+    h, w = gray.shape
+    half = max(7, min(h, w) // 30) // 2
+    integral = np.pad(gray.astype(np.float64).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    y0 = np.clip(np.arange(h) - half, 0, h)
+    y1 = np.clip(np.arange(h) + half + 1, 0, h)
+    x0 = np.clip(np.arange(w) - half, 0, w)
+    x1 = np.clip(np.arange(w) + half + 1, 0, w)
+    sums = (integral[y1][:, x1] - integral[y0][:, x1] - integral[y1][:, x0] + integral[y0][:, x0])
+    area = (y1 - y0)[:, None] * (x1 - x0)[None, :]
+    return gray * area < sums * (1.0 - THRESHOLD_SENSITIVITY)
+
+
+def ink_bbox(ink):
+    """Bounding box (left, top, right, bottom) of the ink plus a margin, or None"""
+    rows, cols = np.nonzero(ink.any(axis=1))[0], np.nonzero(ink.any(axis=0))[0]
+    if rows.size == 0:
+        return None
+    h, w = ink.shape
+    pad_y, pad_x = int(h * CROP_MARGIN), int(w * CROP_MARGIN)
+    return (max(0, cols[0] - pad_x), max(0, rows[0] - pad_y),
+            min(w, cols[-1] + 1 + pad_x), min(h, rows[-1] + 1 + pad_y))
+
+
+def preprocess_image(img_bytes):
+    """Clean one photo. Returns {"image": JPEG bytes for the vision call,
+    "ocr_image": PNG bytes of the binarized page, "steps": what was done}"""
+    steps = {}
+    image = Image.open(io.BytesIO(img_bytes))
+    steps["original_size"] = list(image.size)
+
+    steps["exif_rotated"] = image.getexif().get(0x0112, 1) != 1
+    image = ImageOps.exif_transpose(image).convert("L")
+    image.thumbnail((PREPROCESS_MAX_SIDE, PREPROCESS_MAX_SIDE))
+
+    corners = find_paper(np.asarray(image))
+    if corners is not None:
+        image = warp_paper(image, corners)
+    steps["perspective_corrected"] = corners is not None
+
+    angle = estimate_skew(np.asarray(image))
+    if abs(angle) >= 0.2:
+        image = image.rotate(-angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    steps["deskew_degrees"] = round(-angle, 1)
+
+    ink = adaptive_threshold(np.asarray(image.filter(ImageFilter.GaussianBlur(0.7))))
+    box = ink_bbox(ink)
+    if box:
+        image = image.crop(box)
+        ink = ink[box[1]:box[3], box[0]:box[2]]
+    steps["size"] = list(image.size)
+
+    vision = io.BytesIO()
+    ImageOps.autocontrast(image, cutoff=1).save(vision, format="JPEG", quality=JPEG_QUALITY)
+    ocr = io.BytesIO()
+    Image.fromarray(~ink).convert("1").save(ocr, format="PNG")
+    return {"image": vision.getvalue(), "ocr_image": ocr.getvalue(), "steps": steps}
+
+
+def _pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+        return _POOL
+
+
+def preprocess(img_bytes):
+    """preprocess_image() in the process pool (or inline when USE_POOL is off)"""
+    if not USE_POOL:
+        return preprocess_image(img_bytes)
+    return _pool().submit(preprocess_image, img_bytes).result()
+
+
+def shutdown():
+    """Stop the worker processes (if any were started)"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(wait=False, cancel_futures=True)
+            _POOL = None
@@ -0,0 +1,460 @@
+"""
+AI provider registry and API key pool
+
+Each provider registers its call function (and a client factory) with
+@register. Provider libraries (requests, openai, anthropic) are imported
+the first time a provider is used and API keys are read from the
+environment the first time the pool is needed, so importing this module
+costs next to nothing. warm_up() does all of that ahead of time, for
+servers that want it done before they report ready.
+
+The key pool is shared by the web service and the command line; keys are
+handed out round-robin across every configured provider.
+"""
+import os
+import time
+import threading
+
+from app.generation import (get_profile, gemini_generation_config, openai_params,
+                            anthropic_params, openai_reasoning_tokens)
+from app.metrics import stage
+from app.extraction import page_labels, MAX_IMAGES_PER_CALL
+from app import media
+from app.transport import Base64, JsonBody, as_base64
+
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com").rstrip("/")
+
+# name -> {"call": fn(content, filename, api_key, profile), "env_prefix": str, "client": fn(api_key)}
+PROVIDERS = {}
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_NEXT_INDEX = 0
+_CLIENTS = {}
+
+
+def register(name, env_prefix, client=None):
+    """Register a provider call function; keys come from <env_prefix>_API_KEY[_1..10]"""
+    def decorator(fn):
+        PROVIDERS[name] = {"call": fn, "env_prefix": env_prefix, "client": client}
+        return fn
+    return decorator
+
+
+def load_api_keys():
+    """(Re)load all available API keys into the pool"""
+    global _POOL, _NEXT_INDEX
+    pool = []
+    for name, spec in PROVIDERS.items():
+        prefix = spec["env_prefix"]
+        for var in [f"{prefix}_API_KEY"] + [f"{prefix}_API_KEY_{i}" for i in range(1, 11)]:
+            key = os.getenv(var)
+            if key:
+                pool.append({"provider": name, "key": key})
+    with _POOL_LOCK:
+        _POOL, _NEXT_INDEX = pool, 0
+    print(f"⚡ Loaded {len(pool)} API Key(s) for Load Balancing")
+    return pool
+
+
+def api_pool():
+    """The key pool, loaded from the environment on first use"""
+    if _POOL is None:
+        load_api_keys()
+    return _POOL
+
+
+def get_next_provider():
+    """Round-robin selection of API provider"""
+    global _NEXT_INDEX
+    pool = api_pool()
+    if not pool:
+        return None
+    # Pipelined / threaded callers come in from several threads at once
+    with _POOL_LOCK:
+        provider = pool[_NEXT_INDEX % len(pool)]
+        _NEXT_INDEX = (_NEXT_INDEX + 1) % len(pool)
+    return provider
+
+
+def get_client(provider, api_key):
+    """Cached client object for a provider + key (created on first use)"""
+    factory = PROVIDERS[provider]["client"]
+    if factory is None:
+        return None
+    with _POOL_LOCK:
+        client = _CLIENTS.get((provider, api_key))
+    if client is None:
+        client = factory(api_key)
+        with _POOL_LOCK:
+            client = _CLIENTS.setdefault((provider, api_key), client)
+    return client
+
+
+def warm_up():
+    """Load the key pool and create every provider client now instead of on the first request.
+    Returns {provider: number of clients ready}."""
+    ready = {}
+    for entry in api_pool():
+        try:
+            get_client(entry["provider"], entry["key"])
+            ready[entry["provider"]] = ready.get(entry["provider"], 0) + 1
+        except ImportError as e:
+            print(f"⚠️ Could not prepare {entry['provider']} client: {e}")
+    return ready
+
+
+def clean_json_string(json_str):
+    """Clean AI output to get valid JSON"""
+    json_str = json_str.replace("```json", "").replace("```", "")
+    start = json_str.find("{")
+    end = json_str.rfind("}")
+    if start != -1 and end != -1:
+        json_str = json_str[start:end+1]
+    return json_str
+
+
+INSTRUCTIONS = """
+    INSTRUCTIONS:
+    1. **EXTRACTION**: Extract all visible data. If a Total is clearly the final amount to be paid, extract it.
+    2. **PAGE MAPPING**: Assign items to their correct pages based on visual markers.
+    3. **ANALYSIS**: Flag visual anomalies (edits, fonts) and duplicate items.
+
+    TASK:
+    1. Extract Header Info.
+    2. Extract Line Items (Description, Qty, Unit Price, Amount) and any subtotal printed on each page.
+    3. Extract Financial Totals (Subtotal, Tax, Total).
+"""
+
+
+def document_schema(filename, page_count):
+    """The JSON structure expected for one document"""
+    return f"""    {{
+        "file_info": {{
+            "file_name": "{filename}",
+            "page_count": {page_count},
+            "document_type": "Invoice/Receipt/Bill/Statement",
+            "document_title": "string",
+            "printed_on": "string or null"
+        }},
+        "header": {{
+            "id": "string",
+            "date": "YYYY-MM-DD",
+            "vendor_name": "string",
+            "hospital_name": "string or null",
+            "recipient_name": "string"
+        }},
+        "pages": [
+            {{
+                "page_number": 1,
+                "line_items": [
+                    {{"description": "string", "quantity": number, "unit_price": number, "amount": number}}
+                ],
+                "page_subtotal": number (subtotal printed on the page) or null,
+                "page_anomalies": ["list", "of", "visual", "issues"]
+            }}
+        ],
+        "financials": {{
+            "subtotal": number,
+            "tax": number,
+            "extracted_total": number
+        }},
+        "fraud_analysis": {{
+            "risk_level": "LOW/MEDIUM/HIGH",
+            "pixel_anomalies_detected": boolean,
+            "duplicates_detected": boolean,
+            "flags": ["list", "of", "issues"],
+            "reasoning": "detailed explanation"
+        }}
+    }}"""
+
+
+def get_common_prompt(filename, page_count, page_numbers=None):
+    selection = ""
+    if page_numbers and len(page_numbers) < page_count:
+        # Only part of the document is attached; keep the real page numbers in the output
+        selection = (f"\n    ONLY PAGES {', '.join(map(str, page_numbers))} OF {page_count} ARE INCLUDED. "
+                     "Use these page numbers in \"pages\" and do not guess at the missing pages.\n")
+    return f"""
+    You are an expert Forensic Auditor. Analyze this document (Filename: {filename}, Pages: {page_count}).
+{selection}{INSTRUCTIONS}
+    OUTPUT JSON STRUCTURE:
+{document_schema(filename, page_count)}
+    """
+
+
+def get_packed_prompt(documents):
+    """Prompt for several small documents in one call; documents is [(filename, page_count)]"""
+    listing = "\n".join(f"    DOCUMENT {i}: (Filename: {name}, Pages: {pages})"
+                        for i, (name, pages) in enumerate(documents, 1))
+    return f"""
+    You are an expert Forensic Auditor. This request contains {len(documents)} SEPARATE documents.
+    Analyze each one on its own: never move line items, totals or flags from one document to another.
+
+    DOCUMENTS IN THIS REQUEST:
+{listing}
+
+    Images are labelled "PAGE n OF DOCUMENT i" and extracted text is under "=== DOCUMENT i ===".
+{INSTRUCTIONS}
+    OUTPUT JSON STRUCTURE (one entry per document, in the order listed, each with its
+    "document_index" and the structure below):
+    {{
+        "documents": [
+            {{"document_index": 1, ...}},
+            ...
+        ]
+    }}
+
+    STRUCTURE OF EACH ENTRY:
+{document_schema("string", "number")}
+    """
+
+
+def get_reread_prompt(filename, page_count, findings):
+    """Prompt for re-reading pages whose numbers did not add up; findings as app.reconcile.check_pages"""
+    pages = ", ".join(str(f["page_number"]) for f in findings)
+    problems = "\n".join(f"    - Page {f['page_number']}: {'; '.join(f['issues'])}" for f in findings)
+    return f"""
+    You are an expert Forensic Auditor. Re-read part of this document (Filename: {filename}, Pages: {page_count}).
+    PAGES TO RE-READ: {pages} (only these pages are included).
+
+    An earlier extraction of these pages did not add up:
+{problems}
+
+    Read every line item on these pages again, digit by digit (Description, Qty, Unit Price, Amount),
+    and the subtotal printed on each page, if any. Report what is printed, even where it does not add
+    up; never change a number to make the math work.
+
+    OUTPUT JSON STRUCTURE:
+    {{
+        "pages": [
+            {{
+                "page_number": number,
+                "line_items": [
+                    {{"description": "string", "quantity": number, "unit_price": number, "amount": number}}
+                ],
+                "page_subtotal": number (subtotal printed on the page) or null,
+                "page_anomalies": ["list", "of", "visual", "issues"]
+            }}
+        ]
+    }}
+    """
+
+
+def call_images(content):
+    return content["images"][:content.get("max_images", MAX_IMAGES_PER_CALL)]
+
+
+def call_prompt(content, filename):
+    """The prompt for a call: get_common_prompt, unless the content brings its own (packed calls)"""
+    return content.get("prompt") or get_common_prompt(filename, content['page_count'], content.get("page_numbers"))
+
+
+# --- Providers (registration order is the round-robin order) ---
+
+def _requests_session(api_key):
+    import requests
+    return requests.Session()
+
+def _openai_client(api_key):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+def _anthropic_client(api_key):
+    import anthropic
+    return anthropic.Anthropic(api_key=api_key)
+
+
+@register("gemini", "GEMINI", client=_requests_session)
+def call_gemini(content, filename, api_key, profile=None):
+    profile = profile or get_profile()
+    print(f"🤖 Analyzing {filename} with Gemini 2.5 Flash (Key: ...{api_key[-4:]})...")
+    url = f"{GEMINI_BASE_URL}/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}"
+    session = get_client("gemini", api_key)
+
+    images = call_images(content)
+    refs, digests = media.references("gemini", api_key, images, session, GEMINI_BASE_URL)
+
+    def build_body(refs):
+        parts = [{"text": call_prompt(content, filename)}]
+
+        for page, image, ref in zip(page_labels(content), images, refs):
+            parts.append({"text": f"--- VISUAL DATA FOR PAGE {page} ---"})
+            if ref:
+                parts.append({"file_data": {"mime_type": "image/jpeg", "file_uri": ref}})
+            else:
+                parts.append({"inline_data": {"mime_type": "image/jpeg", "data": Base64(image)}})
+
+        if content["text"]:
+            parts.append({"text": f"EXTRACTED TEXT CONTEXT:\n{content['text']}"})
+
+        # Pages are base64-encoded into the socket while sending (app/transport.py); the body
+        # can be iterated again for a retry
+        return JsonBody({"contents": [{"parts": parts}], "generationConfig": gemini_generation_config(profile)})
+
+    body = build_body(refs)
+
+    # Retry Logic
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            response = session.post(
+                url, headers={'Content-Type': 'application/json'},
+                data=body,
+                timeout=120
+            )
+            if response.status_code == 200:
+                res_json = response.json()
+                text = res_json['candidates'][0]['content']['parts'][0]['text']
+                usage = res_json.get('usageMetadata', {})
+                token_info = {
+                    "prompt_tokens": usage.get('promptTokenCount', 0),
+                    "output_tokens": usage.get('candidatesTokenCount', 0),
+                    "reasoning_tokens": usage.get('thoughtsTokenCount', 0),
+                    "total_tokens": usage.get('totalTokenCount', 0),
+                    "model": "gemini-2.5-flash",
+                    "profile": profile["name"]
+                }
+                return text, token_info
+            elif response.status_code == 429:
+                print(f"   ⏳ Rate limit hit. Waiting 5s... (Attempt {attempt+1}/{max_retries})")
+                with stage("provider_backoff"):
+                    time.sleep(5)
+            elif response.status_code in (400, 403, 404) and any(refs):
+                # An uploaded page expired or was deleted: forget it and send the pages inline
+                print(f"   ⚠️ Gemini rejected uploaded pages ({response.status_code}); sending them inline")
+                media.forget("gemini", api_key, digests)
+                refs = [None] * len(images)
+                body = build_body(refs)
+            else:
+                print(f"❌ Gemini Error: {response.text}")
+                return None, None
+        except Exception as e:
+            print(f"   ⚠️ Request Failed: {e}. Retrying...")
+            with stage("provider_backoff"):
+                time.sleep(2)
+
+    return None, None
+
+
+@register("openai", "OPENAI", client=_openai_client)
+def call_openai(content, filename, api_key, profile=None):
+    profile = profile or get_profile()
+    print(f"🤖 Analyzing {filename} with GPT-4o (Key: ...{api_key[-4:]})...")
+    try:
+        client = get_client("openai", api_key)
+
+        messages = [
+            {"role": "system", "content": "You are a JSON-only extraction API."},
+            {"role": "user", "content": []}
+        ]
+
+        user_content = messages[1]["content"]
+        user_content.append({"type": "text", "text": call_prompt(content, filename)})
+
+        for page, image in zip(page_labels(content), call_images(content)):
+            user_content.append({"type": "text", "text": f"--- PAGE {page} ---"})
+            user_content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:image/jpeg;base64,{as_base64(image)}"}
+            })
+
+        if content["text"]:
+            user_content.append({"type": "text", "text": f"TEXT CONTEXT:\n{content['text']}"})
+
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            response_format={"type": "json_object"},
+            **openai_params(profile, "gpt-4o")
+        )
+
+        text = response.choices[0].message.content
+        usage = response.usage
+        token_info = {
+            "prompt_tokens": usage.prompt_tokens,
+            "output_tokens": usage.completion_tokens,
+            "reasoning_tokens": openai_reasoning_tokens(usage),
+            "total_tokens": usage.total_tokens,
+            "model": "gpt-4o",
+            "profile": profile["name"]
+        }
+        return text, token_info
+    except Exception as e:
+        print(f"❌ OpenAI Error: {e}")
+        return None, None
+
+
+@register("anthropic", "ANTHROPIC", client=_anthropic_client)
+def call_anthropic(content, filename, api_key, profile=None):
+    profile = profile or get_profile()
+    print(f"🤖 Analyzing {filename} with Claude 3.5 Sonnet (Key: ...{api_key[-4:]})...")
+    try:
+        client = get_client("anthropic", api_key)
+        images = call_images(content)
+        refs, digests = media.references("anthropic", api_key, images)
+
+        def create(refs):
+            message_content = []
+
+            # Add Images (labelled when several documents share the call)
+            for page, image, ref in zip(page_labels(content), images, refs):
+                if content.get("image_labels"):
+                    message_content.append({"type": "text", "text": f"--- PAGE {page} ---"})
+                source = ({"type": "file", "file_id": ref} if ref else
+                          {"type": "base64", "media_type": "image/jpeg", "data": as_base64(image)})
+                message_content.append({"type": "image", "source": source})
+
+            # Add Text Prompt
+            prompt = call_prompt(content, filename)
+            if content["text"]:
+                prompt += f"\n\nTEXT CONTEXT:\n{content['text']}"
+
+            message_content.append({"type": "text", "text": prompt})
+
+            params = dict(model="claude-3-5-sonnet-20240620",
+                          messages=[{"role": "user", "content": message_content}],
+                          **anthropic_params(profile, "claude-3-5-sonnet-20240620"))
+            if any(refs):
+                return client.beta.messages.create(betas=[media.ANTHROPIC_FILES_BETA], **params)
+            return client.messages.create(**params)
+
+        try:
+            response = create(refs)
+        except Exception as e:
+            if not any(refs) or getattr(e, "status_code", None) not in (400, 403, 404):
+                raise
+            # An uploaded page was deleted: forget it and send the pages inline
+            print(f"   ⚠️ Anthropic rejected uploaded pages ({e.status_code}); sending them inline")
+            media.forget("anthropic", api_key, digests)
+            response = create([None] * len(images))
+
+        # Skip thinking blocks (present when the profile enables extended thinking)
+        text = next(block.text for block in response.content if block.type == "text")
+        usage = response.usage
+        token_info = {
+            "prompt_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "reasoning_tokens": 0,  # Anthropic bills thinking inside output_tokens
+            "total_tokens": usage.input_tokens + usage.output_tokens,
+            "model": "claude-3-5-sonnet",
+            "profile": profile["name"]
+        }
+        return text, token_info
+    except Exception as e:
+        print(f"❌ Anthropic Error: {e}")
+        return None, None
+
+
+def analyze_document(content, filename, profile=None):
+    """Route to available AI provider using Round-Robin"""
+    profile = get_profile(profile)
+    provider_info = get_next_provider()
+
+    if not provider_info:
+        return None, None
+
+    spec = PROVIDERS.get(provider_info["provider"])
+    if not spec:
+        return None, None
+    return spec["call"](content, filename, provider_info["key"], profile)
@@ -0,0 +1,186 @@
+"""
+Reconciliation: find the pages whose numbers do not add up and re-extract only those
+
+validate_math only says whether the line items add up to the bill's
+total. Before that check runs, every page of the AI's answer is checked
+on its own:
+
+- each line item: quantity x unit_price against its amount
+- the page: the sum of its amounts against the page subtotal printed on
+  it ("page_subtotal" in the answer), or against the running total when
+  the bill carries subtotals forward from page to page
+
+When a page disagrees with its printed subtotal, or when the bill's total
+does not match and the page has inconsistent lines, that page is
+inconsistent. Up to RECONCILE_MAX_PAGES of them are sent back to the
+provider in one call with a focused prompt: just those page images and
+their text, and what did not add up. A re-read page replaces the original
+only when it has fewer inconsistencies, so a correction on a 20-page bill
+costs one or two pages of tokens instead of the whole document.
+
+The outcome is kept in result["reconciliation"] (the pages found
+inconsistent, what changed, and the tokens of the extra call). Results
+without page-level problems are left as they were. Set RECONCILE=false to
+only report, never re-extract.
+"""
+import os
+import re
+import copy
+import json
+
+from app.validation import validate_math, MATH_MATCH_TOLERANCE
+
+RECONCILE = os.getenv("RECONCILE", "true").lower() == "true"
+RECONCILE_MAX_PAGES = int(os.getenv("RECONCILE_MAX_PAGES", "3"))
+LINE_RELATIVE_TOLERANCE = 0.005  # rounding of quantity x unit price on large amounts
+
+
+def _number(value):
+    """float of a number or numeric string ("1,234.50"), else None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.replace(",", "").strip())
+        except ValueError:
+            return None
+    return None
+
+
+def line_issues(items, tolerance=None):
+    """Line items whose quantity x unit_price is not their amount"""
+    tolerance = MATH_MATCH_TOLERANCE if tolerance is None else tolerance
+    issues = []
+    for i, item in enumerate(items or [], 1):
+        if not isinstance(item, dict):
+            continue
+        qty, price, amount = (_number(item.get(k)) for k in ("quantity", "unit_price", "amount"))
+        if qty is None or price is None or amount is None:
+            continue
+        expected = qty * price
+        if abs(expected - amount) > max(tolerance, LINE_RELATIVE_TOLERANCE * abs(amount)):
+            issues.append(f"line {i} \"{item.get('description', '')}\": {qty:g} x {price:.2f} = "
+                          f"{expected:.2f} but amount is {amount:.2f}")
+    return issues
+
+
+def _page_sum(page):
+    return sum(_number(item.get("amount")) or 0.0 for item in page.get("line_items") or []
+               if isinstance(item, dict))
+
+
+def check_pages(result, tolerance=None):
+    """Per-page findings: [{"page_number", "issues": [...], "subtotal_mismatch": bool}] for the pages
+    with any issue, in page order"""
+    tolerance = MATH_MATCH_TOLERANCE if tolerance is None else tolerance
+    pages = [p for p in result.get("pages") or [] if isinstance(p, dict) and not p.get("known_page")]
+    pages.sort(key=lambda p: p.get("page_number") if isinstance(p.get("page_number"), int) else 0)
+    findings, running = [], 0.0
+    for page in pages:
+        issues = line_issues(page.get("line_items"), tolerance)
+        page_sum = _page_sum(page)
+        running += page_sum
+        printed = _number(page.get("page_subtotal"))
+        # A printed figure may be this page's subtotal or the total carried forward
+        subtotal_mismatch = (printed is not None and abs(printed - page_sum) > tolerance
+                             and abs(printed - running) > tolerance)
+        if subtotal_mismatch:
+            issues.append(f"items add up to {page_sum:.2f} but the printed page subtotal is {printed:.2f}")
+        if issues:
+            findings.append({"page_number": page.get("page_number"), "issues": issues,
+                             "subtotal_mismatch": subtotal_mismatch})
+    return findings
+
+
+def page_text(content, pages):
+    """The extracted text of the given pages (PDF text is marked "--- PAGE n ---")"""
+    text = content.get("text") or ""
+    parts = re.split(r"\n--- PAGE (\d+) ---\n", text)
+    if len(parts) == 1:
+        return text
+    by_page = dict(zip(map(int, parts[1::2]), parts[2::2]))
+    return "".join(f"\n--- PAGE {p} ---\n{by_page[p]}" for p in pages if p in by_page)
+
+
+def focused_content(content, filename, findings):
+    """Content for a call that re-reads only the pages in findings"""
+    from app.extraction import page_labels
+    from app.providers import get_reread_prompt
+    pages = [f["page_number"] for f in findings]
+    labels = page_labels(content)
+    images = [img for label, img in zip(labels, content.get("images") or []) if label in pages]
+    return {
+        "images": images,
+        "image_labels": [label for label in labels if label in pages],
+        "max_images": len(images),
+        "text": page_text(content, pages),
+        "page_count": content.get("page_count", 1),
+        "prompt": get_reread_prompt(filename, content.get("page_count", 1), findings),
+    }
+
+
+def _reread(content, filename, findings, profile):
+    """One provider call for the inconsistent pages: ({page number: page}, token_info)"""
+    from app.providers import analyze_document, clean_json_string
+    json_str, token_info = analyze_document(focused_content(content, filename, findings), filename, profile)
+    if not json_str:
+        return {}, token_info
+    try:
+        data = json.loads(clean_json_string(json_str))
+    except ValueError:
+        return {}, token_info
+    pages = data.get("pages") if isinstance(data, dict) else None
+    wanted = {f["page_number"] for f in findings}
+    return {p["page_number"]: p for p in pages or []
+            if isinstance(p, dict) and p.get("page_number") in wanted}, token_info
+
+
+def reconcile(result, content=None, filename=None, profile=None):
+    """Check the answer page by page and re-extract the inconsistent pages (see the module docstring).
+    Runs before validate_math; returns the result."""
+    findings = check_pages(result)
+    if not findings:
+        return result
+    _, match_status = validate_math(copy.deepcopy(result))
+    # Bad lines on a bill that adds up are usually discounts or rounding; a wrong subtotal never is
+    targets = [f for f in findings if f["subtotal_mismatch"] or match_status == "MISMATCH"]
+    report = {"inconsistent_pages": findings, "reextracted_pages": [], "corrected_pages": []}
+    result["reconciliation"] = report
+
+    targets = [f for f in targets if isinstance(f["page_number"], int)][:RECONCILE_MAX_PAGES]
+    if not (RECONCILE and targets and content and (content.get("images") or content.get("text"))):
+        return result
+
+    print(f"   🔎 Re-reading page(s) {', '.join(str(f['page_number']) for f in targets)} that do not add up")
+    reread, token_info = _reread(content, filename or "document", targets, profile)
+    report["reextracted_pages"] = [f["page_number"] for f in targets]
+    if token_info:
+        report["token_usage"] = token_info
+
+    by_number = {p.get("page_number"): p for p in result.get("pages") or [] if isinstance(p, dict)}
+    for finding in targets:
+        number = finding["page_number"]
+        page, new = by_number.get(number), reread.get(number)
+        if page is None or new is None:
+            continue
+        # Judged in place, so a carried-forward subtotal sees the pages before it
+        trial = {"pages": [new if p is page else p for p in result["pages"] if isinstance(p, dict)]}
+        remaining = next((f["issues"] for f in check_pages(trial) if f["page_number"] == number), [])
+        if len(remaining) >= len(finding["issues"]):
+            continue
+        report["corrected_pages"].append({
+            "page_number": number,
+            "issues_before": finding["issues"],
+            "issues_after": remaining,
+            "amount_before": round(_page_sum(page), 2),
+            "amount_after": round(_page_sum(new), 2),
+        })
+        page["line_items"] = new.get("line_items") or []
+        if "page_subtotal" in new:
+            page["page_subtotal"] = new["page_subtotal"]
+        for anomaly in new.get("page_anomalies") or []:
+            if anomaly not in page.setdefault("page_anomalies", []):
+                page["page_anomalies"].append(anomaly)
+    return result
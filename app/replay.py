@@ -0,0 +1,278 @@
+"""
+Replay engine: re-run parsing, math validation and the local fraud rules
+over stored results, without calling the AI again
+
+Every result keeps the provider's raw answer under "raw_response". A
+replay parses that again and runs validate_math (with the tolerances
+being tried), the pixel-forensics merge (the per-page reports are already
+in the result) and Benford scoring, then compares the outcome with what
+is stored. The raw answer is what the AI said before anything was done to
+it, so the pages changed afterwards are taken from the stored result:
+boilerplate pages the page index put back ("known_page") and pages that
+reconciliation re-extracted (with the "reconciliation" report itself).
+Results written before raw responses were kept are replayed
+from the stored result with the system-added fields stripped; those can
+pick up new flags but cannot drop a risk level the old rules raised.
+
+Cross-document duplicate findings depend on the order documents arrived
+in, so they are carried over from the stored result rather than
+recomputed. Benford baselines and tariff price statistics are only read,
+never updated.
+
+Files are spread over a process pool in chunks and workers return only a
+small diff entry per document, so a store of a few hundred thousand
+results takes minutes.
+"""
+import os
+import copy
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+STORE_RAW_RESPONSE = os.getenv("STORE_RAW_RESPONSE", "true").lower() == "true"
+REPLAY_CHUNK_SIZE = 256
+
+# Fields and flags added by the system (not by the AI) to a stored result
+SYSTEM_FINANCIAL_FIELDS = ("calculated_total", "is_match")
+SYSTEM_FRAUD_FIELDS = ("math_mismatch_detected", "pixel_forensics", "benford_analysis", "tariff_analysis")
+SYSTEM_FLAG_PREFIXES = ("Math mismatch:", "Pixel forensics:", "Benford's law:", "Amount digits deviate",
+                        "Unit price outlier:")
+DUPLICATE_FLAG_PREFIXES = ("Cross-document", "Possible re-submitted bill:", "... and ")
+
+# Per-process state set by _init_worker
+_OPTIONS = {}
+_ENGINE = None
+
+
+def attach_raw_response(result, raw_response):
+    """Keep the provider's unparsed answer with the result (if enabled)"""
+    if STORE_RAW_RESPONSE and raw_response is not None:
+        result["raw_response"] = raw_response
+    return result
+
+
+def _page_number(page):
+    return page.get("page_number") if isinstance(page.get("page_number"), int) else 0
+
+
+def restore_pages(output, stored):
+    """Put the pages changed after the AI answered (reattached boilerplate pages, pages corrected
+    by reconciliation) from the stored result into a parsed raw answer"""
+    reconciliation = stored.get("reconciliation")
+    corrected = {c.get("page_number") for c in (reconciliation or {}).get("corrected_pages") or []}
+    kept = {p.get("page_number"): p for p in stored.get("pages") or []
+            if isinstance(p, dict) and (p.get("known_page") or p.get("page_number") in corrected)}
+    if kept:
+        pages = [p for p in output.get("pages") or []
+                 if not (isinstance(p, dict) and p.get("page_number") in kept)]
+        pages.extend(copy.deepcopy(list(kept.values())))
+        pages.sort(key=lambda p: _page_number(p) if isinstance(p, dict) else 0)
+        output["pages"] = pages
+    if reconciliation:
+        output["reconciliation"] = copy.deepcopy(reconciliation)
+    return output
+
+
+def model_output(stored):
+    """What the AI answered for a stored result, with the later page changes kept:
+    (parsed output, source)"""
+    raw = stored.get("raw_response")
+    if raw:
+        from app.providers import clean_json_string
+        return restore_pages(json.loads(clean_json_string(raw)), stored), "raw_response"
+
+    output = copy.deepcopy(stored)
+    for key in ("token_usage", "processing_metadata", "raw_response"):
+        output.pop(key, None)
+    financials = output.get("financials") or {}
+    for key in SYSTEM_FINANCIAL_FIELDS:
+        financials.pop(key, None)
+    fraud = output.get("fraud_analysis") or {}
+    for key in SYSTEM_FRAUD_FIELDS + ("cross_document_duplicates",):
+        fraud.pop(key, None)
+    if "flags" in fraud:
+        fraud["flags"] = [f for f in fraud["flags"]
+                          if not str(f).startswith(SYSTEM_FLAG_PREFIXES + DUPLICATE_FLAG_PREFIXES)]
+    return output, "stored_result"
+
+
+def _carry_duplicates(stored_fraud, fraud):
+    """Copy cross-document duplicate findings (and their risk effect) from the stored result"""
+    flags = [f for f in stored_fraud.get("flags", []) if str(f).startswith(DUPLICATE_FLAG_PREFIXES)]
+    if not stored_fraud.get("cross_document_duplicates") and not flags:
+        return fraud
+    fraud.setdefault("flags", []).extend(f for f in flags if f not in fraud.get("flags", []))
+    fraud["duplicates_detected"] = True
+    fraud["cross_document_duplicates"] = stored_fraud.get("cross_document_duplicates", len(flags))
+    if any(str(f).startswith("Possible re-submitted bill:") for f in flags):
+        fraud["risk_level"] = "HIGH"
+    elif fraud.get("risk_level") in (None, "LOW"):
+        fraud["risk_level"] = "MEDIUM"
+    return fraud
+
+
+def replay_result(stored, engine=None, tolerance=None, risk_threshold=None):
+    """Re-run validation and the local fraud rules for one stored result.
+    Returns (new result, source of the model output)."""
+    from app.validation import validate_math
+    from app.forensics import merge_forensics
+
+    result, source = model_output(stored)
+    if stored.get("token_usage"):
+        result = {"token_usage": stored["token_usage"], **result}
+
+    result, _ = validate_math(result, tolerance, risk_threshold)
+    stored_fraud = stored.get("fraud_analysis") or {}
+    reports = (stored_fraud.get("pixel_forensics") or {}).get("pages")
+    result = merge_forensics(result, reports)
+    if engine:
+        result = engine.annotate(result, update=False)
+    from app.tariff import default_index
+    result = default_index().annotate(result, update=False)
+    result["fraud_analysis"] = _carry_duplicates(stored_fraud, result.get("fraud_analysis", {}))
+
+    if "processing_metadata" in stored:
+        result["processing_metadata"] = stored["processing_metadata"]
+    if "raw_response" in stored:
+        result["raw_response"] = stored["raw_response"]
+    return result, source
+
+
+def diff_results(before, after):
+    """What changed between a stored result and its replay (None if nothing relevant)"""
+    fraud_a, fraud_b = before.get("fraud_analysis") or {}, after.get("fraud_analysis") or {}
+    fin_a, fin_b = before.get("financials") or {}, after.get("financials") or {}
+    flags_a, flags_b = fraud_a.get("flags") or [], fraud_b.get("flags") or []
+    entry = {
+        "risk_before": fraud_a.get("risk_level"),
+        "risk_after": fraud_b.get("risk_level"),
+        "match_before": fin_a.get("is_match"),
+        "match_after": fin_b.get("is_match"),
+        "flags_added": [f for f in flags_b if f not in flags_a],
+        "flags_removed": [f for f in flags_a if f not in flags_b],
+    }
+    changed = (entry["risk_before"] != entry["risk_after"] or entry["match_before"] != entry["match_after"]
+               or entry["flags_added"] or entry["flags_removed"])
+    return entry if changed else None
+
+
+def _init_worker(options):
+    global _OPTIONS, _ENGINE
+    _OPTIONS = options
+    from app.benford import BenfordEngine
+    _ENGINE = BenfordEngine(options.get("benford_baseline") or ":memory:")
+
+
+def _write_json(path, data):
+    tmp = f"{path}.replay.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _replay_one(ref, stored):
+    """Replay one result with the worker's options; returns (ref, source, diff, new result, error)"""
+    try:
+        after, source = replay_result(stored, _ENGINE, _OPTIONS.get("tolerance"), _OPTIONS.get("risk_threshold"))
+        return ref, source, diff_results(stored, after), after, None
+    except Exception as e:
+        return ref, None, None, None, str(e)
+
+
+def _replay_file(path):
+    try:
+        with open(path) as f:
+            stored = json.load(f)
+    except Exception as e:
+        return path, None, None, None, f"Unreadable result: {e}"
+    ref, source, diff, after, error = _replay_one(path, stored)
+    if diff and _OPTIONS.get("write"):
+        after["processing_metadata"] = {**(after.get("processing_metadata") or {}),
+                                        "replayed_at": time.time()}
+        _write_json(path, after)
+    # Results stay in the worker; only the diff goes back
+    return ref, source, diff, None, error
+
+
+def _replay_item(item):
+    return _replay_one(*item)
+
+
+def find_results(root):
+    """Every result_*.json below root (a single file is returned as is)"""
+    if os.path.isfile(root):
+        yield root
+        return
+    for entry in os.scandir(root):
+        if entry.is_dir(follow_symlinks=False):
+            yield from find_results(entry.path)
+        elif entry.name.startswith("result_") and entry.name.endswith(".json"):
+            yield entry.path
+
+
+def _run(fn, items, options, workers, engine=None):
+    """Map fn over items in a process pool (inline for workers <= 1, where an
+    existing Benford engine can be reused) and build the report"""
+    global _OPTIONS, _ENGINE
+    started = time.time()
+    report = {
+        "settings": {k: v for k, v in options.items() if k != "write"},
+        "documents": 0, "changed": 0, "errors": 0,
+        "sources": {}, "risk_changes": {}, "match_changes": {},
+        "changes": [], "failures": [],
+    }
+    updated = {}
+    if workers and workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(options,))
+        outcomes = pool.map(fn, items, chunksize=REPLAY_CHUNK_SIZE)
+    else:
+        pool = None
+        if engine:
+            _OPTIONS, _ENGINE = options, engine
+        else:
+            _init_worker(options)
+        outcomes = map(fn, items)
+    try:
+        for ref, source, diff, after, error in outcomes:
+            report["documents"] += 1
+            if error:
+                report["errors"] += 1
+                report["failures"].append({"ref": ref, "error": error})
+                continue
+            report["sources"][source] = report["sources"].get(source, 0) + 1
+            if not diff:
+                continue
+            report["changed"] += 1
+            report["changes"].append({"ref": ref, "source": source, **diff})
+            if diff["risk_before"] != diff["risk_after"]:
+                key = f"{diff['risk_before']} -> {diff['risk_after']}"
+                report["risk_changes"][key] = report["risk_changes"].get(key, 0) + 1
+            if diff["match_before"] != diff["match_after"]:
+                key = f"{diff['match_before']} -> {diff['match_after']}"
+                report["match_changes"][key] = report["match_changes"].get(key, 0) + 1
+            if after is not None:
+                updated[ref] = after
+    finally:
+        if pool:
+            pool.shutdown()
+    elapsed = time.time() - started
+    report["elapsed_s"] = round(elapsed, 2)
+    report["docs_per_s"] = round(report["documents"] / elapsed, 1) if elapsed > 0 else None
+    return report, updated
+
+
+def replay_store(root, workers=None, tolerance=None, risk_threshold=None, benford_baseline=None, write=False):
+    """Replay every result file under root. With write=True changed results are rewritten in place.
+    Returns the diff report."""
+    options = {"tolerance": tolerance, "risk_threshold": risk_threshold,
+               "benford_baseline": benford_baseline, "write": write, "root": root}
+    report, _ = _run(_replay_file, find_results(root), options, workers or os.cpu_count())
+    return report
+
+
+def replay_results(results, workers=None, tolerance=None, risk_threshold=None, benford_baseline=None,
+                   engine=None):
+    """Replay in-memory results ({ref: result}); engine is used when running inline.
+    Returns (diff report, {ref: new result} for the results that changed)."""
+    options = {"tolerance": tolerance, "risk_threshold": risk_threshold, "benford_baseline": benford_baseline}
+    return _run(_replay_item, list(results.items()), options, workers, engine)
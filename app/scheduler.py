@@ -0,0 +1,187 @@
+"""
+Priority and fair-share scheduling of extraction jobs
+
+Jobs come in two priority classes:
+
+- interactive: single uploads (/api/v1/extract), someone is waiting on them
+- batch: /api/v1/batch-extract backlogs, which soak up whatever is left
+
+A fixed number of worker slots (SCHEDULER_WORKERS, normally one per API
+key) feeds the provider key pool. Interactive jobs always go first and
+INTERACTIVE_RESERVED_SLOTS slots are kept free of batch work, so a new
+upload starts right away even behind a 500-file batch. Batch jobs that
+have waited BATCH_AGING_SECONDS are served ahead of new interactive jobs
+so a steady stream of uploads cannot starve a backlog.
+
+Within a class, tenants (the X-Tenant-ID header) share the slots by
+weighted fair queueing: each tenant has its own FIFO and a virtual clock
+that advances by 1/weight per started job; the tenant with the lowest
+clock goes next. Weights come from TENANT_WEIGHTS ("acme=3,beta=1",
+default 1). A tenant that was idle restarts at the current clock, so it
+cannot bank credit while away.
+
+Queue wait per class is exported as a Prometheus histogram, and waits
+over a class's SLO (INTERACTIVE_QUEUE_SLO_SECONDS) are counted.
+"""
+import os
+import time
+import asyncio
+import itertools
+from collections import deque
+
+from app.metrics import QUEUE_WAIT, SCHEDULER_QUEUED, SCHEDULER_RUNNING, QUEUE_SLO_MISSES
+
+PRIORITY_CLASSES = ("interactive", "batch")  # highest priority first
+
+INTERACTIVE_RESERVED_SLOTS = int(os.getenv("INTERACTIVE_RESERVED_SLOTS", "1"))
+BATCH_AGING_SECONDS = float(os.getenv("BATCH_AGING_SECONDS", "120"))
+QUEUE_SLO_SECONDS = {"interactive": float(os.getenv("INTERACTIVE_QUEUE_SLO_SECONDS", "5"))}
+
+
+def parse_weights(spec):
+    """'acme=3,beta=1' -> {"acme": 3.0, "beta": 1.0}"""
+    weights = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            weights[name.strip()] = max(float(value), 0.01)
+    return weights
+
+
+class FairQueue:
+    """Per-tenant FIFOs served in weighted fair order"""
+
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.tenants = {}
+        self.finish = {}
+        self.clock = 0.0
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return sum(len(q) for q in self.tenants.values())
+
+    def push(self, entry):
+        queue = self.tenants.setdefault(entry["tenant"], deque())
+        if not queue:
+            self.finish[entry["tenant"]] = max(self.finish.get(entry["tenant"], 0.0), self.clock)
+        entry["seq"] = next(self._seq)
+        queue.append(entry)
+
+    def pop(self):
+        tenant = min((t for t, q in self.tenants.items() if q),
+                     key=lambda t: (self.finish[t], self.tenants[t][0]["seq"]))
+        entry = self.tenants[tenant].popleft()
+        self.clock = self.finish[tenant]
+        self.finish[tenant] += 1.0 / self.weights.get(tenant, 1.0)
+        if not self.tenants[tenant]:
+            del self.tenants[tenant]
+        return entry
+
+    def oldest_wait(self, now):
+        heads = [q[0]["queued_at"] for q in self.tenants.values() if q]
+        return now - min(heads) if heads else 0.0
+
+    def remove(self, job_id):
+        for tenant, queue in list(self.tenants.items()):
+            for entry in queue:
+                if entry["job_id"] == job_id:
+                    queue.remove(entry)
+                    if not queue:
+                        del self.tenants[tenant]
+                    return entry
+        return None
+
+
+class Scheduler:
+    """Runs submitted coroutines on a fixed number of slots, by priority class and tenant share"""
+
+    def __init__(self, workers, reserved_interactive=INTERACTIVE_RESERVED_SLOTS, tenant_weights=None,
+                 aging_seconds=BATCH_AGING_SECONDS):
+        self.workers = max(1, workers)
+        # With a single slot nothing can be reserved
+        self.batch_slots = max(1, self.workers - max(0, reserved_interactive))
+        self.aging_seconds = aging_seconds
+        weights = parse_weights(os.getenv("TENANT_WEIGHTS")) if tenant_weights is None else tenant_weights
+        self.queues = {name: FairQueue(weights) for name in PRIORITY_CLASSES}
+        self.running = {name: 0 for name in PRIORITY_CLASSES}
+        self._wake = asyncio.Event()
+        self._tasks = []
+
+    def start(self):
+        """Start the worker slots (call from the running event loop)"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job_id, run, priority_class="interactive", tenant=None):
+        """Queue run(queue_wait_seconds) (a coroutine function) for a job"""
+        if priority_class not in self.queues:
+            raise ValueError(f"Unknown priority class '{priority_class}'")
+        self.queues[priority_class].push({
+            "job_id": job_id, "run": run, "priority_class": priority_class,
+            "tenant": tenant or "default", "queued_at": time.monotonic(),
+        })
+        SCHEDULER_QUEUED.labels(priority_class).inc()
+        self._wake.set()
+
+    def cancel(self, job_id):
+        """Drop a job that has not started yet; returns True if it was queued"""
+        for name, queue in self.queues.items():
+            if queue.remove(job_id):
+                SCHEDULER_QUEUED.labels(name).dec()
+                return True
+        return False
+
+    def _next(self):
+        now = time.monotonic()
+        interactive, batch = self.queues["interactive"], self.queues["batch"]
+        batch_ready = len(batch) > 0 and self.running["batch"] < self.batch_slots
+        if batch_ready and batch.oldest_wait(now) >= self.aging_seconds:
+            return batch.pop()
+        if len(interactive):
+            return interactive.pop()
+        if batch_ready:
+            return batch.pop()
+        return None
+
+    async def _worker(self):
+        while True:
+            entry = self._next()
+            if entry is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            name = entry["priority_class"]
+            wait = time.monotonic() - entry["queued_at"]
+            SCHEDULER_QUEUED.labels(name).dec()
+            QUEUE_WAIT.labels(name).observe(wait)
+            if name in QUEUE_SLO_SECONDS and wait > QUEUE_SLO_SECONDS[name]:
+                QUEUE_SLO_MISSES.labels(name).inc()
+
+            self.running[name] += 1
+            SCHEDULER_RUNNING.labels(name).inc()
+            try:
+                await entry["run"](wait)
+            except Exception as e:
+                print(f"Scheduled job {entry['job_id']} crashed: {e}")
+            finally:
+                self.running[name] -= 1
+                SCHEDULER_RUNNING.labels(name).dec()
+                # A freed batch slot may unblock a waiting worker
+                self._wake.set()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            name: {"queued": len(queue), "running": self.running[name],
+                   "oldest_wait_s": round(queue.oldest_wait(now), 2)}
+            for name, queue in self.queues.items()
+        }
@@ -0,0 +1,239 @@
+"""
+Consolidated output sink for batch results
+
+Flattens each extraction result into one document-level row and one row
+per line item, and appends them to date-partitioned JSONL files and
+Parquet part files, each format under its own root:
+
+    <sink_dir>/jsonl/documents/date=YYYY-MM-DD/documents.jsonl
+    <sink_dir>/jsonl/line_items/date=YYYY-MM-DD/line_items.jsonl
+    <sink_dir>/parquet/documents/date=YYYY-MM-DD/part-<ts>-<n>.parquet
+    <sink_dir>/parquet/line_items/date=YYYY-MM-DD/part-<ts>-<n>.parquet
+
+A day's results can then be loaded with a single scan, e.g.
+pyarrow.dataset.dataset("<sink_dir>/parquet/line_items", format="parquet",
+partitioning="hive"). Parquet output needs pyarrow; without it only JSONL
+is written, with a warning when the sink is opened.
+"""
+import os
+import json
+import time
+import uuid
+import threading
+import importlib.util
+from datetime import datetime, timezone
+
+
+# (column, arrow type name) - kept explicit so every part file has the same schema
+DOCUMENT_COLUMNS = [
+    ("doc_id", "string"),
+    ("source_file", "string"),
+    ("processed_at", "string"),
+    ("file_name", "string"),
+    ("page_count", "int64"),
+    ("document_type", "string"),
+    ("document_title", "string"),
+    ("invoice_id", "string"),
+    ("invoice_date", "string"),
+    ("vendor_name", "string"),
+    ("recipient_name", "string"),
+    ("model", "string"),
+    ("prompt_tokens", "int64"),
+    ("output_tokens", "int64"),
+    ("total_tokens", "int64"),
+    ("line_item_count", "int64"),
+    ("subtotal", "float64"),
+    ("tax", "float64"),
+    ("extracted_total", "float64"),
+    ("calculated_total", "float64"),
+    ("is_match", "bool"),
+    ("risk_level", "string"),
+    ("pixel_anomalies_detected", "bool"),
+    ("duplicates_detected", "bool"),
+    ("math_mismatch_detected", "bool"),
+    ("flags", "list<string>"),
+    ("reasoning", "string"),
+]
+
+LINE_ITEM_COLUMNS = [
+    ("doc_id", "string"),
+    ("source_file", "string"),
+    ("processed_at", "string"),
+    ("vendor_name", "string"),
+    ("invoice_date", "string"),
+    ("page_number", "int64"),
+    ("item_index", "int64"),
+    ("description", "string"),
+    ("quantity", "float64"),
+    ("unit_price", "float64"),
+    ("amount", "float64"),
+]
+
+
+def _to_float(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_bool(value):
+    return value if isinstance(value, bool) else None
+
+
+def _to_str(value):
+    return str(value) if value is not None else None
+
+
+def flatten_result(result, source_file=None, doc_id=None):
+    """Turn one result JSON into (document_row, [line_item_rows])"""
+    doc_id = doc_id or str(uuid.uuid4())
+    processed_at = datetime.now(timezone.utc).isoformat()
+    token_usage = result.get("token_usage") or {}
+    file_info = result.get("file_info") or {}
+    header = result.get("header") or {}
+    financials = result.get("financials") or {}
+    fraud = result.get("fraud_analysis") or {}
+
+    items = []
+    for page in result.get("pages") or []:
+        for item in page.get("line_items") or []:
+            items.append({
+                "doc_id": doc_id,
+                "source_file": source_file,
+                "processed_at": processed_at,
+                "vendor_name": _to_str(header.get("vendor_name")),
+                "invoice_date": _to_str(header.get("date")),
+                "page_number": _to_int(page.get("page_number")),
+                "item_index": len(items),
+                "description": _to_str(item.get("description")),
+                "quantity": _to_float(item.get("quantity")),
+                "unit_price": _to_float(item.get("unit_price")),
+                "amount": _to_float(item.get("amount")),
+            })
+
+    document = {
+        "doc_id": doc_id,
+        "source_file": source_file,
+        "processed_at": processed_at,
+        "file_name": _to_str(file_info.get("file_name")),
+        "page_count": _to_int(file_info.get("page_count")),
+        "document_type": _to_str(file_info.get("document_type")),
+        "document_title": _to_str(file_info.get("document_title")),
+        "invoice_id": _to_str(header.get("id")),
+        "invoice_date": _to_str(header.get("date")),
+        "vendor_name": _to_str(header.get("vendor_name")),
+        "recipient_name": _to_str(header.get("recipient_name")),
+        "model": _to_str(token_usage.get("model")),
+        "prompt_tokens": _to_int(token_usage.get("prompt_tokens")),
+        "output_tokens": _to_int(token_usage.get("output_tokens")),
+        "total_tokens": _to_int(token_usage.get("total_tokens")),
+        "line_item_count": len(items),
+        "subtotal": _to_float(financials.get("subtotal")),
+        "tax": _to_float(financials.get("tax")),
+        "extracted_total": _to_float(financials.get("extracted_total")),
+        "calculated_total": _to_float(financials.get("calculated_total")),
+        "is_match": _to_bool(financials.get("is_match")),
+        "risk_level": _to_str(fraud.get("risk_level")),
+        "pixel_anomalies_detected": _to_bool(fraud.get("pixel_anomalies_detected")),
+        "duplicates_detected": _to_bool(fraud.get("duplicates_detected")),
+        "math_mismatch_detected": _to_bool(fraud.get("math_mismatch_detected")),
+        "flags": [str(f) for f in fraud.get("flags") or []],
+        "reasoning": _to_str(fraud.get("reasoning")),
+    }
+    return document, items
+
+
+def _arrow_schema(columns):
+    import pyarrow as pa
+    types = {
+        "string": pa.string(),
+        "int64": pa.int64(),
+        "float64": pa.float64(),
+        "bool": pa.bool_(),
+        "list<string>": pa.list_(pa.string()),
+    }
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+
+class ResultSink:
+    """Append-only JSONL + Parquet writer with periodic flushes (thread-safe)"""
+
+    def __init__(self, directory, flush_rows=500, flush_seconds=30.0, parquet=True):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.parquet = parquet and importlib.util.find_spec("pyarrow") is not None
+        if parquet and not self.parquet:
+            print("⚠️ pyarrow is not installed - the result sink writes JSONL only (pip install pyarrow)")
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._buffers = {"documents": [], "line_items": []}
+        self._part = 0
+        self._last_flush = time.time()
+        self._closed = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+        # Time-based flushes so a slow trickle of results still lands on disk
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _partition(self, fmt, table, day):
+        path = os.path.join(self.directory, fmt, table, f"date={day}")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def write(self, result, source_file=None, doc_id=None):
+        """Queue one result; returns the doc_id used for its rows"""
+        document, items = flatten_result(result, source_file, doc_id)
+        with self._lock:
+            self._buffers["documents"].append(document)
+            self._buffers["line_items"].extend(items)
+            due = len(self._buffers["documents"]) + len(self._buffers["line_items"]) >= self.flush_rows
+        if due:
+            self.flush()
+        return document["doc_id"]
+
+    def flush(self):
+        with self._lock:
+            buffers = self._buffers
+            self._buffers = {"documents": [], "line_items": []}
+            self._last_flush = time.time()
+            self._part += 1
+            part = self._part
+
+        day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        with self._io_lock:
+            for table, rows in buffers.items():
+                if not rows:
+                    continue
+                path = self._partition("jsonl", table, day)
+                with open(os.path.join(path, f"{table}.jsonl"), "a", encoding="utf-8") as f:
+                    for row in rows:
+                        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                if self.parquet:
+                    self._write_parquet(table, rows, self._partition("parquet", table, day), part)
+
+    def _write_parquet(self, table, rows, path, part):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        columns = DOCUMENT_COLUMNS if table == "documents" else LINE_ITEM_COLUMNS
+        arrow_table = pa.Table.from_pylist(rows, schema=_arrow_schema(columns))
+        name = f"part-{int(time.time())}-{os.getpid()}-{part:05d}.parquet"
+        pq.write_table(arrow_table, os.path.join(path, name))
+
+    def _flush_loop(self):
+        while not self._closed.wait(self.flush_seconds):
+            if time.time() - self._last_flush >= self.flush_seconds:
+                self.flush()
+
+    def close(self):
+        self._closed.set()
+        self.flush()
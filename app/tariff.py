@@ -0,0 +1,312 @@
+"""
+Tariff index: reference unit prices for line items, so inflated prices are
+flagged locally instead of relying on the AI to notice
+
+Two sources of reference prices, both keyed by a normalized description
+(lowercased, split into words and numbers, so "ESOMAN 40MG INJ." and
+"Esoman 40 mg inj" are the same item; word order does not matter):
+
+- a tariff catalog (TARIFF_CATALOG_PATH): a CSV with description and
+  price columns, optionally max_price and code. A unit price more than
+  TARIFF_CATALOG_TOLERANCE above the catalog price (or above max_price)
+  is an outlier.
+- price statistics learned from our own results: count, mean and
+  variance of log(unit price) per item, per vendor and over all vendors,
+  updated with Welford's method for every processed bill and kept in
+  SQLite (TARIFF_STATS_PATH, in memory by default). A bill adds one
+  sample per item however many lines repeat it, so "past prices" means
+  past bills. TARIFF_HISTORY_DIR seeds an empty store from stored
+  result_*.json files. An item is judged against the bill's own vendor
+  once that vendor billed it on TARIFF_MIN_SAMPLES past bills, and against
+  all vendors until then; with at least TARIFF_MIN_SAMPLES past bills, a
+  price more than TARIFF_Z_THRESHOLD standard deviations above the usual
+  one is an outlier. Prices flagged only against all vendors still count
+  towards the vendor's own statistics.
+
+A description that is not known exactly is matched by word overlap
+(Jaccard similarity of at least TARIFF_MIN_SIMILARITY, looking only at
+items that share its rarest words), so "BLOOD SUGAR GLUCOMETER" still
+finds "BLOOD SUGAR BY GLUCOMETER" while "40 MG" and "20 MG" strengths stay
+apart. Everything is in memory dictionaries; a lookup is a few set
+operations.
+
+Results get fraud_analysis.tariff_analysis, plus one flag per outlier
+item (LOW risk becomes MEDIUM). A bill is scored before it is added to
+the statistics, and outlier prices are never added.
+"""
+import os
+import re
+import csv
+import math
+import sqlite3
+import threading
+from functools import lru_cache
+from collections import defaultdict
+
+TARIFF_CATALOG_PATH = os.getenv("TARIFF_CATALOG_PATH")
+TARIFF_STATS_PATH = os.getenv("TARIFF_STATS_PATH") or ":memory:"
+TARIFF_HISTORY_DIR = os.getenv("TARIFF_HISTORY_DIR")
+TARIFF_CATALOG_TOLERANCE = float(os.getenv("TARIFF_CATALOG_TOLERANCE", "0.25"))
+TARIFF_MIN_SAMPLES = int(os.getenv("TARIFF_MIN_SAMPLES", "5"))
+TARIFF_Z_THRESHOLD = float(os.getenv("TARIFF_Z_THRESHOLD", "3.0"))
+TARIFF_MIN_SIMILARITY = float(os.getenv("TARIFF_MIN_SIMILARITY", "0.75"))
+MIN_LOG_STD = 0.1  # fixed-price items: a z of 3 still needs about a third over the usual price
+CANDIDATE_TOKENS = 2
+
+STOP_WORDS = {"a", "an", "and", "by", "for", "of", "the", "to", "with"}
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+
+def _geometric_mean(prices):
+    return math.exp(sum(map(math.log, prices)) / len(prices))
+
+
+def vendor_key(result):
+    """The bill's vendor, lowercased words and numbers ("" when unknown)"""
+    vendor = (result.get("header") or {}).get("vendor_name")
+    return " ".join(re.findall(r"[a-z0-9]+", str(vendor or "").lower()))
+
+
+@lru_cache(maxsize=65536)
+def normalize(description):
+    """Item key: the description's words and numbers, lowercased, deduplicated and sorted"""
+    tokens = re.findall(r"[a-z]+|\d+(?:\.\d+)?", str(description or "").lower())
+    return " ".join(sorted({t for t in tokens if t not in STOP_WORDS}))
+
+
+def _price(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        price = float(str(value).replace(",", "")) if isinstance(value, str) else float(value)
+    except (TypeError, ValueError):
+        return None
+    return price if math.isfinite(price) and price > 0 else None
+
+
+def unit_price(item):
+    """An item's unit price (amount / quantity when none is given), or None"""
+    price = _price(item.get("unit_price"))
+    if price is None:
+        amount, qty = _price(item.get("amount")), _price(item.get("quantity"))
+        price = amount / qty if amount and qty else None
+    return price
+
+
+class TariffIndex:
+    """Catalog prices and learned per-item price statistics, looked up by description"""
+
+    def __init__(self, catalog_path=None, db_path=":memory:"):
+        self.catalog = {}                   # key -> {"description", "price", "max_price", "code"}
+        self.stats = {}                     # (vendor, key) -> [count, mean log price, M2]; vendor "" = all
+        self.postings = defaultdict(set)    # token -> keys
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS item_prices (
+                vendor TEXT NOT NULL,
+                key TEXT NOT NULL,
+                description TEXT,
+                n INTEGER NOT NULL,
+                mean REAL NOT NULL,
+                m2 REAL NOT NULL,
+                PRIMARY KEY (vendor, key)
+            )
+        """)
+        self._conn.commit()
+        for vendor, key, n, mean, m2 in self._conn.execute("SELECT vendor, key, n, mean, m2 FROM item_prices"):
+            self.stats[(vendor, key)] = [n, mean, m2]
+            if not vendor:
+                self._post(key)
+        if catalog_path:
+            self.load_catalog(catalog_path)
+
+    def _post(self, key):
+        for token in key.split():
+            self.postings[token].add(key)
+
+    def load_catalog(self, path):
+        """Read a CSV catalog (description, price[, max_price][, code]); returns the number of items"""
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                row = {(k or "").strip().lower(): v for k, v in row.items()}
+                key = normalize(row.get("description"))
+                price = _price(row.get("price") or row.get("unit_price"))
+                if not key or price is None:
+                    continue
+                self.catalog[key] = {"description": row["description"].strip(), "price": price,
+                                     "max_price": _price(row.get("max_price")), "code": row.get("code") or None}
+                self._post(key)
+        return len(self.catalog)
+
+    def match(self, description):
+        """(key, similarity) of the closest known item, or (None, 0.0)"""
+        key = normalize(description)
+        if not key:
+            return None, 0.0
+        if key in self.catalog or ("", key) in self.stats:
+            return key, 1.0
+        tokens = set(key.split())
+        known = sorted((t for t in tokens if t in self.postings), key=lambda t: len(self.postings[t]))
+        candidates = set().union(*(self.postings[t] for t in known[:CANDIDATE_TOKENS])) if known else ()
+        best, best_score = None, 0.0
+        for candidate in candidates:
+            other = set(candidate.split())
+            score = len(tokens & other) / len(tokens | other)
+            if score > best_score:
+                best, best_score = candidate, score
+        return (best, round(best_score, 3)) if best_score >= TARIFF_MIN_SIMILARITY else (None, 0.0)
+
+    def check(self, description, price, vendor=""):
+        """Outlier finding for one unit price ({"reference_price", "source", ...}) or None"""
+        return self._check(*self.match(description), price, vendor)
+
+    def _check(self, key, similarity, price, vendor=""):
+        if key is None:
+            return None
+        entry = self.catalog.get(key)
+        if entry:
+            limit = entry["max_price"] or entry["price"] * (1 + TARIFF_CATALOG_TOLERANCE)
+            if price > limit:
+                return {"reference_price": entry["price"], "limit": round(limit, 2), "source": "catalog",
+                        "matched": entry["description"], "code": entry["code"], "similarity": similarity}
+            return None
+        # Prices differ between hospitals: all vendors only stand in until this one billed the item often enough
+        scope = vendor if self.stats.get((vendor, key), (0,))[0] >= TARIFF_MIN_SAMPLES else ""
+        n, mean, m2 = self.stats.get((scope, key), (0, 0.0, 0.0))
+        if n < TARIFF_MIN_SAMPLES:
+            return None
+        std = max(math.sqrt(m2 / (n - 1)), MIN_LOG_STD)
+        z = (math.log(price) - mean) / std
+        if z > TARIFF_Z_THRESHOLD:
+            return {"reference_price": round(math.exp(mean), 2), "z_score": round(z, 2), "source": "history",
+                    "samples": n, "vendor": scope or None, "matched": key, "similarity": similarity}
+        return None
+
+    def _learn(self, vendor, key, description, price):
+        n, mean, m2 = self.stats.get((vendor, key), (0, 0.0, 0.0))
+        x = math.log(price)
+        n += 1
+        delta = x - mean
+        mean += delta / n
+        m2 += delta * (x - mean)
+        if not vendor and ("", key) not in self.stats:
+            self._post(key)
+        self.stats[(vendor, key)] = [n, mean, m2]
+        self._conn.execute(
+            "INSERT INTO item_prices (vendor, key, description, n, mean, m2) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (vendor, key) DO UPDATE SET n = excluded.n, mean = excluded.mean, m2 = excluded.m2",
+            (vendor, key, description, n, mean, m2))
+
+    def score(self, result, update=True):
+        """Look up every line item; optionally add the non-outlier prices to the statistics"""
+        analysis = {"items_checked": 0, "items_matched": 0, "outliers": []}
+        vendor = vendor_key(result)
+        learned = {}    # key -> (description, [(price, also for all vendors)]): one sample per item per bill
+        with self._lock:
+            grouped = {}
+            for page in result.get("pages") or []:
+                if not isinstance(page, dict):
+                    continue
+                for item in page.get("line_items") or []:
+                    price = unit_price(item) if isinstance(item, dict) else None
+                    if price is None:
+                        continue
+                    description = str(item.get("description") or "")
+                    analysis["items_checked"] += 1
+                    key, similarity = self.match(description)
+                    if key:
+                        analysis["items_matched"] += 1
+                    finding = self._check(key, similarity, price, vendor)
+                    # A vendor's own prices are learned even when they stand out against all vendors,
+                    # so that a hospital with higher rates gets statistics of its own
+                    if finding is None or (vendor and finding["source"] == "history" and not finding["vendor"]):
+                        learned.setdefault(normalize(description), (description, []))[1].append(
+                            (price, finding is None))
+                    if finding is None:
+                        continue
+                    # A daily charge repeated over a stay is one finding
+                    group = grouped.setdefault((normalize(description), round(price, 2)), {
+                        "description": description, "unit_price": round(price, 2), "pages": [], "lines": 0,
+                        **finding})
+                    group["lines"] += 1
+                    if page.get("page_number") not in group["pages"]:
+                        group["pages"].append(page.get("page_number"))
+            analysis["outliers"] = list(grouped.values())
+            if update:
+                for key, (description, prices) in learned.items():
+                    if not key:
+                        continue
+                    shared = [price for price, usual in prices if usual]
+                    if shared:
+                        self._learn("", key, description, _geometric_mean(shared))
+                    if vendor:
+                        self._learn(vendor, key, description, _geometric_mean([price for price, _ in prices]))
+                self._conn.commit()
+        return analysis
+
+    def annotate(self, result, update=True):
+        """Attach tariff_analysis to fraud_analysis and flag unit-price outliers"""
+        analysis = self.score(result, update=update)
+        fraud = result.get("fraud_analysis", {})
+        fraud["tariff_analysis"] = analysis
+        flags = fraud.setdefault("flags", [])
+        for outlier in analysis["outliers"]:
+            if outlier["source"] == "catalog":
+                source = "tariff catalog"
+            elif outlier["vendor"]:
+                source = f"typical of {outlier['samples']} past bills from this vendor"
+            else:
+                source = f"typical of {outlier['samples']} past bills"
+
+            lines = f", {outlier['lines']} lines" if outlier["lines"] > 1 else ""
+            flags.append(f"Unit price outlier: '{outlier['description']}' at {outlier['unit_price']:.2f} "
+                         f"vs {outlier['reference_price']:.2f} ({source}{lines})")
+        if analysis["outliers"] and fraud.get("risk_level") in (None, "LOW"):
+            fraud["risk_level"] = "MEDIUM"
+        result["fraud_analysis"] = fraud
+        return result
+
+    def learn_store(self, root):
+        """Add the prices of every stored result_*.json below root; returns the number of results read"""
+        import json
+        from app.replay import find_results
+        count = 0
+        for path in find_results(root):
+            try:
+                with open(path) as f:
+                    self.score(json.load(f), update=True)
+                count += 1
+            except (OSError, ValueError):
+                continue
+        return count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_index(catalog_path=None, stats_path=":memory:", history_dir=None):
+    """A TariffIndex whose statistics are seeded from history_dir when they are still empty"""
+    index = TariffIndex(catalog_path, stats_path)
+    if catalog_path:
+        print(f"💹 Tariff catalog: {len(index.catalog)} items")
+    if history_dir and not index.stats:
+        count = index.learn_store(history_dir)
+        items = sum(1 for vendor, _ in index.stats if not vendor)
+        print(f"💹 Learned item prices from {count} stored result(s), {items} items")
+    return index
+
+
+def default_index():
+    """The shared index from TARIFF_CATALOG_PATH / TARIFF_STATS_PATH / TARIFF_HISTORY_DIR (created on first use)"""
+    global _INDEX
+    if _INDEX is None:
+        with _INDEX_LOCK:
+            if _INDEX is None:
+                _INDEX = open_index(TARIFF_CATALOG_PATH, TARIFF_STATS_PATH, TARIFF_HISTORY_DIR)
+    return _INDEX
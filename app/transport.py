@@ -0,0 +1,94 @@
+"""
+Provider request bodies streamed from the page bytes
+
+Pages travel through the pipeline as JPEG bytes (content["images"]); the
+base64 text the provider APIs want is only produced while a request is
+being sent. JsonBody serializes the small part of a request (prompt,
+extracted text, settings) once and leaves a slot for every Base64 value;
+when requests iterates the body, each page is encoded in CHUNK_BYTES
+pieces straight from a memoryview and written to the socket. The length
+is known up front, so the body goes out with a Content-Length and can be
+sent again on a retry.
+
+That keeps one copy of each page per job (plus one chunk in flight)
+instead of the JPEG, its base64 string, the JSON text and its encoded
+bytes. Callers that need a base64 string anyway (the OpenAI and
+Anthropic SDKs, provider batch files) use as_base64() for the duration of
+the call.
+"""
+import re
+import json
+import uuid
+import base64
+
+CHUNK_BYTES = 3 * 16 * 1024  # a multiple of 3, so chunks encode without padding in between
+
+
+def as_bytes(image):
+    """Page image as bytes (older content holds base64 strings)"""
+    return base64.b64decode(image) if isinstance(image, str) else image
+
+
+def as_base64(image):
+    """Page image as a base64 string"""
+    return image if isinstance(image, str) else base64.b64encode(image).decode("ascii")
+
+
+class Base64:
+    """Bytes that go into a JSON body as a base64 string, encoded chunk by chunk while sending"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        if isinstance(self.data, str):
+            return len(self.data)
+        return 4 * ((len(self.data) + 2) // 3)
+
+    def chunks(self):
+        if isinstance(self.data, str):
+            for i in range(0, len(self.data), CHUNK_BYTES):
+                yield self.data[i:i + CHUNK_BYTES].encode("ascii")
+            return
+        view = memoryview(self.data)
+        for i in range(0, len(view), CHUNK_BYTES):
+            yield base64.b64encode(view[i:i + CHUNK_BYTES])
+
+
+class JsonBody:
+    """A JSON request body whose Base64 values are streamed instead of built in memory.
+    Pass it as data= to requests: it is iterable and has a length (sent as Content-Length)."""
+
+    def __init__(self, payload):
+        marker = f"@@{uuid.uuid4().hex}:"
+        blobs = []
+
+        def hold(node):
+            if isinstance(node, Base64):
+                blobs.append(node)
+                return f"{marker}{len(blobs) - 1}@@"
+            if isinstance(node, dict):
+                return {key: hold(value) for key, value in node.items()}
+            if isinstance(node, list):
+                return [hold(value) for value in node]
+            return node
+
+        text = json.dumps(hold(payload))
+        self.parts = []
+        pos = 0
+        for match in re.finditer(re.escape(marker) + r"(\d+)@@", text):
+            self.parts.append(text[pos:match.start()].encode())
+            self.parts.append(blobs[int(match.group(1))])
+            pos = match.end()
+        self.parts.append(text[pos:].encode())
+        self.length = sum(len(part) for part in self.parts)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for part in self.parts:
+            if isinstance(part, Base64):
+                yield from part.chunks()
+            elif part:
+                yield part
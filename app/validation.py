@@ -0,0 +1,83 @@
+"""
+Python-side math validation of the AI's numbers
+
+Shared by the web service, the command line and the replay engine. The
+tolerances come from the environment so a change can be tried on stored
+results (python replay.py) before it goes live:
+
+- MATH_MATCH_TOLERANCE: largest difference between the extracted total
+  and the sum of the line items that still counts as a match, in the
+  bill's currency (absolute, not a share of the total)
+- MATH_RISK_THRESHOLD: a mismatch larger than this raises LOW risk to MEDIUM
+"""
+import os
+
+MATH_MATCH_TOLERANCE = float(os.getenv("MATH_MATCH_TOLERANCE", "0.10"))
+MATH_RISK_THRESHOLD = float(os.getenv("MATH_RISK_THRESHOLD", "1.0"))
+
+
+def validate_math(data, tolerance=None, risk_threshold=None):
+    """Perform Python-side math validation.
+    Returns (data, match_status) with match_status MATCH / MISMATCH / TOTAL_MISSING /
+    INVALID_TOTAL_FORMAT (ERROR if validation itself failed)."""
+    tolerance = MATH_MATCH_TOLERANCE if tolerance is None else tolerance
+    risk_threshold = MATH_RISK_THRESHOLD if risk_threshold is None else risk_threshold
+    try:
+        calculated_total = 0.0
+        line_items = []
+
+        if "pages" in data:
+            for page in data["pages"]:
+                if "line_items" in page:
+                    line_items.extend(page["line_items"])
+        elif "line_items" in data:
+            line_items = data["line_items"]
+
+        for item in line_items:
+            amount = item.get("amount")
+            if amount is not None:
+                try: calculated_total += float(amount)
+                except: pass
+
+        financials = data.get("financials", {})
+        extracted_total = financials.get("extracted_total")
+
+        is_match = None
+        match_status = "UNKNOWN"
+
+        if extracted_total is not None:
+            try:
+                extracted_total = float(extracted_total)
+                if abs(extracted_total - calculated_total) < tolerance:
+                    is_match = True
+                    match_status = "MATCH"
+                else:
+                    is_match = False
+                    match_status = "MISMATCH"
+            except:
+                match_status = "INVALID_TOTAL_FORMAT"
+        else:
+            match_status = "TOTAL_MISSING"
+
+        financials["calculated_total"] = round(calculated_total, 2)
+        financials["is_match"] = is_match
+        data["financials"] = financials
+
+        fraud = data.get("fraud_analysis", {})
+        if is_match is False and extracted_total is not None:
+            fraud["math_mismatch_detected"] = True
+            msg = f"Math mismatch: Extracted {extracted_total} vs Calculated {round(calculated_total, 2)}"
+            if msg not in fraud.get("flags", []):
+                fraud.setdefault("flags", []).append(msg)
+            if abs(extracted_total - calculated_total) > risk_threshold:
+                 if fraud.get("risk_level") == "LOW":
+                     fraud["risk_level"] = "MEDIUM"
+        else:
+            fraud["math_mismatch_detected"] = False
+
+        data["fraud_analysis"] = fraud
+        return data, match_status
+
+    except Exception as e:
+        print(f"   ⚠️ Validation Error: {e}")
+        return data, "ERROR"
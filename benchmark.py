@@ -0,0 +1,495 @@
+"""
+BAJAJ HEALTH DATATHON - Document Extraction System
+Benchmark Harness
+
+Replays Datathon-Datasets/*.pdf and test_bill.jpg through the web service
+(/api/v1/extract and /api/v1/batch-extract) and through submit_bill.py,
+with every provider call answered by the local mock provider
+(mock_provider.py) so runs are free, repeatable and comparable.
+
+Reports docs/second, p50/p95/p99 latency, peak RSS and CPU time per
+pipeline stage (from each result's processing_metadata), plus cold-start
+numbers (import time, time until the server is live / ready, first
+request latency, single-file CLI run), and stores everything as JSON
+tagged with the git commit.
+
+Usage:
+    python benchmark.py
+    python benchmark.py --targets cli --latency 1.5 --rate-limit 0.05
+    python benchmark.py --compare benchmarks/a.json benchmarks/b.json
+"""
+import os
+import sys
+import json
+import glob
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from mock_provider import start_server
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INPUTS = sorted(glob.glob(os.path.join(ROOT, "Datathon-Datasets", "*.pdf"))) + \
+    [os.path.join(ROOT, "test_bill.jpg")]
+TARGETS = ("api-single", "api-batch", "cli")
+PROVIDER_PREFIXES = {"gemini": "GEMINI", "openai": "OPENAI", "anthropic": "ANTHROPIC"}
+
+# Metrics compared by --compare: (key, label, higher_is_better)
+COMPARE_METRICS = [
+    ("docs_per_second", "docs/s", True),
+    ("latency_ms.p50", "p50 ms", False),
+    ("latency_ms.p95", "p95 ms", False),
+    ("latency_ms.p99", "p99 ms", False),
+    ("peak_rss_mb", "peak RSS MB", False),
+    ("failed", "failed", False),
+]
+
+COLD_START_METRICS = [
+    ("import_ms.app.main", "import app.main ms"),
+    ("import_ms.submit_bill", "import submit_bill ms"),
+    ("api_live_ms", "API live ms"),
+    ("api_ready_ms", "API ready ms"),
+    ("first_request_ms", "1st request ms"),
+    ("cli_single_file_ms", "CLI 1 file ms"),
+]
+
+
+# --- Helpers ---
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"], cwd=ROOT).returncode != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentiles(values):
+    """Nearest-rank p50 / p95 / p99 (None when there are no values)"""
+    values = sorted(values)
+    def pick(p):
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))], 1)
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99),
+            "mean": round(sum(values) / len(values), 1) if values else None}
+
+def stage_summary(metadatas):
+    """Total and per-document CPU / wall milliseconds per pipeline stage"""
+    totals = {}
+    for meta in metadatas:
+        for name, entry in (meta or {}).get("stage_timings", {}).items():
+            t = totals.setdefault(name, {"cpu_ms": 0.0, "wall_ms": 0.0, "docs": 0})
+            t["cpu_ms"] += entry.get("cpu_ms", 0.0)
+            t["wall_ms"] += entry.get("wall_ms", 0.0)
+            t["docs"] += 1
+    return {name: {"cpu_ms_total": round(t["cpu_ms"], 1), "wall_ms_total": round(t["wall_ms"], 1),
+                   "cpu_ms_per_doc": round(t["cpu_ms"] / t["docs"], 1)}
+            for name, t in sorted(totals.items())}
+
+def bench_env(mock_url, providers, workdir):
+    """Environment for the app under test: every provider points at the mock,
+    persistent state goes to a scratch directory so runs don't affect each other"""
+    env = dict(os.environ)
+    env.update({
+        "GEMINI_BASE_URL": mock_url,
+        "OPENAI_BASE_URL": f"{mock_url}/v1",
+        "ANTHROPIC_BASE_URL": mock_url,
+        "PYTHONUNBUFFERED": "1",
+        "RESULT_SINK_DIR": "",
+        "DUPLICATE_INDEX_PATH": "",
+        "BENFORD_BASELINE_PATH": ":memory:",
+        "BULK_STATE_PATH": os.path.join(workdir, "bulk_state.json"),
+    })
+    # Empty values win over .env (python-dotenv never overrides), so real keys stay unused
+    for name, prefix in PROVIDER_PREFIXES.items():
+        env[f"{prefix}_API_KEY"] = "benchmark-key" if name in providers else ""
+        for i in range(1, 11):
+            env[f"{prefix}_API_KEY_{i}"] = ""
+    return env
+
+
+class RSSSampler:
+    """Samples the resident memory of a process and all its children (Linux /proc)"""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self.current_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _tree(self, pid):
+        pids = [pid]
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    for child in f.read().split():
+                        pids.extend(self._tree(int(child)))
+        except OSError:
+            pass
+        return pids
+
+    def _rss_kb(self, pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.current_kb = sum(self._rss_kb(p) for p in self._tree(self.pid))
+            self.peak_kb = max(self.peak_kb, self.current_kb)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return round(self.peak_kb / 1024, 1) if os.path.isdir("/proc") else None
+
+
+# --- Targets ---
+
+def start_api(env, port, timeout=60, workers=1):
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+                             "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError("API server exited during startup")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/", timeout=1)
+            return proc, round((time.perf_counter() - started) * 1000, 1)
+        except requests.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("API server did not start")
+
+def wait_until_ready(port, started, timeout=60):
+    """Milliseconds (since `started`) until /ready answers 200; servers without /ready count as ready"""
+    while time.perf_counter() - started < timeout:
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/ready", timeout=1).status_code in (200, 404):
+                break
+        except requests.RequestException:
+            pass
+        time.sleep(0.05)
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def import_ms(module, env, runs=3):
+    """Median fresh-interpreter import time of a module"""
+    code = f"import time; t = time.perf_counter(); import {module}; print((time.perf_counter() - t) * 1000)"
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True)
+        try:
+            times.append(float(out.stdout.strip().splitlines()[-1]))
+        except (ValueError, IndexError):
+            return None
+    return round(sorted(times)[len(times) // 2], 1)
+
+def measure_cold_start(sample, env, timeout):
+    """Import times, time to live / ready, first request latency and a one-file CLI run"""
+    cold = {"import_ms": {m: import_ms(m, env) for m in ("app.main", "submit_bill")}}
+    
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    proc, cold["api_live_ms"] = start_api(env, port)
+    try:
+        cold["api_ready_ms"] = wait_until_ready(port, started)
+        t0 = time.perf_counter()
+        with open(sample, "rb") as f:
+            job = requests.post(f"{base}/api/v1/extract", files={"file": (os.path.basename(sample), f)},
+                                timeout=60).json()
+        status, seen = wait_for_job(base, job["job_id"], timeout)
+        cold["first_request_ms"] = round((seen - t0) * 1000, 1) if status.get("status") == "completed" else None
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    
+    with tempfile.TemporaryDirectory(prefix="bench-cold-") as out_dir:
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(ROOT, "submit_bill.py"), sample, "--output-dir", out_dir,
+                        "--no-manifest"], cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.STDOUT, timeout=timeout)
+        cold["cli_single_file_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return cold
+
+def wait_for_job(base, job_id, timeout, poll=0.05):
+    """Poll until the job finishes; returns (status, perf_counter when it was seen finished)"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            status = requests.get(f"{base}/api/v1/status/{job_id}", timeout=30).json()
+        except requests.RequestException:
+            # The server stops answering while a job blocks its event loop - keep waiting
+            continue
+        if status.get("status") in ("completed", "failed"):
+            return status, time.perf_counter()
+        time.sleep(poll)
+    return {"status": "failed", "error": "benchmark timeout"}, time.perf_counter()
+
+def run_api(files, env, mode, concurrency, timeout):
+    """mode='single': one /extract upload per document, `concurrency` at a time.
+    mode='batch': one /batch-extract upload with every document.
+    Latency is upload start to the poll that saw the job finish."""
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    proc, startup_ms = start_api(env, port)
+    sampler = RSSSampler(proc.pid).start()
+    try:
+        started = time.perf_counter()
+        if mode == "single":
+            def one(path):
+                t0 = time.perf_counter()
+                with open(path, "rb") as f:
+                    job = requests.post(f"{base}/api/v1/extract",
+                                        files={"file": (os.path.basename(path), f)}, timeout=60).json()
+                return (t0, *wait_for_job(base, job["job_id"], timeout))
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                outcomes = list(pool.map(one, files))
+        else:
+            handles = [open(p, "rb") for p in files]
+            try:
+                t0 = time.perf_counter()
+                batch = requests.post(f"{base}/api/v1/batch-extract", timeout=120,
+                                      files=[("files", (os.path.basename(p), h)) for p, h in zip(files, handles)]).json()
+            finally:
+                for h in handles:
+                    h.close()
+            with ThreadPoolExecutor(max_workers=max(1, len(files))) as pool:
+                outcomes = list(pool.map(lambda j: (t0, *wait_for_job(base, j["job_id"], timeout)),
+                                         batch["batch_results"]))
+        wall = time.perf_counter() - started
+    finally:
+        peak = sampler.stop()
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    
+    done = [(t0, status, seen) for t0, status, seen in outcomes if status.get("status") == "completed"]
+    return {
+        "wall_seconds": round(wall, 2),
+        "startup_ms": startup_ms,
+        "latencies": [(seen - t0) * 1000 for t0, _, seen in done],
+        "metadatas": [status["result"].get("processing_metadata") for _, status, _ in done],
+        "failed": len(outcomes) - len(done),
+        "peak_rss_mb": peak,
+    }
+
+def run_cli(files, env, workers, concurrency, timeout):
+    """Run submit_bill.py over the documents into a scratch output directory.
+    Per-document latency is the summed stage time from processing_metadata."""
+    with tempfile.TemporaryDirectory(prefix="bench-cli-") as out_dir:
+        cmd = [sys.executable, os.path.join(ROOT, "submit_bill.py"), *files, "--output-dir", out_dir,
+               "--no-manifest", "--concurrency", str(concurrency)]
+        if workers:
+            cmd += ["--workers", str(workers)]
+        started = time.perf_counter()
+        proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        sampler = RSSSampler(proc.pid).start()
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        wall = time.perf_counter() - started
+        peak = sampler.stop()
+        
+        metadatas = []
+        for path in glob.glob(os.path.join(out_dir, "result_*.json")):
+            with open(path, "r") as f:
+                metadatas.append(json.load(f).get("processing_metadata"))
+    return {
+        "wall_seconds": round(wall, 2),
+        "latencies": [m["total_wall_ms"] for m in metadatas if m and "total_wall_ms" in m],
+        "metadatas": metadatas,
+        "failed": len(files) - len(metadatas),
+        "peak_rss_mb": peak,
+    }
+
+def summarize(raw, docs):
+    metadatas = raw.pop("metadatas")
+    latencies = raw.pop("latencies")
+    ok = docs - raw["failed"]
+    return {
+        "docs": docs,
+        "completed": ok,
+        **raw,
+        "docs_per_second": round(ok / raw["wall_seconds"], 3) if raw["wall_seconds"] else None,
+        "latency_ms": percentiles(latencies),
+        "stages": stage_summary(metadatas),
+    }
+
+
+# --- Reporting ---
+
+def lookup(result, dotted):
+    for key in dotted.split("."):
+        result = (result or {}).get(key)
+    return result
+
+def print_report(report):
+    print(f"\n📊 Benchmark @ {report['commit']} ({report['documents']} documents, mock latency "
+          f"{report['mock']['latency']}s, 429 rate {report['mock']['rate_limit']}, "
+          f"failure rate {report['mock']['failure_rate']})")
+    cold = report.get("cold_start")
+    if cold:
+        imports = ", ".join(f"{m} {ms} ms" for m, ms in cold["import_ms"].items())
+        print(f"\n  cold start: import {imports} | API live {cold['api_live_ms']} ms, ready {cold['api_ready_ms']} ms, "
+              f"first request {cold['first_request_ms']} ms | CLI one file {cold['cli_single_file_ms']} ms")
+    for target, result in report["targets"].items():
+        lat = result["latency_ms"]
+        print(f"\n  {target}: {result['completed']}/{result['docs']} ok in {result['wall_seconds']}s "
+              f"→ {result['docs_per_second']} docs/s | p50 {lat['p50']} / p95 {lat['p95']} / p99 {lat['p99']} ms "
+              f"| peak RSS {result['peak_rss_mb']} MB")
+        for name, stage in sorted(result["stages"].items(), key=lambda kv: -kv[1]["cpu_ms_total"]):
+            print(f"     {name:<18} cpu {stage['cpu_ms_total']:>10.1f} ms  wall {stage['wall_ms_total']:>10.1f} ms"
+                  f"  ({stage['cpu_ms_per_doc']:.1f} cpu ms/doc)")
+
+def compare(path_a, path_b):
+    with open(path_a) as f:
+        a = json.load(f)
+    with open(path_b) as f:
+        b = json.load(f)
+    print(f"📊 {a['commit']} → {b['commit']}")
+    
+    def row(label, old, new, higher_is_better):
+        if old is None or new is None:
+            return
+        change = (new - old) / old * 100 if old else 0.0
+        better = (change > 0) == higher_is_better if change else None
+        mark = "" if better is None else (" ✅" if better else " ⚠️")
+        print(f"     {label:<22} {old:>10} → {new:<10} ({change:+.1f}%){mark}")
+    
+    if a.get("cold_start") and b.get("cold_start"):
+        print("\n  cold start")
+        for key, label in COLD_START_METRICS:
+            head, _, rest = key.partition(".")
+            pick = (lambda r: (r["cold_start"].get(head) or {}).get(rest)) if rest else (lambda r: r["cold_start"].get(key))
+            row(label, pick(a), pick(b), False)
+    for target in sorted(set(a["targets"]) & set(b["targets"])):
+        print(f"\n  {target}")
+        for key, label, higher_is_better in COMPARE_METRICS:
+            row(label, lookup(a["targets"][target], key), lookup(b["targets"][target], key), higher_is_better)
+
+
+# --- Main ---
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the extraction pipeline against a mock provider")
+    parser.add_argument("inputs", nargs="*", help="Documents to replay (default: Datathon-Datasets/*.pdf + test_bill.jpg)")
+    parser.add_argument("--targets", default=",".join(TARGETS),
+                        help=f"Comma-separated subset of {', '.join(TARGETS)}")
+    parser.add_argument("--providers", default="gemini",
+                        help="Providers to enable (gemini, openai, anthropic), all served by the mock")
+    parser.add_argument("--latency", type=float, default=0.5, help="Mock seconds per provider call")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of calls answered with 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of calls answered with 500")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--concurrency", type=int, default=4, help="Client uploads / CLI provider calls in flight")
+    parser.add_argument("--workers", type=int, default=None, help="CLI extraction processes")
+    parser.add_argument("--timeout", type=float, default=900, help="Seconds allowed per target")
+    parser.add_argument("--no-cold-start", action="store_true", help="Skip the import / startup / first request timings")
+    parser.add_argument("--output", help="Where to write the JSON report (default: benchmarks/<commit>-<time>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two saved reports and exit")
+    args = parser.parse_args(argv)
+    
+    args.targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    unknown = set(args.targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"unknown target(s): {', '.join(sorted(unknown))}")
+    args.providers = [p.strip() for p in args.providers.split(",") if p.strip()]
+    if not args.providers or set(args.providers) - set(PROVIDER_PREFIXES):
+        parser.error("--providers must list gemini, openai and/or anthropic")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    
+    files = [os.path.abspath(f) for f in (args.inputs or DEFAULT_INPUTS) if os.path.isfile(f)]
+    if not files:
+        print("❌ No input documents found")
+        sys.exit(1)
+    
+    mock_options = {"latency": args.latency, "jitter": args.jitter, "rate_limit": args.rate_limit,
+                    "failure_rate": args.failure_rate, "seed": args.seed}
+    mock_port = free_port()
+    mock = start_server(port=mock_port, batch_delay=1.0, **mock_options)
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "documents": len(files),
+        "mock": mock_options,
+        "providers": args.providers,
+        "concurrency": args.concurrency,
+        "targets": {},
+    }
+    
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+            env = bench_env(mock_url, args.providers, workdir)
+            if not args.no_cold_start:
+                print("⏱️  cold start...", flush=True)
+                sample = next((f for f in files if not f.lower().endswith(".pdf")), files[0])
+                report["cold_start"] = measure_cold_start(sample, env, args.timeout)
+            for target in args.targets:
+                print(f"⏱️  {target} ({len(files)} documents)...", flush=True)
+                if target == "cli":
+                    raw = run_cli(files, env, args.workers, args.concurrency, args.timeout)
+                else:
+                    raw = run_api(files, env, target.split("-")[1], args.concurrency, args.timeout)
+                report["targets"][target] = summarize(raw, len(files))
+    finally:
+        report["mock"]["stats"] = requests.get(f"{mock_url}/_mock/stats", timeout=5).json()
+        mock.shutdown()
+    
+    print_report(report)
+    output = args.output or os.path.join(ROOT, "benchmarks",
+                                         f"{report['commit']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""
+BAJAJ HEALTH DATATHON - Document Extraction System
+Load Test
+
+Drives a local instance of app.main:app (backed by mock_provider.py) with
+many concurrent clients: a configurable mix of single uploads, batch
+uploads and status polls, arriving at a rate that steps up over time.
+
+For every step it reports achieved throughput, latency percentiles and
+error rates per request type, and it samples memory, queue depth and jobs
+in flight once a second from /metrics. The first step where the service
+stops keeping up is reported as the saturation point, which is what
+uvicorn worker counts and pod sizes should be planned from.
+
+Usage:
+    python loadtest.py
+    python loadtest.py --rates 2,5,10,20,40 --step-seconds 30 --mix single=5,batch=1,poll=20
+    python loadtest.py --url http://localhost:8000 --rates 1,2,4
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from mock_provider import start_server
+from benchmark import (DEFAULT_INPUTS, RSSSampler, bench_env, free_port, git_commit, percentiles,
+                       start_api)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+KINDS = ("single", "batch", "poll")
+
+
+def parse_mix(text):
+    """'single=5,batch=1,poll=20' -> {"single": 5.0, "batch": 1.0, "poll": 20.0}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in KINDS:
+            raise ValueError(f"unknown request type '{name}' (use {', '.join(KINDS)})")
+        mix[name.strip()] = float(weight or 1)
+    if sum(mix.values()) <= 0:
+        raise ValueError("mix weights must add up to more than 0")
+    return mix
+
+def read_gauges(text):
+    """Pick the queue / job numbers out of a Prometheus text page"""
+    values = {"queued": 0.0, "in_flight": 0.0, "jobs_finished": 0.0}
+    for line in text.splitlines():
+        if line.startswith("bill_jobs_queued "):
+            values["queued"] += float(line.split()[-1])
+        elif line.startswith("bill_jobs_in_flight "):
+            values["in_flight"] += float(line.split()[-1])
+        elif line.startswith("bill_jobs_total{"):
+            values["jobs_finished"] += float(line.split()[-1])
+    return values
+
+
+class LoadGenerator:
+    """Open-loop client: requests are fired at the target rate whether or not
+    earlier ones have finished, up to max_clients in flight"""
+
+    def __init__(self, base, files, mix, batch_size, max_clients, timeout, seed=None):
+        self.base = base
+        self.files = files
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.pool = ThreadPoolExecutor(max_workers=max_clients)
+        self.slots = threading.Semaphore(max_clients)
+        self.lock = threading.Lock()
+        self.job_ids = []
+        self.records = []   # (kind, step, started, latency_ms, outcome)
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max_clients))
+
+    def _upload(self, kind):
+        paths = self.random.sample(self.files, min(self.batch_size, len(self.files))) if kind == "batch" \
+            else [self.random.choice(self.files)]
+        handles = [open(p, "rb") for p in paths]
+        try:
+            if kind == "single":
+                r = self.session.post(f"{self.base}/api/v1/extract", timeout=self.timeout,
+                                      files={"file": (os.path.basename(paths[0]), handles[0])})
+            else:
+                r = self.session.post(f"{self.base}/api/v1/batch-extract", timeout=self.timeout,
+                                      files=[("files", (os.path.basename(p), h)) for p, h in zip(paths, handles)])
+        finally:
+            for h in handles:
+                h.close()
+        if r.ok:
+            body = r.json()
+            ids = [body["job_id"]] if kind == "single" else [j["job_id"] for j in body["batch_results"]]
+            with self.lock:
+                self.job_ids.extend(ids)
+        return r.status_code
+
+    def _poll(self):
+        with self.lock:
+            job_id = self.random.choice(self.job_ids) if self.job_ids else None
+        if job_id is None:
+            return "skipped"
+        return self.session.get(f"{self.base}/api/v1/status/{job_id}", timeout=self.timeout).status_code
+
+    def _run(self, kind, step):
+        started = time.perf_counter()
+        try:
+            outcome = self._poll() if kind == "poll" else self._upload(kind)
+        except requests.Timeout:
+            outcome = "timeout"
+        except requests.RequestException as e:
+            outcome = type(e).__name__
+        finally:
+            self.slots.release()
+        with self.lock:
+            self.records.append((kind, step, started, (time.perf_counter() - started) * 1000, outcome))
+
+    def fire(self, step):
+        """Start one request; returns False when every client is busy"""
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.records.append(("dropped", step, time.perf_counter(), 0.0, "no free client"))
+            return False
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        self.pool.submit(self._run, kind, step)
+        return True
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+class Monitor:
+    """Once a second: server memory plus queue depth from /metrics"""
+
+    def __init__(self, base, started, pid=None, interval=1.0):
+        self.base = base
+        self.started = started
+        self.rss = RSSSampler(pid).start() if pid else None
+        self.interval = interval
+        self.step = 0
+        self.timeline = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            point = {"t": round(time.perf_counter() - self.started, 1), "step": self.step}
+            try:
+                point.update(read_gauges(requests.get(f"{self.base}/metrics", timeout=5).text))
+            except requests.RequestException:
+                point["metrics_error"] = True
+            if self.rss:
+                point["rss_mb"] = round(self.rss.current_kb / 1024, 1)
+            self.timeline.append(point)
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.rss.stop() if self.rss else None
+
+
+def step_report(rate, step, seconds, records, timeline, slo_ms):
+    mine = [r for r in records if r[1] == step]
+    by_kind = {}
+    for kind in KINDS + ("dropped",):
+        rows = [r for r in mine if r[0] == kind]
+        if not rows:
+            continue
+        errors = [r for r in rows if r[4] not in (200, "skipped")]
+        by_kind[kind] = {
+            "requests": len(rows),
+            "errors": len(errors),
+            "error_rate": round(len(errors) / len(rows), 3),
+            "latency_ms": percentiles([r[3] for r in rows if r[4] == 200]),
+            "error_types": sorted({str(r[4]) for r in errors}),
+        }
+
+    samples = [p for p in timeline if p.get("step") == step]
+    points = [p for p in samples if not p.get("metrics_error")]
+    first, last = (points[0], points[-1]) if points else ({}, {})
+    jobs_done = last.get("jobs_finished", 0) - first.get("jobs_finished", 0)
+    sent = [r for r in mine if r[0] != "dropped"]
+    failed = [r for r in sent if r[4] not in (200, "skipped")]
+    p95 = percentiles([r[3] for r in sent if r[4] == 200])["p95"]
+
+    report = {
+        "offered_rate": rate,
+        "requests": len(mine),
+        "achieved_rate": round(len(sent) / seconds, 2),
+        "error_rate": round(len(failed) / len(sent), 3) if sent else 0.0,
+        "dropped": len(mine) - len(sent),
+        "p95_ms": p95,
+        "jobs_finished_per_second": round(jobs_done / seconds, 2),
+        "queue_start": first.get("queued"),
+        "queue_end": last.get("queued"),
+        "queue_growth_per_second": round((last.get("queued", 0) - first.get("queued", 0)) / seconds, 2),
+        "metrics_unreachable": len(samples) - len(points),
+        "peak_rss_mb": max((p["rss_mb"] for p in samples if "rss_mb" in p), default=None),
+        "by_kind": by_kind,
+    }
+    reasons = []
+    if report["error_rate"] > 0.05:
+        reasons.append(f"error rate {report['error_rate']:.0%}")
+    if report["dropped"]:
+        reasons.append(f"{report['dropped']} requests found no free client")
+    if p95 is not None and p95 > slo_ms:
+        reasons.append(f"p95 {p95:.0f} ms > {slo_ms:.0f} ms")
+    if report["metrics_unreachable"]:
+        reasons.append(f"/metrics unreachable for {report['metrics_unreachable']}s (event loop blocked)")
+    if report["queue_growth_per_second"] > 0.5:
+        reasons.append(f"queue growing {report['queue_growth_per_second']}/s")
+    report["saturated"] = bool(reasons)
+    report["saturation_reasons"] = reasons
+    return report
+
+def print_step(report):
+    mark = "🔴" if report["saturated"] else "🟢"
+    print(f"{mark} {report['offered_rate']:>6.1f} req/s offered | {report['achieved_rate']:>6.2f} sent/s | "
+          f"errors {report['error_rate']:.1%} | p95 {report['p95_ms']} ms | "
+          f"jobs done {report['jobs_finished_per_second']}/s | queue {report['queue_start']} → {report['queue_end']} | "
+          f"RSS {report['peak_rss_mb']} MB", flush=True)
+    for reason in report["saturation_reasons"]:
+        print(f"      ↳ {reason}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the extraction API with concurrent clients")
+    parser.add_argument("inputs", nargs="*", help="Documents to upload (default: Datathon-Datasets/*.pdf + test_bill.jpg)")
+    parser.add_argument("--url", help="Test an already running instance instead of starting one")
+    parser.add_argument("--uvicorn-workers", type=int, default=1, help="Worker processes for the local instance")
+    parser.add_argument("--rates", default="1,2,4,8,16", help="Arrival rates (requests/second), one step each")
+    parser.add_argument("--step-seconds", type=float, default=20)
+    parser.add_argument("--mix", default="single=4,batch=1,poll=15",
+                        help="Relative weights of single uploads, batch uploads and status polls")
+    parser.add_argument("--batch-size", type=int, default=5, help="Files per batch upload")
+    parser.add_argument("--max-clients", type=int, default=200, help="Concurrent client connections")
+    parser.add_argument("--request-timeout", type=float, default=30)
+    parser.add_argument("--slo-ms", type=float, default=2000, help="p95 request latency treated as saturated")
+    parser.add_argument("--stop-on-saturation", action="store_true", help="Stop after the first saturated step")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mock seconds per provider call")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of mock calls answered with 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Where to write the JSON report (default: loadtests/<commit>-<time>.json)")
+    args = parser.parse_args(argv)
+    try:
+        args.mix = parse_mix(args.mix)
+        args.rates = [float(r) for r in args.rates.split(",") if r.strip()]
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    files = [os.path.abspath(f) for f in (args.inputs or DEFAULT_INPUTS) if os.path.isfile(f)]
+    if not files:
+        print("❌ No input documents found")
+        sys.exit(1)
+
+    mock = server = None
+    workdir = tempfile.TemporaryDirectory(prefix="loadtest-")
+    if args.url:
+        base = args.url.rstrip("/")
+    else:
+        mock_port = free_port()
+        mock = start_server(port=mock_port, batch_delay=1.0, latency=args.latency, jitter=args.latency / 4,
+                            rate_limit=args.rate_limit, failure_rate=args.failure_rate, seed=args.seed)
+        port = free_port()
+        base = f"http://127.0.0.1:{port}"
+        server, _ = start_api(bench_env(f"http://127.0.0.1:{mock_port}", ["gemini"], workdir.name), port,
+                              workers=args.uvicorn_workers)
+        print(f"🚀 API on {base} ({args.uvicorn_workers} uvicorn worker(s)), mock provider latency {args.latency}s")
+
+    started = time.perf_counter()
+    monitor = Monitor(base, started, server.pid if server else None).start()
+    generator = LoadGenerator(base, files, args.mix, args.batch_size, args.max_clients,
+                              args.request_timeout, args.seed)
+    ran = []
+    try:
+        for step, rate in enumerate(args.rates):
+            monitor.step = step
+            step_started = time.perf_counter()
+            next_at = step_started
+            while time.perf_counter() - step_started < args.step_seconds:
+                generator.fire(step)
+                next_at += generator.random.expovariate(rate)
+                time.sleep(max(0.0, next_at - time.perf_counter()))
+            ran.append(rate)
+            print(f"   step {step + 1}/{len(args.rates)}: {rate} req/s for {args.step_seconds:.0f}s done", flush=True)
+            if args.stop_on_saturation and step_report(rate, step, args.step_seconds, generator.records,
+                                                       monitor.timeline, args.slo_ms)["saturated"]:
+                break
+    except KeyboardInterrupt:
+        print("\n⏹️  Stopped")
+    finally:
+        print("   waiting for outstanding requests...", flush=True)
+        generator.close()
+        peak = monitor.stop()
+        if server:
+            server.terminate()
+            server.wait()
+        if mock:
+            mock.shutdown()
+        workdir.cleanup()
+
+    # Reported after every request has finished, so slow ones count towards their own step
+    print()
+    steps = [step_report(rate, step, args.step_seconds, generator.records, monitor.timeline, args.slo_ms)
+             for step, rate in enumerate(ran)]
+    for report in steps:
+        print_step(report)
+
+    healthy = [s["offered_rate"] for s in steps if not s["saturated"]]
+    saturated = next((s for s in steps if s["saturated"]), None)
+    print()
+    if saturated:
+        print(f"📉 Saturation at {saturated['offered_rate']} req/s "
+              + (f"(last healthy step: {healthy[-1]} req/s)" if healthy else "(already saturated at the first step)"))
+    else:
+        print(f"✅ No saturation up to {args.rates[-1]} req/s")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "target": base if args.url else f"local, {args.uvicorn_workers} uvicorn worker(s)",
+        "settings": {"rates": args.rates, "step_seconds": args.step_seconds, "mix": args.mix,
+                     "batch_size": args.batch_size, "max_clients": args.max_clients, "slo_ms": args.slo_ms,
+                     "mock_latency": args.latency, "mock_rate_limit": args.rate_limit,
+                     "mock_failure_rate": args.failure_rate},
+        "saturation_rate": saturated["offered_rate"] if saturated else None,
+        "max_healthy_rate": healthy[-1] if healthy else None,
+        "peak_rss_mb": peak,
+        "steps": steps,
+        "timeline": monitor.timeline,
+    }
+    output = args.output or os.path.join(ROOT, "loadtests", f"{report['commit']}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"💾 Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
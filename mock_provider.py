@@ -0,0 +1,454 @@
+"""
+BAJAJ HEALTH DATATHON - Document Extraction System
+Local Stand-in LLM Provider
+
+A small HTTP server that imitates the regular and batch APIs of Gemini,
+OpenAI and Anthropic closely enough to develop, test and benchmark the
+pipeline without spending tokens. Responses are canned extraction results
+built from Dataset-results/*.json (matched by the filename in the prompt).
+Regular calls can be slowed down and made to fail with 429 / 500 errors
+at a configurable rate. Page images can also be uploaded once through the
+Gemini and Anthropic file APIs and referenced afterwards (MEDIA_UPLOADS);
+calls referencing an unknown file are rejected like the real APIs do.
+
+Usage:
+    python mock_provider.py --port 8089 --batch-delay 5
+    python mock_provider.py --port 8089 --latency 2 --rate-limit 0.05 --failure-rate 0.01
+
+Then point the app at it:
+    GEMINI_BASE_URL=http://127.0.0.1:8089
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8089
+"""
+import os
+import re
+import sys
+import json
+import glob
+import time
+import uuid
+import email
+import random
+import argparse
+import threading
+from email import policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Dataset-results")
+
+# Keys added by our own validation step - a real model never returns them
+VALIDATION_KEYS = {"financials": ("calculated_total", "is_match"), "fraud_analysis": ("math_mismatch_detected",)}
+
+
+class CannedResponses:
+    """Extraction JSON per document name, taken from stored results"""
+
+    def __init__(self, results_dir=RESULTS_DIR):
+        self.by_name = {}
+        for path in sorted(glob.glob(os.path.join(results_dir, "result_*.json"))):
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            data.pop("token_usage", None)
+            for section, keys in VALIDATION_KEYS.items():
+                for key in keys:
+                    (data.get(section) or {}).pop(key, None)
+            self.by_name[os.path.basename(path)[len("result_"):-len(".json")]] = json.dumps(data, indent=2)
+        self.names = sorted(self.by_name)
+
+    def for_prompt(self, prompt):
+        if "DOCUMENTS IN THIS REQUEST" in prompt:
+            # Packed call: one entry per listed document
+            names = re.findall(r"DOCUMENT \d+: \(Filename: (.+?), Pages", prompt)
+            return json.dumps({"documents": [{"document_index": i, **json.loads(self.for_name(name))}
+                                             for i, name in enumerate(names, 1)]}, indent=2)
+        match = re.search(r"Filename: (.+?), Pages", prompt)
+        if "PAGES TO RE-READ:" in prompt:
+            return self.reread(match.group(1) if match else "", prompt)
+        return self.for_name(match.group(1) if match else "")
+
+    def reread(self, name, prompt):
+        """Re-read of a few pages (app/reconcile.py): the stored pages, with every amount read as
+        quantity x unit price"""
+        wanted = {int(n) for n in re.findall(r"\d+", re.search(r"PAGES TO RE-READ: ([\d, ]+)", prompt).group(1))}
+        pages = [p for p in json.loads(self.for_name(name)).get("pages", []) if p.get("page_number") in wanted]
+        for page in pages:
+            for item in page.get("line_items") or []:
+                if isinstance(item.get("quantity"), (int, float)) and isinstance(item.get("unit_price"), (int, float)):
+                    item["amount"] = round(item["quantity"] * item["unit_price"], 2)
+        return json.dumps({"pages": pages}, indent=2)
+
+    def for_name(self, name):
+        if name in self.by_name:
+            return self.by_name[name]
+        if not self.names:
+            return json.dumps({"file_info": {"file_name": name}, "pages": [], "financials": {}})
+        return self.by_name[self.names[sum(map(ord, name)) % len(self.names)]]
+
+
+def _usage(prompt, images, text):
+    prompt_tokens = len(prompt) // 4 + 258 * images
+    output_tokens = len(text) // 4
+    return prompt_tokens, output_tokens
+
+
+def _texts_and_images(obj):
+    """Collect prompt text and count images in any provider's request body"""
+    texts, images = [], 0
+    def walk(node):
+        nonlocal images
+        if isinstance(node, dict):
+            if "inline_data" in node or "file_data" in node or node.get("type") in ("image", "image_url"):
+                images += 1
+            for key, value in node.items():
+                if key in ("text", "content") and isinstance(value, str):
+                    texts.append(value)
+                else:
+                    walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+    walk(obj)
+    return "\n".join(texts), images
+
+
+def _file_refs(obj):
+    """Uploaded files referenced by a request body (Gemini file_data URIs, Anthropic file sources)"""
+    refs = []
+    def walk(node):
+        if isinstance(node, dict):
+            if isinstance(node.get("file_data"), dict):
+                refs.append(node["file_data"].get("file_uri", "").rsplit("/", 1)[-1])
+            if node.get("type") == "file" and "file_id" in node:
+                refs.append(node["file_id"])
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+    walk(obj)
+    return refs
+
+
+class MockProvider:
+    """State shared by all request handlers"""
+
+    def __init__(self, batch_delay=5.0, latency=0.0, jitter=0.0, rate_limit=0.0, failure_rate=0.0, seed=None):
+        self.batch_delay = batch_delay
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.canned = CannedResponses()
+        self.lock = threading.Lock()
+        self.batches = {}   # id -> {"kind", "created", "requests"}
+        self.files = {}     # id -> bytes
+        self.uploads = {}   # pending Gemini resumable upload id -> display name
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "failed": 0,
+                      "request_bytes": 0, "uploads": 0, "upload_bytes": 0, "referenced_images": 0}
+
+    def add_file(self, file_id, data, upload=False):
+        with self.lock:
+            self.files[file_id] = data
+            if upload:
+                self.stats["uploads"] += 1
+                self.stats["upload_bytes"] += len(data)
+
+    def missing_files(self, request, size):
+        """Count a regular call's body and references; returns the referenced files that do not exist"""
+        refs = _file_refs(request)
+        with self.lock:
+            self.stats["request_bytes"] += size
+            self.stats["referenced_images"] += len(refs)
+            return [r for r in refs if r not in self.files]
+
+    def outcome(self):
+        """Sleep for the simulated latency, then pick 200 / 429 / 500 for a regular call"""
+        with self.lock:
+            roll = self.random.random()
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            self.stats["requests"] += 1
+            if roll < self.rate_limit:
+                status, key = 429, "rate_limited"
+            elif roll < self.rate_limit + self.failure_rate:
+                status, key = 500, "failed"
+            else:
+                status, key = 200, "ok"
+            self.stats[key] += 1
+        time.sleep(delay if status == 200 else min(delay, 0.05))
+        return status
+
+    # --- Response bodies per provider ---
+
+    def gemini_response(self, request):
+        prompt, images = _texts_and_images(request)
+        text = self.canned.for_prompt(prompt)
+        prompt_tokens, output_tokens = _usage(prompt, images, text)
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": output_tokens,
+                              "thoughtsTokenCount": 0, "totalTokenCount": prompt_tokens + output_tokens},
+        }
+
+    def openai_response(self, request):
+        prompt, images = _texts_and_images(request.get("messages"))
+        text = self.canned.for_prompt(prompt)
+        prompt_tokens, output_tokens = _usage(prompt, images, text)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion", "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": output_tokens,
+                      "total_tokens": prompt_tokens + output_tokens,
+                      "completion_tokens_details": {"reasoning_tokens": 0}},
+        }
+
+    def anthropic_response(self, request):
+        prompt, images = _texts_and_images(request.get("messages"))
+        text = self.canned.for_prompt(prompt)
+        prompt_tokens, output_tokens = _usage(prompt, images, text)
+        return {
+            "id": f"msg_{uuid.uuid4().hex[:12]}", "type": "message", "role": "assistant",
+            "model": request.get("model"), "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": prompt_tokens, "output_tokens": output_tokens},
+        }
+
+    # --- Batch bookkeeping ---
+
+    def create_batch(self, kind, batch_requests):
+        batch_id = f"{kind}-{uuid.uuid4().hex[:12]}"
+        with self.lock:
+            self.batches[batch_id] = {"kind": kind, "created": time.time(), "requests": batch_requests}
+        return batch_id
+
+    def batch_done(self, batch_id):
+        return time.time() - self.batches[batch_id]["created"] >= self.batch_delay
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _send(self, status, payload, content_type="application/json", headers=None):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _base(self):
+            return f"http://{self.headers.get('Host')}"
+
+        def _regular(self, build):
+            status = mock.outcome()
+            if status == 429:
+                return self._send(429, {"error": {"code": 429, "message": "Resource exhausted (mock)",
+                                                  "type": "rate_limit_error"}})
+            if status != 200:
+                return self._send(status, {"error": {"code": status, "message": "Internal error (mock)",
+                                                     "type": "api_error"}})
+            return self._send(200, build())
+
+        def _multipart_file(self, raw):
+            message = email.message_from_bytes(
+                f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode() + raw,
+                policy=policy.HTTP)
+            for part in message.iter_parts():
+                if part.get_param("name", header="content-disposition") == "file":
+                    return part.get_payload(decode=True)
+            return b""
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            path = url.path
+            raw = self._body()
+
+            # Regular calls: Gemini generateContent, OpenAI chat completions, Anthropic messages
+            if path.endswith(":generateContent") or path in ("/v1/chat/completions", "/v1/messages"):
+                request = json.loads(raw)
+                missing = mock.missing_files(request, len(raw))
+                if missing and path == "/v1/messages":
+                    return self._send(404, {"type": "error", "error": {
+                        "type": "not_found_error", "message": f"File not found: {missing[0]}"}})
+                if missing:
+                    return self._send(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                                                      "message": f"File {missing[0]} is not found or expired"}})
+            if path.endswith(":generateContent"):
+                return self._regular(lambda: mock.gemini_response(request))
+            if path == "/v1/chat/completions":
+                return self._regular(lambda: mock.openai_response(request))
+            if path == "/v1/messages":
+                return self._regular(lambda: mock.anthropic_response(request))
+
+            # Gemini Files API, resumable: start (JSON metadata) then "upload, finalize" (the bytes)
+            if path == "/upload/v1beta/files":
+                upload_id = parse_qs(url.query).get("upload_id", [None])[0]
+                if upload_id is None:
+                    upload_id = uuid.uuid4().hex[:12]
+                    with mock.lock:
+                        mock.uploads[upload_id] = (json.loads(raw or b"{}").get("file") or {}).get("display_name")
+                    return self._send(200, {}, headers={
+                        "X-Goog-Upload-URL": f"{self._base()}/upload/v1beta/files?upload_id={upload_id}",
+                        "X-Goog-Upload-Status": "active"})
+                with mock.lock:
+                    display_name = mock.uploads.pop(upload_id, None)
+                file_id = f"g{upload_id}"
+                mock.add_file(file_id, raw, upload=True)
+                expires = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 48 * 3600))
+                return self._send(200, {"file": {
+                    "name": f"files/{file_id}", "displayName": display_name, "mimeType": self.headers.get(
+                        "X-Goog-Upload-Header-Content-Type", "image/jpeg"),
+                    "sizeBytes": str(len(raw)), "uri": f"{self._base()}/v1beta/files/{file_id}",
+                    "expirationTime": expires, "state": "ACTIVE"}})
+
+            # Gemini batch: POST /v1beta/models/<model>:batchGenerateContent
+            if path.endswith(":batchGenerateContent"):
+                body = json.loads(raw)
+                inlined = body["batch"]["input_config"]["requests"]["requests"]
+                batch_id = mock.create_batch("gemini", inlined)
+                return self._send(200, {"name": f"batches/{batch_id}",
+                                        "metadata": {"state": "BATCH_STATE_PENDING"}})
+
+            # Anthropic / OpenAI file upload: POST /v1/files (multipart/form-data)
+            if path == "/v1/files":
+                data = self._multipart_file(raw)
+                if self.headers.get("anthropic-version"):
+                    file_id = f"file_{uuid.uuid4().hex[:12]}"
+                    mock.add_file(file_id, data, upload=True)
+                    return self._send(200, {"id": file_id, "type": "file", "filename": "page.jpg",
+                                            "mime_type": "image/jpeg", "size_bytes": len(data),
+                                            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())})
+                file_id = f"file-{uuid.uuid4().hex[:12]}"
+                mock.add_file(file_id, data)
+                return self._send(200, {"id": file_id, "object": "file", "bytes": len(data), "purpose": "batch"})
+
+            # OpenAI batch: POST /v1/batches
+            if path == "/v1/batches":
+                body = json.loads(raw)
+                lines = [json.loads(l) for l in mock.files[body["input_file_id"]].decode().splitlines() if l.strip()]
+                batch_id = mock.create_batch("openai", lines)
+                return self._send(200, {"id": batch_id, "object": "batch", "status": "validating"})
+
+            # Anthropic batch: POST /v1/messages/batches
+            if path == "/v1/messages/batches":
+                body = json.loads(raw)
+                batch_id = mock.create_batch("anthropic", body["requests"])
+                return self._send(200, {"id": batch_id, "type": "message_batch", "processing_status": "in_progress"})
+
+            return self._send(404, {"error": f"unknown endpoint {path}"})
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+
+            if path == "/_mock/stats":
+                with mock.lock:
+                    return self._send(200, dict(mock.stats))
+
+            # Gemini batch status: GET /v1beta/batches/<id>
+            match = re.fullmatch(r"/v1beta/batches/([\w-]+)", path)
+            if match and match.group(1) in mock.batches:
+                batch_id = match.group(1)
+                if not mock.batch_done(batch_id):
+                    return self._send(200, {"name": f"batches/{batch_id}", "done": False,
+                                            "metadata": {"state": "BATCH_STATE_RUNNING"}})
+                responses = [{"response": mock.gemini_response(r["request"]), "metadata": r.get("metadata")}
+                             for r in mock.batches[batch_id]["requests"]]
+                return self._send(200, {"name": f"batches/{batch_id}", "done": True,
+                                        "metadata": {"state": "BATCH_STATE_SUCCEEDED"},
+                                        "response": {"inlinedResponses": {"inlinedResponses": responses}}})
+
+            # OpenAI batch status: GET /v1/batches/<id>
+            match = re.fullmatch(r"/v1/batches/([\w-]+)", path)
+            if match and match.group(1) in mock.batches:
+                batch_id = match.group(1)
+                if not mock.batch_done(batch_id):
+                    return self._send(200, {"id": batch_id, "object": "batch", "status": "in_progress"})
+                output_id = f"file-out-{batch_id}"
+                if output_id not in mock.files:
+                    lines = [json.dumps({"id": f"req-{i}", "custom_id": r["custom_id"], "error": None,
+                                         "response": {"status_code": 200, "body": mock.openai_response(r["body"])}})
+                             for i, r in enumerate(mock.batches[batch_id]["requests"])]
+                    with mock.lock:
+                        mock.files[output_id] = "\n".join(lines).encode()
+                return self._send(200, {"id": batch_id, "object": "batch", "status": "completed",
+                                        "output_file_id": output_id, "error_file_id": None})
+
+            # OpenAI file content: GET /v1/files/<id>/content
+            match = re.fullmatch(r"/v1/files/([\w-]+)/content", path)
+            if match and match.group(1) in mock.files:
+                return self._send(200, mock.files[match.group(1)], "application/jsonl")
+
+            # Anthropic batch status / results
+            match = re.fullmatch(r"/v1/messages/batches/([\w-]+)(/results)?", path)
+            if match and match.group(1) in mock.batches:
+                batch_id = match.group(1)
+                done = mock.batch_done(batch_id)
+                if not match.group(2):
+                    return self._send(200, {
+                        "id": batch_id, "type": "message_batch",
+                        "processing_status": "ended" if done else "in_progress",
+                        "results_url": f"{self._base()}/v1/messages/batches/{batch_id}/results" if done else None,
+                    })
+                lines = [json.dumps({"custom_id": r["custom_id"],
+                                     "result": {"type": "succeeded", "message": mock.anthropic_response(r["params"])}})
+                         for r in mock.batches[batch_id]["requests"]]
+                return self._send(200, "\n".join(lines).encode(), "application/jsonl")
+
+            return self._send(404, {"error": f"unknown endpoint {path}"})
+
+    return Handler
+
+
+def start_server(port=8089, host="127.0.0.1", **options):
+    """Start the stand-in provider on a background thread; returns the server"""
+    server = ThreadingHTTPServer((host, port), make_handler(MockProvider(**options)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini/OpenAI/Anthropic APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--batch-delay", type=float, default=5.0,
+                        help="Seconds before a submitted batch reports completion")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds each regular (non-batch) call takes")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="Random +/- seconds added to --latency")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="Fraction of regular calls answered with 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="Fraction of regular calls answered with 500")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    mock = MockProvider(batch_delay=args.batch_delay, latency=args.latency, jitter=args.jitter,
+                        rate_limit=args.rate_limit, failure_rate=args.failure_rate, seed=args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(mock))
+    base = f"http://{args.host}:{args.port}"
+    print(f"🧪 Mock provider on {base}")
+    print(f"   GEMINI_BASE_URL={base}")
+    print(f"   OPENAI_BASE_URL={base}/v1")
+    print(f"   ANTHROPIC_BASE_URL={base}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+BAJAJ HEALTH DATATHON - Document Extraction System
+Replay
+
+Re-runs parsing, math validation and the local fraud rules over stored
+result_*.json files (e.g. Dataset-results/) without calling the AI, and
+reports which documents would change risk level or math check. Use it to
+try a new tolerance or fraud rule on past documents, then --write to
+apply it.
+
+Usage:
+    python replay.py Dataset-results
+    python replay.py Dataset-results --tolerance 0.5 --risk-threshold 5
+    python replay.py Dataset-results --benford-baseline outputs/benford.sqlite --write
+"""
+import os
+import sys
+import json
+import argparse
+from datetime import datetime
+
+from app.replay import replay_store
+
+
+def print_report(report, limit=20):
+    print(f"\n📊 Replayed {report['documents']} result(s) in {report['elapsed_s']}s "
+          f"({report['docs_per_s']} docs/s), {report['errors']} error(s)")
+    print(f"   Sources: {report['sources']}")
+    print(f"   Changed: {report['changed']}")
+    for change, count in sorted(report["risk_changes"].items()):
+        print(f"   🛡️ Risk {change}: {count}")
+    for change, count in sorted(report["match_changes"].items()):
+        print(f"   💰 Math match {change}: {count}")
+    for entry in report["changes"][:limit]:
+        print(f"   - {os.path.basename(entry['ref'])}: {entry['risk_before']} -> {entry['risk_after']}, "
+              f"+{len(entry['flags_added'])}/-{len(entry['flags_removed'])} flag(s)")
+    if report["changed"] > limit:
+        print(f"   ... and {report['changed'] - limit} more (see the report file)")
+    for failure in report["failures"][:limit]:
+        print(f"   ❌ {failure['ref']}: {failure['error']}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Re-run validation and fraud rules over stored results")
+    parser.add_argument("store", help="Directory of result_*.json files (searched recursively) or one file")
+    parser.add_argument("--tolerance", type=float, default=None,
+                        help="Math match tolerance (default: MATH_MATCH_TOLERANCE or 0.10)")
+    parser.add_argument("--risk-threshold", type=float, default=None,
+                        help="Mismatch that raises LOW risk to MEDIUM (default: MATH_RISK_THRESHOLD or 1.0)")
+    parser.add_argument("--benford-baseline", default=None,
+                        help="SQLite file with per-vendor/hospital digit baselines (read only)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: number of CPUs, 1 = no pool)")
+    parser.add_argument("--write", action="store_true",
+                        help="Rewrite changed results in place")
+    parser.add_argument("--report", default=None,
+                        help="Diff report path (default: replays/replay_<timestamp>.json)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.exists(args.store):
+        print(f"❌ {args.store} not found")
+        sys.exit(1)
+
+    print(f"🔁 Replaying {args.store}{' (writing changes)' if args.write else ''}...")
+    report = replay_store(args.store, args.workers, args.tolerance, args.risk_threshold,
+                          args.benford_baseline, args.write)
+    report["timestamp"] = datetime.now().isoformat(timespec="seconds")
+    print_report(report)
+
+    path = args.report or os.path.join("replays", f"replay_{datetime.now():%Y%m%d_%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n📝 Report saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
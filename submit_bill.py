@@ -8,468 +8,647 @@ It handles PDF conversion, OCR, and AI analysis.
 import os
 import sys
 import json
-import base64
 import time
-import requests
 import glob
-import pytesseract
-from PIL import Image
-from dotenv import load_dotenv
-import pypdf
-import io
-
-# Load environment variables
-load_dotenv()
-
-# Configuration
-TESSERACT_CMD = os.getenv("TESSERACT_CMD", r"C:\Program Files\Tesseract-OCR\tesseract.exe")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-
-# Set Tesseract path
-if os.path.exists(TESSERACT_CMD):
-    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
-
-# Set Poppler Path
-POPPLER_PATH = r"C:\Program Files\poppler-25.11.0\Library\bin"
-if os.path.exists(POPPLER_PATH):
-    os.environ["PATH"] += os.pathsep + POPPLER_PATH
-else:
-    POPPLER_PATH_ALT = r"C:\Program Files\poppler-25.11.0\bin"
-    if os.path.exists(POPPLER_PATH_ALT):
-        os.environ["PATH"] += os.pathsep + POPPLER_PATH_ALT
-
-def clean_json_string(json_str):
-    """Clean AI output to get valid JSON"""
-    json_str = json_str.replace("```json", "").replace("```", "")
-    start = json_str.find("{")
-    end = json_str.rfind("}")
-    if start != -1 and end != -1:
-        json_str = json_str[start:end+1]
-    return json_str
-
-def encode_pil_image(image):
-    """Convert PIL Image to base64 string"""
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-def extract_content(file_path):
-    """Extract content for AI (Vision prioritized)"""
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from app.manifest import RunManifest, file_sha256
+from app.generation import DEFAULT_PROFILE, PROFILES
+from app.metrics import StageTimer, record_job
+from app import extraction, page_index, tariff
+from app.providers import analyze_document, api_pool, clean_json_string, get_common_prompt
+from app.validation import validate_math
+from app.reconcile import reconcile
+from app.replay import attach_raw_response
+
+# Generation profile used when a job does not ask for one (fast / balanced / thorough)
+GENERATION_PROFILE = DEFAULT_PROFILE
+
+# Where result_<name>.json files go and the run manifest (set from CLI args in main)
+OUTPUT_DIR = "."
+MANIFEST = None
+SINK = None  # Optional consolidated JSONL/Parquet output (--sink)
+DUPLICATE_INDEX = None  # Optional cross-document duplicate index (--duplicate-index)
+BENFORD_ENGINE = None  # Benford digit analysis (baselines persisted with --benford-baseline)
+TARIFF_INDEX = None  # Reference unit prices (--tariff-catalog, learned statistics in --tariff-stats)
+PAGE_SELECTION = {}  # pages / page_role from --pages / --page-role
+ARTIFACTS = None  # Extracted content kept for retries and reruns (<output-dir>/.artifacts)
+
+def extract_content(file_path, pages=None, page_role=None):
+    """Extract content for AI (Vision prioritized), optionally only some pages"""
     print(f"🔍 Extracting content from {os.path.basename(file_path)}...")
-    
-    content = {
-        "text": "",
-        "page_count": 1,
-        "images": [], # List of base64 images
-        "extraction_method": "unknown"
-    }
-    
+    # Already running in this script's extraction pool (or one file at a time)
+    from app import preprocess
+    preprocess.USE_POOL = False
     try:
-        if file_path.lower().endswith('.pdf'):
-            # Try converting PDF to Images (Best for Vision)
-            try:
-                from pdf2image import convert_from_path
-                print("   📸 Converting PDF pages to images...")
-                pil_images = convert_from_path(file_path)
-                content["page_count"] = len(pil_images)
-                content["images"] = [encode_pil_image(img) for img in pil_images]
-                content["extraction_method"] = "pdf_vision"
-                
-                # Also extract text as backup
-                reader = pypdf.PdfReader(file_path)
-                for i, page in enumerate(reader.pages):
-                    content["text"] += f"\n--- PAGE {i+1} ---\n{page.extract_text()}"
-                    
-            except Exception as e:
-                print(f"   ⚠️ PDF Vision failed: {e}")
-                # Fallback: Text Only
-                reader = pypdf.PdfReader(file_path)
-                content["page_count"] = len(reader.pages)
-                for i, page in enumerate(reader.pages):
-                    content["text"] += f"\n--- PAGE {i+1} ---\n{page.extract_text()}"
-                content["extraction_method"] = "pdf_text_only"
-                
-        else:
-            # Image Processing
-            print("   📸 Processing Image...")
-            with open(file_path, "rb") as f:
-                img_bytes = f.read()
-                content["images"] = [base64.b64encode(img_bytes).decode('utf-8')]
-            
-            try:
-                content["text"] = pytesseract.image_to_string(Image.open(file_path))
-            except: pass
-            content["extraction_method"] = "image_vision"
-            
-    except Exception as e:
-        print(f"❌ Extraction Error: {e}")
-        
+        return extraction.extract_content(file_path, pages=pages, page_role=page_role)
+    except extraction.PageSelectionError as e:
+        print(f"   ❌ {e}")
+        return {"text": "", "page_count": 0, "images": [], "extraction_method": "unknown"}
+
+def has_content(content):
+    return bool(content["text"].strip() or content["images"])
+
+def artifact_key(file_path):
+    """Content hash + page selection, so a changed file or selection never reuses old pages"""
+    return f"{file_sha256(file_path)}|{PAGE_SELECTION.get('pages')}|{PAGE_SELECTION.get('page_role')}"
+
+def cached_content(file_path):
+    """Content extracted by an earlier attempt (within ARTIFACT_TTL_SECONDS), or None"""
+    if not ARTIFACTS:
+        return None
+    content = ARTIFACTS.get(artifact_key(file_path)).get("content")
+    if content:
+        print(f"♻️ Reusing extracted content for {os.path.basename(file_path)}")
     return content
 
-# --- AI PROVIDERS & LOAD BALANCING ---
-
-API_POOL = []
-CURRENT_KEY_INDEX = 0
-
-def load_api_keys():
-    """Load all available API keys into a pool"""
-    global API_POOL
-    API_POOL = []
-    
-    # Helper to add keys
-    def add_keys(prefix, provider_name):
-        # Check base key
-        key = os.getenv(f"{prefix}_API_KEY")
-        if key: API_POOL.append({"provider": provider_name, "key": key})
-        
-        # Check numbered keys (1-10)
-        for i in range(1, 11):
-            key = os.getenv(f"{prefix}_API_KEY_{i}")
-            if key: API_POOL.append({"provider": provider_name, "key": key})
-
-    add_keys("GEMINI", "gemini")
-    add_keys("OPENAI", "openai")
-    add_keys("ANTHROPIC", "anthropic")
-    
-    if not API_POOL:
-        print("❌ No API Keys found! Set GEMINI_API_KEY, OPENAI_API_KEY, or ANTHROPIC_API_KEY in .env")
-        sys.exit(1)
-        
-    print(f"⚡ Loaded {len(API_POOL)} API Key(s) for Load Balancing")
-
-# Initialize Pool
-load_api_keys()
-
-def get_next_provider():
-    """Round-robin selection of API provider"""
-    global CURRENT_KEY_INDEX
-    if not API_POOL: return None
-    
-    provider = API_POOL[CURRENT_KEY_INDEX]
-    CURRENT_KEY_INDEX = (CURRENT_KEY_INDEX + 1) % len(API_POOL)
-    return provider
-
-def get_common_prompt(filename, page_count):
-    return f"""
-    You are an expert Forensic Auditor. Analyze this document (Filename: {filename}, Pages: {page_count}).
-
-    INSTRUCTIONS:
-    1. **EXTRACTION**: Extract all visible data. If a Total is clearly the final amount to be paid, extract it.
-    2. **PAGE MAPPING**: Assign items to their correct pages based on visual markers.
-    3. **ANALYSIS**: Flag visual anomalies (edits, fonts) and duplicate items.
-
-    TASK:
-    1. Extract Header Info.
-    2. Extract Line Items (Description, Qty, Unit Price, Amount).
-    3. Extract Financial Totals (Subtotal, Tax, Total).
-
-    OUTPUT JSON STRUCTURE:
-    {{
-        "file_info": {{
-            "file_name": "{filename}",
-            "page_count": {page_count},
-            "document_type": "Invoice/Receipt/Bill/Statement",
-            "document_title": "string",
-            "printed_on": "string or null"
-        }},
-        "header": {{
-            "id": "string",
-            "date": "YYYY-MM-DD",
-            "vendor_name": "string",
-            "recipient_name": "string"
-        }},
-        "pages": [
-            {{
-                "page_number": 1,
-                "line_items": [
-                    {{"description": "string", "quantity": number, "unit_price": number, "amount": number}}
-                ],
-                "page_anomalies": ["list", "of", "visual", "issues"]
-            }}
-        ],
-        "financials": {{
-            "subtotal": number,
-            "tax": number,
-            "extracted_total": number
-        }},
-        "fraud_analysis": {{
-            "risk_level": "LOW/MEDIUM/HIGH",
-            "pixel_anomalies_detected": boolean,
-            "duplicates_detected": boolean,
-            "flags": ["list", "of", "issues"],
-            "reasoning": "detailed explanation"
-        }}
-    }}
-    """
-
-def call_gemini(content, filename, api_key):
-    print(f"🤖 Analyzing {filename} with Gemini 2.5 Flash (Key: ...{api_key[-4:]})...")
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={api_key}"
-    
-    parts = [{"text": get_common_prompt(filename, content['page_count'])}]
-    
-    for i, img_b64 in enumerate(content["images"][:5]):
-        parts.append({"text": f"--- VISUAL DATA FOR PAGE {i+1} ---"})
-        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": img_b64}})
-
-    if content["text"]:
-        parts.append({"text": f"EXTRACTED TEXT CONTEXT:\n{content['text']}"})
+def store_content(file_path, content):
+    if ARTIFACTS and has_content(content):
+        ARTIFACTS.put(artifact_key(file_path), content=content)
 
-    # Retry Logic
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(
-                url, headers={'Content-Type': 'application/json'},
-                json={"contents": [{"parts": parts}]}, timeout=120
-            )
-            if response.status_code == 200:
-                res_json = response.json()
-                text = res_json['candidates'][0]['content']['parts'][0]['text']
-                usage = res_json.get('usageMetadata', {})
-                token_info = {
-                    "prompt_tokens": usage.get('promptTokenCount', 0),
-                    "output_tokens": usage.get('candidatesTokenCount', 0),
-                    "total_tokens": usage.get('totalTokenCount', 0),
-                    "model": "gemini-2.5-flash"
-                }
-                return text, token_info
-            elif response.status_code == 429:
-                print(f"   ⏳ Rate limit hit. Waiting 5s... (Attempt {attempt+1}/{max_retries})")
-                time.sleep(5)
-            else:
-                print(f"❌ Gemini Error: {response.text}")
-                return None, None
-        except Exception as e:
-            print(f"   ⚠️ Request Failed: {e}. Retrying...")
-            time.sleep(2)
-            
-    return None, None
+def load_or_extract(file_path):
+    """Extracted content from the artifact store, or extract (and store) it now"""
+    content = cached_content(file_path)
+    if content is None:
+        content = extract_content(file_path, **PAGE_SELECTION)
+        store_content(file_path, content)
+    return content
 
-def call_openai(content, filename, api_key):
-    print(f"🤖 Analyzing {filename} with GPT-4o (Key: ...{api_key[-4:]})...")
+def timed_analysis(content, filename):
+    """analyze_document() with the provider call recorded on the file's StageTimer"""
+    timer = StageTimer(content.get("stage_timings"))
+    with timer.active(), timer.stage("provider_call"):
+        json_str, token_info = analyze_document(content, filename, GENERATION_PROFILE)
+    return json_str, token_info, timer
+
+def save_result(file_path, json_str, token_info, forensics=None, timer=None, extraction_method=None,
+                page_selection=None, page_hashes=None, skipped_pages=None, content=None):
+    """Parse the AI response, validate it and write result_<name>.json.
+    With the extracted content, pages that do not add up are re-extracted first (app/reconcile.py).
+    Returns the output path, or None if the response was not valid JSON or could not be
+    processed (the caller records the failure and moves on to the next file)."""
+    timer = timer or StageTimer()
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
+        with timer.stage("json_parse"):
+            data = json.loads(clean_json_string(json_str))
+        # Boilerplate pages left out of the call: learn from this answer, put their known content back
+        with timer.stage("page_index"):
+            data = page_index.apply(data, page_hashes, skipped_pages, os.path.basename(file_path))
         
-        messages = [
-            {"role": "system", "content": "You are a JSON-only extraction API."},
-            {"role": "user", "content": []}
-        ]
-        
-        user_content = messages[1]["content"]
-        user_content.append({"type": "text", "text": get_common_prompt(filename, content['page_count'])})
-        
-        for i, img_b64 in enumerate(content["images"][:5]):
-            user_content.append({"type": "text", "text": f"--- PAGE {i+1} ---"})
-            user_content.append({
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
-            })
+        # Inject Token Info at the top
+        if token_info:
+            data = {"token_usage": token_info, **data}
+        # Raw answer, so new validation / fraud rules can be replayed without the AI
+        data = attach_raw_response(data, json_str)
             
-        if content["text"]:
-            user_content.append({"type": "text", "text": f"TEXT CONTEXT:\n{content['text']}"})
-
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            response_format={"type": "json_object"},
-            max_tokens=4000
-        )
-        
-        text = response.choices[0].message.content
-        usage = response.usage
-        token_info = {
-            "prompt_tokens": usage.prompt_tokens,
-            "output_tokens": usage.completion_tokens,
-            "total_tokens": usage.total_tokens,
-            "model": "gpt-4o"
-        }
-        return text, token_info
-    except Exception as e:
-        print(f"❌ OpenAI Error: {e}")
-        return None, None
-
-def call_anthropic(content, filename, api_key):
-    print(f"🤖 Analyzing {filename} with Claude 3.5 Sonnet (Key: ...{api_key[-4:]})...")
-    try:
-        import anthropic
-        client = anthropic.Anthropic(api_key=api_key)
-        
-        message_content = []
+        with timer.active(), timer.stage("reconcile"):
+            data = reconcile(data, content, os.path.basename(file_path), GENERATION_PROFILE)
+        with timer.stage("validate"):
+            data, match_status = validate_math(data)
+        with timer.stage("fraud_rules"):
+            from app.forensics import merge_forensics
+            data = merge_forensics(data, forensics)
+            if BENFORD_ENGINE:
+                data = BENFORD_ENGINE.annotate(data)
+            if TARIFF_INDEX:
+                data = TARIFF_INDEX.annotate(data)
+            if DUPLICATE_INDEX:
+                # Same path + same content is a rerun, not a duplicate bill
+                doc_id = f"{os.path.abspath(file_path)}#{file_sha256(file_path)[:16]}"
+                data = DUPLICATE_INDEX.annotate(data, doc_id=doc_id, source=os.path.basename(file_path))
         
-        # Add Images
-        for i, img_b64 in enumerate(content["images"][:5]):
-            message_content.append({
-                "type": "image",
-                "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64}
-            })
-            
-        # Add Text Prompt
-        prompt = get_common_prompt(filename, content['page_count'])
-        if content["text"]:
-            prompt += f"\n\nTEXT CONTEXT:\n{content['text']}"
-            
-        message_content.append({"type": "text", "text": prompt})
-
-        response = client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=4000,
-            messages=[{"role": "user", "content": message_content}]
-        )
+        output_file = os.path.join(OUTPUT_DIR, f"result_{os.path.basename(file_path)}.json")
+        with timer.stage("sink"):
+            data["processing_metadata"] = {"extraction_method": extraction_method, **timer.metadata()}
+            if page_selection:
+                data["processing_metadata"]["page_selection"] = page_selection
+            if skipped_pages:
+                data["processing_metadata"]["skipped_pages"] = [s["page_number"] for s in skipped_pages]
+            with open(output_file, "w") as f:
+                json.dump(data, f, indent=2)
+            if SINK:
+                SINK.write(data, source_file=file_path)
+        timer.export((token_info or {}).get("model"), extraction_method)
+        record_job("completed", token_info, extraction_method)
+        print(f"   ✅ Saved to {output_file}")
+        print(f"   🛡️ Risk: {data.get('fraud_analysis', {}).get('risk_level', 'UNKNOWN')}")
+        print(f"   💰 Math Validation: {match_status}")
+        corrected = (data.get("reconciliation") or {}).get("corrected_pages")
+        if corrected:
+            print(f"   🔧 Re-extracted page(s) {', '.join(str(c['page_number']) for c in corrected)}")
+        if token_info:
+            print(f"   🔢 Tokens: {token_info['total_tokens']} ({token_info['model']}, "
+                  f"{token_info.get('reasoning_tokens', 0)} reasoning, profile {token_info.get('profile')})")
+        return output_file
         
-        text = response.content[0].text
-        usage = response.usage
-        token_info = {
-            "prompt_tokens": usage.input_tokens,
-            "output_tokens": usage.output_tokens,
-            "total_tokens": usage.input_tokens + usage.output_tokens,
-            "model": "claude-3-5-sonnet"
-        }
-        return text, token_info
+    except json.JSONDecodeError:
+        print("   ❌ Invalid JSON from AI")
+        record_job("failed", token_info, extraction_method)
+        return None
     except Exception as e:
-        print(f"❌ Anthropic Error: {e}")
-        return None, None
+        # One bad answer (not an object, a failing check) must not stop the other files
+        print(f"   ❌ Could not process the AI response: {type(e).__name__}: {e}")
+        record_job("failed", token_info, extraction_method)
+        return None
+
+def record_outcome(file_path, output_file, token_info, error=None):
+    """Write the outcome of one attempt to the run manifest (if enabled)"""
+    if MANIFEST:
+        MANIFEST.finish(file_path, bool(output_file), token_info, output_file,
+                        None if output_file else (error or "AI analysis failed"))
+    return bool(output_file)
 
-def analyze_document(content, filename):
-    """Route to available AI provider using Round-Robin"""
-    provider_info = get_next_provider()
-    
-    if not provider_info:
-        return None, None
-        
-    provider = provider_info["provider"]
-    key = provider_info["key"]
+def process_file(file_path):
+    print(f"\n🚀 Processing: {file_path}")
+    if MANIFEST: MANIFEST.start(file_path)
+    content = load_or_extract(file_path)
     
-    if provider == "gemini":
-        return call_gemini(content, filename, key)
-    elif provider == "openai":
-        return call_openai(content, filename, key)
-    elif provider == "anthropic":
-        return call_anthropic(content, filename, key)
+    if not has_content(content):
+        print("   ❌ No content found")
+        return record_outcome(file_path, None, None, "No content found")
+
+    json_str, token_info, timer = timed_analysis(content, os.path.basename(file_path))
     
-    return None, None
+    output_file = save_result(file_path, json_str, token_info, content.get("forensics"),
+                              timer, content.get("extraction_method"),
+                              content.get("page_selection"), content.get("page_hashes"),
+                              content.get("skipped_pages"), content) if json_str else None
+    return record_outcome(file_path, output_file, token_info)
+
+# --- PIPELINED MODE ---
+
+class ProgressDisplay:
+    """Live progress and throughput line for pipelined runs"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.started = time.time()
+
+    def update(self, success=None):
+        if success is not None:
+            self.done += 1
+            if not success:
+                self.failed += 1
+        elapsed = time.time() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        pct = 100.0 * self.done / self.total if self.total else 100.0
+        print(f"   📊 [{self.done}/{self.total}] {pct:.0f}% | {rate:.2f} files/s | "
+              f"AI in flight: {self.in_flight} | failed: {self.failed} | {elapsed:.1f}s", flush=True)
+
+def run_pipeline(files, workers, concurrency):
+    """
+    Staged pipeline over a list of files:
+    rasterize + OCR in a process pool, provider calls on a thread pool
+    (one slot per concurrent request), validate + write in this thread
+    as soon as each response arrives.
+    Returns (failed_files, contents) where contents holds the extracted
+    content of the failed files so retries skip the extraction stage;
+    a file's pages are let go as soon as its result is saved.
+    """
+    progress = ProgressDisplay(len(files))
+    failed_files = []
+    contents = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as extract_pool, \
+         ThreadPoolExecutor(max_workers=concurrency) as ai_pool:
+        pending = {}
+        for f in files:
+            if MANIFEST: MANIFEST.start(f)
+            content = cached_content(f)
+            if content:
+                # Already extracted by an earlier run: straight to the AI stage
+                contents[f] = content
+                progress.in_flight += 1
+                pending[ai_pool.submit(timed_analysis, content, os.path.basename(f))] = ("analyze", f)
+            else:
+                pending[extract_pool.submit(extract_content, f, **PAGE_SELECTION)] = ("extract", f)
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                step, f = pending.pop(fut)
+
+                if step == "extract":
+                    try:
+                        content = fut.result()
+                    except Exception as e:
+                        print(f"   ❌ Extraction crashed for {f}: {e}")
+                        record_outcome(f, None, None, f"Extraction crashed: {e}")
+                        failed_files.append(f)
+                        progress.update(False)
+                        continue
+                    if not has_content(content):
+                        print(f"   ❌ No content found in {f}")
+                        record_outcome(f, None, None, "No content found")
+                        failed_files.append(f)
+                        progress.update(False)
+                        continue
+                    store_content(f, content)
+                    contents[f] = content
+                    progress.in_flight += 1
+                    pending[ai_pool.submit(timed_analysis, content, os.path.basename(f))] = ("analyze", f)
 
-def validate_math(data):
-    """Perform Python-side math validation"""
-    try:
-        calculated_total = 0.0
-        line_items = []
-        
-        if "pages" in data:
-            for page in data["pages"]:
-                if "line_items" in page:
-                    line_items.extend(page["line_items"])
-        elif "line_items" in data:
-            line_items = data["line_items"]
-            
-        for item in line_items:
-            amount = item.get("amount")
-            if amount is not None:
-                try: calculated_total += float(amount)
-                except: pass
-                
-        financials = data.get("financials", {})
-        extracted_total = financials.get("extracted_total")
-        
-        is_match = None
-        match_status = "UNKNOWN"
-        
-        if extracted_total is not None:
-            try:
-                extracted_total = float(extracted_total)
-                if abs(extracted_total - calculated_total) < 0.10:
-                    is_match = True
-                    match_status = "MATCH"
                 else:
-                    is_match = False
-                    match_status = "MISMATCH"
-            except:
-                match_status = "INVALID_TOTAL_FORMAT"
+                    progress.in_flight -= 1
+                    content = contents[f]
+                    try:
+                        json_str, token_info, timer = fut.result()
+                    except Exception as e:
+                        print(f"   ❌ AI call crashed for {f}: {e}")
+                        json_str, token_info, timer = None, None, None
+                    print(f"\n🧾 {f}")
+                    output_file = save_result(f, json_str, token_info, content.get("forensics"),
+                                              timer, content.get("extraction_method"),
+                                              content.get("page_selection"), content.get("page_hashes"),
+                                              content.get("skipped_pages"), content) if json_str else None
+                    success = record_outcome(f, output_file, token_info)
+                    if success:
+                        del contents[f]
+                    else:
+                        failed_files.append(f)
+                    progress.update(success)
+
+    return failed_files, contents
+
+def retry_pipeline(failed_files, contents, concurrency):
+    """Retry failed files concurrently, reusing already extracted content"""
+    progress = ProgressDisplay(len(failed_files))
+    
+    def retry_one(f):
+        if MANIFEST: MANIFEST.start(f)
+        content = contents.get(f) or load_or_extract(f)
+        if not has_content(content):
+            return f, content, None, None, None
+        json_str, token_info, timer = timed_analysis(content, os.path.basename(f))
+        return f, content, json_str, token_info, timer
+
+    with ThreadPoolExecutor(max_workers=concurrency) as ai_pool:
+        futures = [ai_pool.submit(retry_one, f) for f in failed_files]
+        progress.in_flight = len(futures)
+        for fut in futures:
+            f, content, json_str, token_info, timer = fut.result()
+            progress.in_flight -= 1
+            print(f"\n🔁 {f}")
+            output_file = save_result(f, json_str, token_info, content.get("forensics"),
+                                      timer, content.get("extraction_method"),
+                                      content.get("page_selection"), content.get("page_hashes"),
+                                      content.get("skipped_pages"), content) if json_str else None
+            progress.update(record_outcome(f, output_file, token_info))
+
+# --- PACKED MODE ---
+
+def run_packed(files, workers, concurrency):
+    """
+    Extract every file, then send small documents (single-page receipts,
+    photos) several to a provider call and everything else one per call.
+    Files a packed answer does not cover are sent again on their own.
+    Returns (failed_files, contents) like run_pipeline.
+    """
+    from app.packing import plan_packs, analyze_pack
+    progress = ProgressDisplay(len(files))
+    failed_files = []
+    contents = {}
+
+    print(f"🔍 Extracting {len(files)} files...")
+    with ProcessPoolExecutor(max_workers=workers) as extract_pool:
+        cached = {f: cached_content(f) for f in files}
+        todo = [f for f in files if not cached[f]]
+        extracted = dict(zip(todo, extract_pool.map(partial(extract_content, **PAGE_SELECTION), todo)))
+
+    documents = []
+    for f in files:
+        if MANIFEST: MANIFEST.start(f)
+        content = cached[f] or extracted[f]
+        if f in extracted:
+            store_content(f, content)
+        if not has_content(content):
+            print(f"   ❌ No content found in {f}")
+            record_outcome(f, None, None, "No content found")
+            failed_files.append(f)
+            progress.update(False)
+            continue
+        contents[f] = content
+        documents.append({"ref": f, "filename": os.path.basename(f), "content": content})
+
+    packs, singles = plan_packs(documents, GENERATION_PROFILE)
+    print(f"📦 {sum(map(len, packs))} small file(s) in {len(packs)} packed call(s), {len(singles)} on their own")
+
+    def finish(f, json_str, token_info, timer):
+        content = contents[f]
+        output_file = save_result(f, json_str, token_info, content.get("forensics"),
+                                  timer, content.get("extraction_method"),
+                                  content.get("page_selection"), content.get("page_hashes"),
+                                  content.get("skipped_pages"), content) if json_str else None
+        success = record_outcome(f, output_file, token_info)
+        if success:
+            del contents[f]
         else:
-            match_status = "TOTAL_MISSING"
-
-        financials["calculated_total"] = round(calculated_total, 2)
-        financials["is_match"] = is_match
-        data["financials"] = financials
-        
-        fraud = data.get("fraud_analysis", {})
-        if is_match is False and extracted_total is not None:
-            fraud["math_mismatch_detected"] = True
-            msg = f"Math mismatch: Extracted {extracted_total} vs Calculated {round(calculated_total, 2)}"
-            if msg not in fraud.get("flags", []):
-                fraud.setdefault("flags", []).append(msg)
-            if abs(extracted_total - calculated_total) > 1.0:
-                 if fraud.get("risk_level") == "LOW":
-                     fraud["risk_level"] = "MEDIUM"
+            failed_files.append(f)
+        progress.update(success)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as ai_pool:
+        pending = {ai_pool.submit(analyze_pack, pack, GENERATION_PROFILE): ("pack", pack) for pack in packs}
+        for doc in singles:
+            pending[ai_pool.submit(timed_analysis, doc["content"], doc["filename"])] = ("single", doc["ref"])
+        progress.in_flight = len(pending)
+        # The pending calls and contents now hold each file's pages until its result is saved
+        del documents, packs, singles
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                kind, item = pending.pop(fut)
+                progress.in_flight -= 1
+
+                if kind == "single":
+                    try:
+                        json_str, token_info, timer = fut.result()
+                    except Exception as e:
+                        print(f"   ❌ AI call crashed for {item}: {e}")
+                        json_str, token_info, timer = None, None, None
+                    print(f"\n🧾 {item}")
+                    finish(item, json_str, token_info, timer)
+                    continue
+
+                try:
+                    results, pack_timer = fut.result()
+                except Exception as e:
+                    print(f"   ❌ Packed AI call crashed: {e}")
+                    results, pack_timer = {}, StageTimer()
+                for doc in item:
+                    f = doc["ref"]
+                    if f not in results:
+                        # Not covered by the packed answer: send it on its own
+                        progress.in_flight += 1
+                        pending[ai_pool.submit(timed_analysis, doc["content"], doc["filename"])] = ("single", f)
+                        continue
+                    json_str, token_info = results[f]
+                    timer = StageTimer({**doc["content"].get("stage_timings", {}), **pack_timer.stages})
+                    print(f"\n🧾 {f} (packed with {len(item) - 1} other file(s))")
+                    finish(f, json_str, token_info, timer)
+
+    return failed_files, contents
+
+# --- CLIENT MODE ---
+
+def run_client(files, server, concurrency, mode=None, tenant=None):
+    """
+    Send the files to a running API server (--server) instead of processing
+    them here, and write each result_<name>.json as its job finishes. The
+    batch is remembered in <output-dir>/.server_batch.json, so an
+    interrupted run picks up its jobs when started again.
+    """
+    from app.client import ApiClient, BatchState, upload_files, follow_batch
+    client = ApiClient(server, tenant)
+    state = BatchState(os.path.join(OUTPUT_DIR, ".server_batch.json"), client.base)
+    params = {"profile": GENERATION_PROFILE, "mode": mode, "priority": "batch", **PAGE_SELECTION}
+    params = {k: v for k, v in params.items() if v}
+    progress = ProgressDisplay(len(files))
+    
+    resumed = len(state.pending(files))
+    if resumed:
+        print(f"♻️ Resuming batch {state.batch_id}: {resumed} file(s) already uploaded")
+    for f in files:
+        if MANIFEST: MANIFEST.start(f)
+    upload_files(client, state, files, params, concurrency)
+    progress.in_flight = len(state.pending(files))
+    
+    def on_result(f, job):
+        result = job.get("result")
+        output_file = None
+        if job.get("status") == "completed" and result:
+            output_file = os.path.join(OUTPUT_DIR, f"result_{os.path.basename(f)}.json")
+            with open(output_file, "w") as fh:
+                json.dump(result, fh, indent=2)
+            if SINK:
+                SINK.write(result, source_file=f)
         else:
-            fraud["math_mismatch_detected"] = False
-            
-        data["fraud_analysis"] = fraud
-        return data, match_status
-        
-    except Exception as e:
-        print(f"   ⚠️ Validation Error: {e}")
-        return data, "ERROR"
-
-def process_file(file_path):
-    print(f"\n🚀 Processing: {file_path}")
-    content = extract_content(file_path)
+            print(f"\n   ❌ {f}: {job.get('error') or 'failed on the server'}")
+        progress.in_flight -= 1
+        progress.update(record_outcome(f, output_file, (result or {}).get("token_usage"), job.get("error")))
     
-    if not content["text"].strip() and not content["images"]:
-        print("   ❌ No content found")
-        return False
+    follow_batch(client, state, files, on_result, params, concurrency)
+    state.discard()
 
-    json_str, token_info = analyze_document(content, os.path.basename(file_path))
-    
-    if json_str:
-        json_str = clean_json_string(json_str)
-        try:
-            data = json.loads(json_str)
-            
-            # Inject Token Info at the top
-            if token_info:
-                data = {"token_usage": token_info, **data}
-                
-            data, match_status = validate_math(data)
-            
-            output_file = f"result_{os.path.basename(file_path)}.json"
-            with open(output_file, "w") as f:
-                json.dump(data, f, indent=2)
-            print(f"   ✅ Saved to {output_file}")
-            print(f"   🛡️ Risk: {data.get('fraud_analysis', {}).get('risk_level', 'UNKNOWN')}")
-            print(f"   💰 Math Validation: {match_status}")
-            if token_info:
-                print(f"   🔢 Tokens: {token_info['total_tokens']} ({token_info['model']})")
-            return True
-            
-        except json.JSONDecodeError:
-            print("   ❌ Invalid JSON from AI")
-            return False
-    return False
+# --- BULK MODE ---
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python submit_bill.py <file_or_directory>")
-        return
+def run_bulk(files, workers, poll_seconds, resume=False):
+    """
+    Submit files through the providers' batch APIs and write each result as
+    its batch completes. With resume=True only waits for batches recorded in
+    the state file by an earlier run.
+    """
+    from app.bulk import BulkState, submit_documents, wait_for_batches, BULK_POLL_SECONDS
+    state = BulkState(os.path.join(OUTPUT_DIR, ".bulk_state.json"))
+    
+    if not resume:
+        print(f"🔍 Extracting {len(files)} files for bulk submission...")
+        with ProcessPoolExecutor(max_workers=workers) as extract_pool:
+            cached = {f: cached_content(f) for f in files}
+            todo = [f for f in files if not cached[f]]
+            extracted = dict(zip(todo, extract_pool.map(partial(extract_content, **PAGE_SELECTION), todo)))
+        contents = []
+        for f in files:
+            if f in extracted:
+                store_content(f, extracted[f])
+            contents.append(cached[f] or extracted[f])
+        
+        documents = []
+        for f, content in zip(files, contents):
+            if MANIFEST: MANIFEST.start(f)
+            if not has_content(content):
+                print(f"   ❌ No content found in {f}")
+                record_outcome(f, None, None, "No content found")
+                continue
+            documents.append({"ref": f, "filename": os.path.basename(f), "content": content,
+                              "extra": {"forensics": content.get("forensics"),
+                                        "stage_timings": content.get("stage_timings"),
+                                        "extraction_method": content.get("extraction_method"),
+                                        "page_selection": content.get("page_selection"),
+                                        "page_hashes": content.get("page_hashes"),
+                                        "skipped_pages": content.get("skipped_pages")}})
+        if documents:
+            submit_documents(documents, api_pool(), get_common_prompt, state, GENERATION_PROFILE)
+    
+    pending = sum(len(b["items"]) for b in state.pending().values())
+    print(f"⏳ Waiting for {len(state.pending())} provider batch(es) covering {pending} file(s)...")
+    
+    def on_result(item, json_str, token_info, error):
+        f = item["ref"]
+        print(f"\n📬 {f}")
+        extra = item.get("extra") or {}
+        timer = StageTimer(extra.get("stage_timings"))
+        output_file = save_result(f, json_str, token_info, extra.get("forensics"),
+                                  timer, extra.get("extraction_method"),
+                                  extra.get("page_selection"), extra.get("page_hashes"),
+                                  extra.get("skipped_pages")) if json_str else None
+        if error:
+            print(f"   ❌ {error}")
+        record_outcome(f, output_file, token_info, error)
+    
+    wait_for_batches(state, api_pool(), on_result, poll_seconds or BULK_POLL_SECONDS)
 
-    inputs = sys.argv[1:]
+def collect_files(inputs):
     files_to_process = []
-
     for inp in inputs:
         if os.path.isdir(inp):
             for ext in ['*.pdf', '*.jpg', '*.jpeg', '*.png']:
                 files_to_process.extend(glob.glob(os.path.join(inp, ext)))
         elif os.path.exists(inp):
             files_to_process.append(inp)
+    return files_to_process
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Extract bill/invoice data into result_<name>.json files"
+    )
+    parser.add_argument("inputs", nargs="*", help="Files or directories to process")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Process pool size for PDF rasterization + OCR (enables pipelined mode)")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="Concurrent AI calls (enables pipelined mode, default: number of API keys)")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Use the providers' batch APIs (cheaper, results arrive in minutes to hours)")
+    parser.add_argument("--bulk-resume", action="store_true",
+                        help="Only wait for batches submitted by an earlier --bulk run (no new submissions)")
+    parser.add_argument("--bulk-poll-interval", type=float, default=None,
+                        help="Seconds between batch status checks")
+    parser.add_argument("--pack", action="store_true",
+                        help="Send small files (single-page receipts, photos) several to one AI call")
+    parser.add_argument("--server", default=None,
+                        help="Send the files to a running API server (e.g. http://localhost:8000) instead")
+    parser.add_argument("--tenant", default=None,
+                        help="X-Tenant-ID to send to the server (--server)")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=sorted(PROFILES),
+                        help="Generation profile: fast (no thinking), balanced, thorough")
+    parser.add_argument("--pages", default=None,
+                        help="Only process these PDF pages, e.g. 1-3,7,10- (use --force to redo finished files)")
+    parser.add_argument("--page-role", default=None, choices=extraction.PAGE_ROLES,
+                        help="Only process PDF pages of this kind: summary (totals) or line_items")
+    parser.add_argument("--output-dir", default=".",
+                        help="Directory for result_<name>.json files (e.g. Dataset-results)")
+    parser.add_argument("--manifest", default=None,
+                        help="Run manifest (SQLite), default: <output-dir>/.submit_bill_manifest.sqlite")
+    parser.add_argument("--no-manifest", action="store_true",
+                        help="Do not record or resume from a run manifest")
+    parser.add_argument("--force", action="store_true",
+                        help="Reprocess files even if the manifest says they already succeeded")
+    parser.add_argument("--no-artifacts", action="store_true",
+                        help="Do not keep extracted content for retries and reruns (<output-dir>/.artifacts)")
+    parser.add_argument("--sink", default=None,
+                        help="Also append flattened rows to JSONL/Parquet tables in this directory")
+    parser.add_argument("--duplicate-index", default=None,
+                        help="SQLite index of past line items used to flag cross-document duplicate billing")
+    parser.add_argument("--page-index", default=None,
+                        help="SQLite page index shared across runs: skips pages known to be boilerplate")
+    parser.add_argument("--benford-baseline", default=":memory:",
+                        help="SQLite file with per-vendor/hospital digit baselines (default: this run only)")
+    parser.add_argument("--tariff-catalog", default=tariff.TARIFF_CATALOG_PATH,
+                        help="CSV of reference unit prices (description, price[, max_price][, code])")
+    parser.add_argument("--tariff-stats", default=tariff.TARIFF_STATS_PATH,
+                        help="SQLite file with item prices learned from past bills (default: this run only)")
+    parser.add_argument("--tariff-history", default=tariff.TARIFF_HISTORY_DIR,
+                        help="Learn item prices from the result_*.json files in this folder first")
+    return parser.parse_args(argv)
+
+def main():
+    global OUTPUT_DIR, MANIFEST, SINK, DUPLICATE_INDEX, BENFORD_ENGINE, TARIFF_INDEX, GENERATION_PROFILE, PAGE_SELECTION, ARTIFACTS
+    if len(sys.argv) < 2:
+        print("Usage: python submit_bill.py <file_or_directory> [--workers N] [--concurrency M] [--output-dir DIR]")
+        return
 
-    if not files_to_process:
+    args = parse_args(sys.argv[1:])
+    files_to_process = collect_files(args.inputs)
+
+    if not files_to_process and not args.bulk_resume:
         print("❌ No files found")
         return
 
+    OUTPUT_DIR = args.output_dir
+    GENERATION_PROFILE = args.profile
+    if args.pages or args.page_role:
+        try:
+            extraction.check_page_request(args.pages, args.page_role)
+        except extraction.PageSelectionError as e:
+            print(f"❌ {e}")
+            sys.exit(2)
+        PAGE_SELECTION = {"pages": args.pages, "page_role": args.page_role}
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    if not args.no_artifacts and not args.server:
+        from app.artifacts import ArtifactStore
+        ARTIFACTS = ArtifactStore(os.path.join(OUTPUT_DIR, ".artifacts"))
+    if args.page_index:
+        # Read by the extraction workers too
+        os.environ["PAGE_INDEX_PATH"] = page_index.PAGE_INDEX_PATH = args.page_index
+    from app import media
+    if media.MEDIA_UPLOADS and not media.MEDIA_CACHE_PATH:
+        media.use_cache_file(os.path.join(OUTPUT_DIR, ".media_cache.json"))
+    if args.sink:
+        from app.sinks import ResultSink
+        SINK = ResultSink(args.sink)
+    if args.duplicate_index:
+        from app.duplicates import DuplicateIndex
+        DUPLICATE_INDEX = DuplicateIndex(args.duplicate_index)
+    if not args.server:
+        from app.benford import BenfordEngine
+        BENFORD_ENGINE = BenfordEngine(args.benford_baseline)
+        TARIFF_INDEX = tariff.open_index(args.tariff_catalog, args.tariff_stats, args.tariff_history)
+    if not args.no_manifest:
+        MANIFEST = RunManifest(args.manifest or os.path.join(OUTPUT_DIR, ".submit_bill_manifest.sqlite"))
+        if not args.force:
+            done = {f for f in files_to_process if MANIFEST.is_done(f)}
+            if done:
+                print(f"⏭️ Skipping {len(done)} unchanged file(s) that already succeeded")
+                files_to_process = [f for f in files_to_process if f not in done]
+        if not files_to_process and not args.bulk_resume:
+            print("✅ Nothing to do - all files are up to date")
+            return
+
+    if args.server:
+        # The server does the extraction, AI calls and checks; keys stay there
+        mode = "bulk" if args.bulk else "pack" if args.pack else None
+        print(f"🌐 Sending {len(files_to_process)} file(s) to {args.server}")
+        started = time.time()
+        run_client(files_to_process, args.server, args.concurrency or 4, mode, args.tenant)
+        print(f"\n✅ Batch Processing Complete! ({time.time() - started:.1f}s)")
+        print_manifest_summary()
+        return
+
+    if not api_pool():
+        print("❌ No API Keys found! Set GEMINI_API_KEY, OPENAI_API_KEY, or ANTHROPIC_API_KEY in .env")
+        sys.exit(1)
+
     print(f"📦 Found {len(files_to_process)} files...")
+
+    if args.bulk or args.bulk_resume:
+        run_bulk(files_to_process, args.workers or os.cpu_count() or 1,
+                 args.bulk_poll_interval, resume=args.bulk_resume)
+        print("\n✅ Bulk Processing Complete!")
+        print_manifest_summary()
+        return
+
+    if args.workers or args.concurrency or args.pack:
+        workers = args.workers or os.cpu_count() or 1
+        concurrency = args.concurrency or len(api_pool())
+        mode = "Packed" if args.pack else "Pipelined"
+        print(f"⚙️ {mode} mode: {workers} extraction worker(s), {concurrency} concurrent AI call(s)")
+        started = time.time()
+        run = run_packed if args.pack else run_pipeline
+        failed_files, contents = run(files_to_process, workers, concurrency)
+
+        if failed_files:
+            print(f"\n\n⚠️ Retrying {len(failed_files)} failed files...")
+            time.sleep(5) # Cool down before retrying
+            retry_pipeline(failed_files, contents, concurrency)
+
+        print(f"\n✅ Batch Processing Complete! ({time.time() - started:.1f}s)")
+        print_manifest_summary()
+        return
+
     failed_files = []
 
     # 1. First Pass
@@ -495,6 +674,17 @@ def main():
             time.sleep(3)
 
     print("\n✅ Batch Processing Complete!")
+    print_manifest_summary()
+
+def print_manifest_summary():
+    if SINK:
+        SINK.close()
+        print(f"   🗃️ Consolidated tables: {SINK.directory}")
+    if not MANIFEST:
+        return
+    for status, info in sorted(MANIFEST.summary().items()):
+        print(f"   📒 {status}: {info['files']} file(s), {info['total_tokens']} tokens")
+    print(f"   📒 Manifest: {MANIFEST.db_path}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,31 @@
+"""Deskew straightens a page rotated by a known angle"""
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from app.preprocess import estimate_skew, preprocess_image
+
+
+def ruled_page():
+    """A white page with dark bars where the text lines would be"""
+    page = Image.new("L", (1200, 1600), 255)
+    draw = ImageDraw.Draw(page)
+    for y in range(150, 1450, 40):
+        draw.rectangle((150, y, 1050, y + 12), fill=0)
+    return page
+
+
+@pytest.mark.parametrize("angle", [-7.0, -4.0, 2.5, 4.0, 5.0])
+def test_deskew_removes_known_rotation(angle):
+    page = ruled_page().rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    assert estimate_skew(np.asarray(page)) == pytest.approx(angle, abs=0.3)
+
+    upload = io.BytesIO()
+    page.save(upload, format="PNG")
+    out = preprocess_image(upload.getvalue())
+
+    assert out["steps"]["deskew_degrees"] == pytest.approx(-angle, abs=0.3)
+    straightened = Image.open(io.BytesIO(out["image"])).convert("L")
+    assert estimate_skew(np.asarray(straightened)) == pytest.approx(0.0, abs=0.3)
@@ -0,0 +1,57 @@
+"""Replaying a result keeps what happened after the AI answered"""
+import copy
+import json
+
+from app import reconcile as reconcile_module
+from app.page_index import reattach
+from app.replay import attach_raw_response, diff_results, replay_result
+from app.validation import validate_math
+
+RAW = {
+    "pages": [
+        {"page_number": 1, "page_subtotal": 300.0, "line_items": [
+            {"description": "Room rent", "quantity": 2, "unit_price": 100.0, "amount": 200.0},
+            {"description": "Nursing", "quantity": 1, "unit_price": 100.0, "amount": 10.0},
+        ]},
+        {"page_number": 3, "line_items": [
+            {"description": "Pharmacy", "quantity": 1, "unit_price": 50.0, "amount": 50.0},
+        ]},
+    ],
+    "financials": {"extracted_total": 350.0},
+    "fraud_analysis": {"risk_level": "LOW", "flags": []},
+}
+REREAD_PAGE_1 = {"page_number": 1, "page_subtotal": 300.0, "line_items": [
+    {"description": "Room rent", "quantity": 2, "unit_price": 100.0, "amount": 200.0},
+    {"description": "Nursing", "quantity": 1, "unit_price": 100.0, "amount": 100.0},
+]}
+TERMS_PAGE = {"page_number": 2, "matched_by": "text", "times_seen": 4,
+              "content": {"page_anomalies": [], "text": "Terms and conditions"}}
+
+
+def stored_result(monkeypatch):
+    """A result as complete_job builds it: page 2 skipped as boilerplate, page 1 re-read"""
+    monkeypatch.setattr(reconcile_module, "_reread",
+                        lambda *args: ({1: copy.deepcopy(REREAD_PAGE_1)}, {"total_tokens": 10}))
+    raw = json.dumps(RAW)
+    result = reattach(json.loads(raw), [TERMS_PAGE])
+    result = attach_raw_response(result, raw)
+    result = reconcile_module.reconcile(result, {"text": "bill text", "page_count": 3}, "bill.pdf")
+    result, status = validate_math(result)
+    assert status == "MATCH"
+    assert [c["page_number"] for c in result["reconciliation"]["corrected_pages"]] == [1]
+    return result
+
+
+def test_replay_keeps_reconciled_and_reattached_pages(monkeypatch):
+    stored = stored_result(monkeypatch)
+
+    replayed, source = replay_result(copy.deepcopy(stored))
+
+    assert source == "raw_response"
+    assert replayed["financials"]["is_match"] is True
+    assert replayed["fraud_analysis"]["risk_level"] == "LOW"
+    assert not any(f.startswith("Math mismatch") for f in replayed["fraud_analysis"]["flags"])
+    assert replayed["reconciliation"] == stored["reconciliation"]
+    assert [p["page_number"] for p in replayed["pages"]] == [1, 2, 3]
+    assert replayed["pages"][1]["known_page"]["text"] == "Terms and conditions"
+    assert diff_results(stored, replayed) is None